@@ -0,0 +1,213 @@
+"""
+Small-file batching on the command channel.
+
+Sending thousands of tiny files one by one costs a queue slot, a FILE_METADATA,
+an ACK and several status messages per file. Clients that advertise "batch" in
+CLIENT_INFO instead receive a run of small files as one transfer:
+
+    BATCH_START  {"batch_id", "files": [{"file_name", "file_size"}, ...]}
+    DATA frames  - the files' bytes back to back, in index order
+    BATCH_END    {"batch_id"}
+
+The client cuts the payload back into files as it arrives and files each one
+as soon as it is complete, then answers with a single BATCH_ACK {"batch_id",
+"received", "failed"}. A file whose size changed after it was indexed is sent
+padded or cut to the indexed size, announced beforehand by BATCH_SKIP
+{"batch_id", "indexes"}; the client drops it and the server sends it again on
+its own. Per-file results stay on the client and are returned by
+BATCH_STATUS_REQUEST / BATCH_STATUS. Batches of files from a synced directory
+tree (network/manifest.py) add "tree" to BATCH_START and "tree_path" to each
+entry.
+"""
+
+import os
+
+from . import protocol
+
+BATCH_BLOCK_SIZE = 1024 * 1024  # Payload bytes gathered into one DATA frame
+BATCH_HISTORY = 32  # Batches whose per-file results a client keeps for status requests
+
+
+def plan_batches(file_paths, max_files=protocol.BATCH_MAX_FILES, max_bytes=protocol.BATCH_MAX_BYTES):
+    """Split file_paths into (paths, total size) batches of at most max_files files and max_bytes bytes."""
+    batches = []
+    current, current_bytes = [], 0
+    for path in file_paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes):
+            batches.append((current, current_bytes))
+            current, current_bytes = [], 0
+        current.append(path)
+        current_bytes += size
+    if current:
+        batches.append((current, current_bytes))
+    return batches
+
+
+def build_index(file_paths, tree_root=None):
+    """
+    (paths, index entries) for the files that still exist, in send order. Files
+    of a synced tree also carry their "tree_path" relative to tree_root.
+    """
+    paths, entries = [], []
+    for path in file_paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        paths.append(path)
+        entry = {"file_name": os.path.basename(path), "file_size": size}
+        if tree_root:
+            entry["tree_path"] = os.path.relpath(path, tree_root).replace(os.sep, "/")
+        entries.append(entry)
+    return paths, entries
+
+
+class BatchPacker:
+    """
+    Reads a batch's files in index order and gathers their bytes into blocks of
+    about BATCH_BLOCK_SIZE, so a run of tiny files costs a few large sends.
+    """
+    def __init__(self, paths, entries, block_size=BATCH_BLOCK_SIZE):
+        self.paths = paths
+        self.entries = entries
+        self.block_size = block_size
+        self.changed = []  # Indexes of files whose size no longer matched the index when read
+        self.files_done = 0
+
+    def blocks(self):
+        """Yield the payload in blocks; a block always holds whole files."""
+        buf = bytearray()
+        for index, (path, entry) in enumerate(zip(self.paths, self.entries)):
+            size = entry["file_size"]
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read(size + 1)
+            except OSError:
+                data = b""
+            if len(data) != size:
+                # The client expects exactly size bytes; it discards this file
+                self.changed.append(index)
+                data = data[:size].ljust(size, b"\0")
+            buf += data
+            self.files_done += 1
+            if len(buf) >= self.block_size:
+                yield buf
+                buf = bytearray()
+        if buf:
+            yield buf
+
+
+class BatchUnpacker:
+    """
+    Writes a batch's payload into its files as it arrives. open_file(file_name)
+    returns (path, file object) for a new file; feed() and finish() return the
+    files they completed as (index, entry, path), with path None if the file
+    was skipped or could not be written.
+    """
+    def __init__(self, batch_id, entries, open_file):
+        self.batch_id = batch_id
+        self.entries = entries
+        self.skipped = set()  # Indexes announced by BATCH_SKIP; their bytes are discarded
+        self._open_file = open_file
+        self._next = 0
+        self._current = None
+        self._path = None
+        self._handle = None
+        self._remaining = 0
+
+    def feed(self, data):
+        done = []
+        view = memoryview(data)
+        while True:
+            self._advance(done)
+            if not len(view) or self._current is None:
+                break
+            take = min(len(view), self._remaining)
+            if self._handle:
+                try:
+                    self._handle.write(view[:take])
+                except OSError as e:
+                    print(f"Cannot write {self._current['file_name']} from batch {self.batch_id}: {e}")
+                    self._discard()
+            view = view[take:]
+            self._remaining -= take
+        return done
+
+    def skip(self, indexes):
+        """Discard the bytes of these files instead of saving them."""
+        for index in indexes:
+            if not isinstance(index, int):
+                continue
+            if index >= self._next:
+                self.skipped.add(index)
+            elif (index == self._next - 1 and self._current is not None
+                  and self._remaining == self._current.get("file_size", 0)):
+                # Already opened, but none of its bytes have arrived
+                self._discard()
+                self.skipped.add(index)
+
+    def finish(self):
+        """
+        The batch ended: complete any trailing empty files. Returns (done, missing),
+        missing being the names whose bytes never arrived.
+        """
+        done = []
+        self._advance(done)
+        missing = []
+        if self._current is not None:
+            missing.append(self._current["file_name"])
+            self._discard()
+            self._current = None
+        missing.extend(entry["file_name"] for entry in self.entries[self._next:])
+        self._next = len(self.entries)
+        return done, missing
+
+    def abort(self):
+        """Drop the file being written; files already completed are kept."""
+        if self._current is not None:
+            self._discard()
+            self._current = None
+        self._next = len(self.entries)
+
+    def _advance(self, done):
+        """Finish the current file once all its bytes are in and open the next one."""
+        while self._current is None or self._remaining == 0:
+            if self._current is not None:
+                if self._handle:
+                    try:
+                        self._handle.close()
+                    except OSError:
+                        self._path = None
+                done.append((self._next - 1, self._current, self._path if self._handle else None))
+                self._current = None
+            if self._next >= len(self.entries):
+                return
+            self._current = self.entries[self._next]
+            self._next += 1
+            self._remaining = self._current.get("file_size", 0)
+            if self._next - 1 in self.skipped:
+                self._path, self._handle = None, None
+                continue
+            try:
+                self._path, self._handle = self._open_file(self._current["file_name"])
+            except OSError as e:
+                print(f"Cannot create {self._current['file_name']} from batch {self.batch_id}: {e}")
+                self._path, self._handle = None, None
+
+    def _discard(self):
+        if self._handle:
+            try:
+                self._handle.close()
+            except OSError:
+                pass
+            self._handle = None
+        if self._path:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+            self._path = None
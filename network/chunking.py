@@ -0,0 +1,97 @@
+"""
+Chunk sizes learned from each link instead of picked from file-size tiers.
+
+Every sender asks a per-client ChunkSizer how much to hand the socket at once
+and reports back how each slice went: the bytes, the seconds they took, and,
+where acks are measured, the ack round-trip. A sizer starts at
+PROBE_CHUNK_SIZE, so short files and the first bytes of every stream go out
+without waiting behind a large slice, then keeps a goodput figure per size and
+moves between powers of two within [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE]:
+
+- if a slice at the current size takes longer than TARGET_SLICE_SECONDS
+  (cancellation, progress and other streams on the channel wait that long) it
+  halves;
+- while the current size is the best measured, it probes double, as long as
+  that is still expected to meet the target;
+- otherwise it moves to the best measured size; a larger size has to beat a
+  smaller one by GROWTH_MARGIN to be preferred.
+
+Measurements expire after SIZER_MEMORY decisions so a changed link is explored
+again. Senders whose chunk size is fixed for the whole file (FileSender,
+whose receiver places chunk i at i * chunk_size) take the learned size when
+a file starts; the command channel adapts between slices of the same file.
+"""
+
+import threading
+
+MIN_CHUNK_SIZE = 64 * 1024
+PROBE_CHUNK_SIZE = 256 * 1024  # Where every client starts
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+TARGET_SLICE_SECONDS = 0.25  # Longest a single slice should hold the socket
+GROWTH_MARGIN = 1.1  # Goodput gain a larger size needs over a smaller one
+SAMPLES_PER_DECISION = 4  # Full slices measured at one size before moving
+SIZER_MEMORY = 16  # Decisions a size's measurement stays valid for
+
+
+class ChunkSizer:
+    """
+    Per-client chunk size, adjusted from measured goodput and slice latency.
+    Shared by every sender thread of one client, so it is thread-safe.
+    """
+    def __init__(self, size=PROBE_CHUNK_SIZE, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        self.lock = threading.Lock()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(max_size, size))
+        self.rates = {}  # {size: [bytes per second, seconds per slice, decision number]}
+        self.samples = 0  # Full slices recorded at self.size since the last decision
+        self.decisions = 0
+
+    def slice_size(self, limit=None):
+        """Bytes to send in the next slice, at most limit."""
+        return min(self.size, limit) if limit else self.size
+
+    def record(self, size, nbytes, elapsed, latency=None):
+        """
+        A slice asked for at size moved nbytes in elapsed seconds. latency is
+        the per-slice delay when it differs from elapsed (an ack round-trip when
+        several chunks share the time). Slices cut short, by the end of a file
+        or a bandwidth limit, say little about their size and are ignored.
+        Returns the size to use from now on.
+        """
+        with self.lock:
+            if nbytes < size // 2 or elapsed <= 0:
+                return self.size
+            rate = nbytes / elapsed
+            latency = elapsed if latency is None else latency
+            previous = self.rates.get(size)
+            if previous:
+                # Smooth like an RTT estimate; one slow slice should not undo a good size
+                rate = 0.75 * previous[0] + 0.25 * rate
+                latency = 0.75 * previous[1] + 0.25 * latency
+            self.rates[size] = [rate, latency, self.decisions]
+            if size == self.size:
+                self.samples += 1
+                if self.samples >= SAMPLES_PER_DECISION:
+                    self._decide()
+            return self.size
+
+    def _decide(self):
+        self.decisions += 1
+        self.samples = 0
+        self.rates = {s: r for s, r in self.rates.items() if self.decisions - r[2] <= SIZER_MEMORY}
+        rate, latency, _ = self.rates[self.size]
+        if latency > TARGET_SLICE_SECONDS and self.size > self.min_size:
+            self.size //= 2
+            return
+        usable = [s for s, r in self.rates.items() if r[1] <= TARGET_SLICE_SECONDS] or [self.size]
+        best = min(usable)
+        for s in sorted(usable):
+            if self.rates[s][0] > self.rates[best][0] * GROWTH_MARGIN:
+                best = s
+        larger = self.size * 2
+        if (best == self.size and larger <= self.max_size and larger not in self.rates
+                and latency * 2 <= TARGET_SLICE_SECONDS):
+            self.size = larger
+        else:
+            self.size = best
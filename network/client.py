@@ -7,21 +7,40 @@ import platform
 import subprocess
 import shutil
 import ctypes
+import random
 import zipfile
 import tempfile
 from pathlib import Path
 from auto_installer import AutoInstaller
 from PyQt5.QtCore import QObject, pyqtSignal, QTimer
 from . import protocol
+from . import framing
+from . import delta
+from . import compression
+from . import batch
+from . import manifest
+from . import fileio
+from . import integrity
 from .protocol import get_local_ip, get_adaptive_timeouts
 from collections import defaultdict
 from .connection_handler import ConnectionHandler
+from .multicast import MulticastReceiver
+from .parallel import ParallelReceiver
+from .ranges import RangeSet
+from .resume import ResumeCheckpoint, find_checkpoints
+from .swarm import SwarmPeerServer, SwarmDownloader
+from utils.hash_index import HashIndex
+from utils import hashing
 import struct
 import hashlib
+import lzma
+import zlib
 
 # Define chunk size for file transfers - will be adaptive based on network topology
 CHUNK_SIZE = 131072  # Default 128KB chunks, will be overridden by adaptive sizing
 RECEIVED_FILES_DIR = "received_files"
+# Seconds between FILE_PREPARING messages while delta signatures are computed; well below the server's reply timeout
+DELTA_KEEPALIVE_INTERVAL = 10
 
 class NetworkClient(QObject):
     server_found = pyqtSignal(dict)  # Emits server info {ip, hostname, os_type, is_windows}
@@ -53,11 +72,29 @@ class NetworkClient(QObject):
             "media": os.path.join(self.received_files_path, "media"),
             "tmp": os.path.join(self.received_files_path, "tmp"),
             "manual_setup": os.path.join(self.received_files_path, "manual_setup"),
+            "trees": os.path.join(self.received_files_path, manifest.TREES_DIR),
         }
         for p in self.dirs.values():
             os.makedirs(p, exist_ok=True)
         # Track reconnect attempts to avoid duplicates
         self._reconnect_in_progress = set()
+        # Active multicast receptions {(server_ip, transfer_id): {receiver, file_name, file_path}}
+        self.multicast_receivers = {}
+        # Peer-assisted swarm downloads {(server_ip, swarm_id): {downloader, file_name, file_path}}
+        self.swarm_downloads = {}
+        self.swarm_peer_server = None  # Serves chunks we hold to other clients, created on first offer
+        self.parallel_receiver = None  # Accepts multi-stream data connections, created on first connect
+        # Content hashes of everything already received, so files we hold are not sent again
+        self.hash_index = HashIndex(self.received_files_path)
+        # Per-file results of recent batches {(server_ip, batch_id): {file_name: status}}, for BATCH_STATUS_REQUEST
+        self.batch_results = {}
+        # Directory trees being synced {(server_ip, tree_id): {name, dir, parts, entries, pending, received, failed}},
+        # pending mapping each path still to arrive to its manifest hash
+        self.tree_syncs = {}
+        self.tree_lock = threading.Lock()
+        # Received files that failed their digest check, awaiting resent ranges
+        # {(server_ip, repair_id): {file_name, file_path, file_handle, expected, outstanding, ...}}
+        self.pending_repairs = {}
 
     def _get_local_ip(self):
         """Get the most appropriate local IP address for LAN communication"""
@@ -117,6 +154,7 @@ class NetworkClient(QObject):
             return
 
         self.running = True
+        threading.Thread(target=self.hash_index.refresh, daemon=True).start()
         self.start_discovery_client()
         print("Client started.")
 
@@ -134,9 +172,8 @@ class NetworkClient(QObject):
             
         # Try to send a test message
         try:
-            socket_obj = server_info["socket"]
             test_msg = {"type": "PING"}
-            socket_obj.sendall(json.dumps(test_msg).encode('utf-8') + b'\n')
+            self._write_message(server_ip, test_msg)
             return True
         except Exception:
             return False
@@ -149,6 +186,12 @@ class NetworkClient(QObject):
         self.stop_discovery_client()
         for server_ip in list(self.connected_servers.keys()):
             self._disconnect_from_server(server_ip)
+        if self.swarm_peer_server:
+            self.swarm_peer_server.close()
+            self.swarm_peer_server = None
+        if self.parallel_receiver:
+            self.parallel_receiver.close()
+            self.parallel_receiver = None
         print("Client stopped.")
 
     def _connect_to_server(self, server_ip=None, server_port=protocol.COMMAND_PORT, retry_count=0):
@@ -208,6 +251,12 @@ class NetworkClient(QObject):
             client_socket.settimeout(timeouts['operation'] * 2)
             
             print(f"Connected to server {server_ip}:{server_port}")
+
+            if self.parallel_receiver is None:
+                try:
+                    self.parallel_receiver = ParallelReceiver()
+                except OSError as e:
+                    print(f"Multi-stream receiving unavailable: {e}")
             
             # Send client info with retry
             client_info = {
@@ -216,7 +265,16 @@ class NetworkClient(QObject):
                 "hostname": socket.gethostname(),
                 "os_type": platform.system(),
                 "is_windows": platform.system() == "Windows",
-                "reconnect": retry_count > 0
+                "reconnect": retry_count > 0,
+                "framing": framing.LATEST_FRAMING, # Server answers with SERVER_INFO if it supports framing
+                "partial_files": self._partial_file_report(), # Interrupted receives the server may resume
+                # Listener for multi-stream transfers of large files
+                "parallel_port": self.parallel_receiver.port if self.parallel_receiver else None,
+                "max_streams": protocol.PARALLEL_MAX_STREAMS,
+                "dedup": True, # Hashed FILE_METADATA is answered with FILE_HAVE / FILE_NEED
+                "compression": list(compression.CODECS), # File bodies may arrive compressed with these
+                "batch": True, # Runs of small files may arrive as one BATCH_START ... BATCH_END transfer
+                "integrity": True # Bodies are checked against a FILE_DIGEST trailer; corrupt ranges are re-requested
             }
             
             max_info_retries = 3
@@ -229,15 +287,10 @@ class NetworkClient(QObject):
                         raise Exception(f"Failed to send client info: {e}")
                     time.sleep(1)
 
-            # Start server handler thread
+            # Register before the handler starts so SERVER_INFO can update the entry
             server_thread = threading.Thread(target=self._handle_server, args=(client_socket, server_ip))
             server_thread.daemon = True
-            server_thread.start()
-
-            # Start heartbeat thread
             heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(server_ip,), daemon=True)
-            heartbeat_thread.start()
-
             self.connected_servers[server_ip] = {
                 "socket": client_socket,
                 "thread": server_thread,
@@ -245,8 +298,16 @@ class NetworkClient(QObject):
                 "timeouts": timeouts,
                 "local_ip": local_ip,
                 "heartbeat_thread": heartbeat_thread,
-                "last_heartbeat": time.time()
+                "last_heartbeat": time.time(),
+                "send_lock": threading.Lock(),  # Background senders (swarm, multicast) share the socket
+                "framing": framing.LEGACY_FRAMING  # Raised when the server's SERVER_INFO arrives
             }
+
+            # Start server handler thread
+            server_thread.start()
+
+            # Start heartbeat thread
+            heartbeat_thread.start()
             self._current_timeouts = timeouts
             self.connection_status.emit(server_ip, True)
             self.status_update.emit(f"Connected to {server_ip}", "green")
@@ -268,37 +329,26 @@ class NetworkClient(QObject):
             self.status_update.emit(f"Error connecting to {server_ip}: {e}", "red")
 
     def _handle_server(self, server_socket, server_ip):
-        buffer = b""
-        current_file_transfer = {} # To store state for ongoing file reception
+        # One preallocated buffer per connection; file payload is written straight from views into it
+        decoder = framing.FrameDecoder(peer=f"server {server_ip}")
+        # State of each file being received, by stream id; 0 unless the server multiplexes
+        transfers = {}
         last_activity = time.time()
 
+        # Get adaptive timeouts for this server connection
+        timeouts = getattr(self, '_current_timeouts', {'operation': 120, 'inactivity': 300})
+        is_cross_machine = timeouts.get('connection', 10) > 30
+        # Use adaptive socket timeout for better cross-machine stability
+        server_socket.settimeout(5 if is_cross_machine else 2)  # 5s for cross-machine, 2s for same-machine
+
         while self.running:
             try:
-                # Get adaptive timeouts for this server connection
-                timeouts = getattr(self, '_current_timeouts', {'operation': 120, 'inactivity': 300})
-                is_cross_machine = timeouts.get('connection', 10) > 30
-                
-                # Use adaptive socket timeout for better cross-machine stability
-                server_socket.settimeout(5 if is_cross_machine else 2)  # 5s for cross-machine, 2s for same-machine
                 try:
-                    data = server_socket.recv(CHUNK_SIZE)
-                    if data:
+                    received = decoder.recv_into(server_socket)
+                    if received:
                         last_activity = time.time()
                     else:
-                        # Server closed connection. If mid-file, mark as cancelled/incomplete
-                        if current_file_transfer.get("receiving_file") and \
-                           current_file_transfer.get("received_bytes", 0) < current_file_transfer.get("file_size", 0):
-                            try:
-                                fh = current_file_transfer.get("file_handle")
-                                if fh:
-                                    fh.close()
-                            except Exception:
-                                pass
-                            file_name = current_file_transfer.get("file_name", "")
-                            self.status_update_received.emit(file_name, server_ip, "Not Received (Disconnected)")
-                            self.status_update.emit(f"Disconnected during {file_name} from {server_ip}", "red")
-                            current_file_transfer.clear()
-                        break
+                        break  # Server closed connection
                 except socket.timeout:
                     # Check for server timeout (no activity for too long) - adaptive timeout
                     inactivity_timeout = timeouts.get('inactivity', 300)
@@ -310,82 +360,137 @@ class NetworkClient(QObject):
                     print(f"Server {server_ip} connection error: {e}")
                     break
 
-                buffer += data
-
-                # If currently receiving a file, consume exactly the remaining bytes first
-                if current_file_transfer.get("receiving_file"):
-                    bytes_needed = current_file_transfer["file_size"] - current_file_transfer["received_bytes"]
-                    if bytes_needed > 0:
-                        if len(buffer) >= bytes_needed:
-                            # Write only the needed bytes to finish the file
-                            self._receive_file_chunk(server_ip, buffer[:bytes_needed], current_file_transfer)
-                            buffer = buffer[bytes_needed:]
-                        else:
-                            # Not enough data yet; write all and wait for more
-                            self._receive_file_chunk(server_ip, buffer, current_file_transfer)
-                            buffer = b""
-                            continue  # Wait for more data; skip JSON parsing for now
-
-                # Process JSON messages in buffer after file consumption
-                while b'\n' in buffer:
-                    line, remaining_buffer = buffer.split(b'\n', 1)
-                    try:
-                        message = json.loads(line.decode('utf-8'))
-                        self._process_server_message(server_ip, message, current_file_transfer)
-                        buffer = remaining_buffer # Update buffer after processing JSON
-                    except (json.JSONDecodeError, UnicodeDecodeError):
-                        # If it's not valid JSON and we are (now) receiving a file, treat entire buffer as file data
-                        if current_file_transfer.get("receiving_file"):
-                            bytes_needed = current_file_transfer["file_size"] - current_file_transfer["received_bytes"]
-                            to_write = buffer[:bytes_needed]
-                            if to_write:
-                                self._receive_file_chunk(server_ip, to_write, current_file_transfer)
-                            buffer = buffer[len(to_write):]
-                            # If still receiving, wait for more data
-                            if current_file_transfer.get("receiving_file"):
-                                break
-                        else:
-                            print(f"Non-JSON data or incomplete JSON from {server_ip}: {line.decode('utf-8', errors='ignore')}")
-                            buffer = remaining_buffer
-                        break
+                for kind, stream, payload in decoder.events():
+                    if kind == framing.FRAME_CONTROL:
+                        stream = payload.get("stream", 0)
+                    current_file_transfer = transfers.setdefault(stream, {})
+                    if kind == framing.FRAME_CONTROL:
+                        self._process_server_message(server_ip, payload, current_file_transfer)
+                        if self._server_framing(server_ip) < framing.FRAMING_VERSION:
+                            # Legacy servers follow these messages with unframed bytes
+                            msg_type = payload.get("type")
+                            if msg_type == "FILE_METADATA" and current_file_transfer.get("receiving_file"):
+                                decoder.expect_raw(current_file_transfer["file_size"] - current_file_transfer["received_bytes"])
+                            elif msg_type == "FILE_METADATA" and current_file_transfer.get("discarding"):
+                                decoder.expect_raw(payload.get("file_size", 0) - payload.get("resume_offset", 0))
+                            elif msg_type == "MULTICAST_REPAIR":
+                                decoder.expect_raw(payload.get("length", 0))
+                    elif stream and not current_file_transfer:
+                        pass  # Frames already in flight for a stream the server cancelled
+                    elif current_file_transfer.get("multicast_repair"):
+                        # Bytes repairing a multicast transfer follow a MULTICAST_REPAIR message
+                        self._receive_multicast_repair(server_ip, payload, current_file_transfer)
+                    elif current_file_transfer.get("file_repair"):
+                        # Resent ranges of a file that failed its digest check follow FILE_REPAIR
+                        self._receive_file_repair(server_ip, payload, current_file_transfer)
+                    elif current_file_transfer.get("discarding"):
+                        pass  # Body of a resume we could not honour; the server restarts the file
+                    elif current_file_transfer.get("batch"):
+                        self._receive_batch_chunk(server_ip, payload, current_file_transfer)
+                    elif current_file_transfer.get("decompressor"):
+                        self._receive_compressed_chunk(server_ip, payload, current_file_transfer)
+                    else:
+                        self._receive_file_chunk(server_ip, payload, current_file_transfer)
+                    if stream and not current_file_transfer:
+                        del transfers[stream] # Finished or cancelled
 
             except ConnectionResetError:
                 print(f"Server {server_ip} disconnected unexpectedly.")
                 break
+            except framing.FramingError as e:
+                print(f"Protocol error from server {server_ip}: {e}")
+                break
             except Exception as e:
                 if self.running:
                     print(f"Error handling server {server_ip}: {e}")
                 break
+        for current_file_transfer in transfers.values():
+            self._suspend_partial_file(server_ip, current_file_transfer)
+        if self.parallel_receiver:
+            self.parallel_receiver.suspend(server_ip)
         self._disconnect_from_server(server_ip)
 
     def _process_server_message(self, server_ip, message, current_file_transfer):
         msg_type = message.get("type")
         if msg_type == "SERVER_INFO":
             # This is typically received right after connection
+            if server_ip in self.connected_servers:
+                self.connected_servers[server_ip]["framing"] = framing.negotiate(message.get("framing"))
             self.servers[server_ip] = message
             self.server_found.emit(message) # Re-emit to update UI with full info
         elif msg_type == "FILE_METADATA":
             file_name = message.get("file_name")
             file_size = message.get("file_size")
+            file_mtime = message.get("file_mtime")
+            resume_offset = message.get("resume_offset", 0)
 
-            # Allow duplicates - create unique filename if needed
-            base_name, ext = os.path.splitext(file_name)
-            unique_name = file_name
-            counter = 1
-            temp_path = os.path.join(self.dirs.get("tmp", self.received_files_path), unique_name)
-            while os.path.exists(temp_path):
-                unique_name = f"{base_name}_{counter}{ext}"
-                temp_path = os.path.join(self.dirs.get("tmp", self.received_files_path), unique_name)
-                counter += 1
-            
+            sha256 = message.get("sha256")
+            stream = message.get("stream", 0)
+            tree = message.get("tree") if isinstance(message.get("tree"), dict) else None
+
+            self._close_delta_basis(current_file_transfer)
             current_file_transfer.clear() # Clear any previous transfer state
+            basis_path = None
+            if sha256:
+                existing = self.hash_index.lookup(sha256, file_size)
+                if existing and self._receive_existing_file(server_ip, file_name, file_size, existing, sha256, stream, tree):
+                    return
+                basis_path = self._delta_basis(server_ip, file_name, file_size, tree)
+            if not self._has_free_space(file_size - resume_offset):
+                self._reject_file(server_ip, file_name, stream, "Insufficient disk space", current_file_transfer)
+                return
+            if message.get("parallel") and self.parallel_receiver and not basis_path:
+                self._begin_parallel_receive(server_ip, message)
+                if sha256:
+                    self._send_control_message(server_ip, {"type": "FILE_NEED", "file_name": file_name, "stream": stream})
+                return
+            if resume_offset:
+                # The server verified the tail of a partial copy we reported at connect time
+                checkpoint = self._find_checkpoint(file_name, file_size, file_mtime, resume_offset)
+                if checkpoint is None:
+                    print(f"Cannot resume {file_name}: partial copy is gone")
+                    self._send_control_message(server_ip, {"type": "RESUME_REJECT", "file_name": file_name,
+                                                           "stream": stream})
+                    current_file_transfer["discarding"] = True
+                    current_file_transfer["file_name"] = file_name
+                    return
+                temp_path = checkpoint.file_path
+                unique_name = os.path.basename(temp_path)
+                file_handle = open(temp_path, 'r+b')
+                file_handle.truncate(resume_offset)
+                file_handle.seek(resume_offset)
+                checkpoint.ranges = RangeSet([[0, resume_offset]])
+                print(f"Resuming {file_name} at {resume_offset}/{file_size} bytes from {server_ip}")
+            else:
+                # Allow duplicates - create unique filename if needed
+                unique_name, temp_path = self._unique_temp_path(file_name)
+                file_handle = open(temp_path, 'wb')
+                checkpoint = ResumeCheckpoint(temp_path, file_name, file_size, file_mtime)
+            try:
+                # Reserve the whole file now: no ENOSPC midway, and fewer fragments than growing by appends
+                fileio.preallocate(file_handle.fileno(), file_size)
+            except OSError as e:
+                file_handle.close()
+                if not resume_offset:
+                    os.remove(temp_path)
+                self._reject_file(server_ip, file_name, stream, f"Cannot allocate disk space: {e.strerror}",
+                                  current_file_transfer)
+                return
+
             current_file_transfer["receiving_file"] = True
             current_file_transfer["file_name"] = file_name
             current_file_transfer["unique_name"] = unique_name
             current_file_transfer["file_size"] = file_size
-            current_file_transfer["received_bytes"] = 0
+            current_file_transfer["received_bytes"] = resume_offset
             current_file_transfer["file_path"] = temp_path
-            current_file_transfer["file_handle"] = open(temp_path, 'wb')
+            current_file_transfer["file_handle"] = file_handle
+            current_file_transfer["checkpoint"] = checkpoint
+            current_file_transfer["tree"] = tree
+            digest = message.get("digest")
+            chunk_size = digest.get("chunk_size") if isinstance(digest, dict) else None
+            if not resume_offset and isinstance(chunk_size, int) and chunk_size > 0:
+                # Chunk digests taken as the body is written, compared with the FILE_DIGEST trailer
+                current_file_transfer["integrity"] = hashing.TreeHasher(chunk_size)
             
             print(f"Receiving file metadata: {file_name} ({file_size} bytes) from {server_ip}")
             self.file_received.emit({
@@ -395,8 +500,119 @@ class NetworkClient(QObject):
                 "path": current_file_transfer["file_path"]
             })
             self.status_update.emit(f"Receiving {file_name} from {server_ip}", "orange")
+            if sha256:
+                # The server holds the body back until we answer
+                reply = {"type": "FILE_NEED", "file_name": file_name, "stream": stream}
+                if basis_path:
+                    # Signing reads the whole basis; off this thread, so other streams keep flowing
+                    threading.Thread(target=self._request_delta, daemon=True,
+                                     args=(server_ip, reply, basis_path, file_size, sha256, current_file_transfer)).start()
+                else:
+                    self._send_control_message(server_ip, reply)
+            if resume_offset >= file_size:
+                # No payload follows an empty file
+                self._receive_file_chunk(server_ip, b"", current_file_transfer)
+        elif msg_type == "COMPRESSION_START":
+            if current_file_transfer.get("receiving_file") and current_file_transfer.get("file_name") == message.get("file_name"):
+                current_file_transfer["decompressor"] = compression.Decompressor(message.get("codec"))
+        elif msg_type == "COMPRESSION_END":
+            # Anything after this is raw; the end of the stream may still hold output
+            decompressor = current_file_transfer.pop("decompressor", None)
+            if decompressor and current_file_transfer.get("receiving_file"):
+                tail = decompressor.flush()
+                if tail:
+                    self._receive_file_chunk(server_ip, tail, current_file_transfer)
+        elif msg_type == "FILE_DIGEST":
+            if current_file_transfer.get("awaiting_digest") and current_file_transfer.get("file_name") == message.get("file_name"):
+                self._check_file_digest(server_ip, message, current_file_transfer)
+        elif msg_type == "FILE_REPAIR":
+            current_file_transfer.clear()
+            if message.get("length", 0) > 0:
+                # The payload always follows; it is dropped if the repair was abandoned
+                offset = message.get("offset", 0)
+                repair = self.pending_repairs.get((server_ip, message.get("repair_id")))
+                current_file_transfer["file_repair"] = {
+                    "key": (server_ip, message.get("repair_id")),
+                    "start": offset,
+                    "offset": offset,
+                    "remaining": message.get("length", 0),
+                    "hasher": hashing.TreeHasher(repair["chunk_size"]) if repair else None
+                }
+        elif msg_type == "DELTA_COPY":
+            if current_file_transfer.get("delta_basis") and current_file_transfer.get("file_name") == message.get("file_name"):
+                self._apply_delta_copy(server_ip, message, current_file_transfer)
+        elif msg_type == "BATCH_START":
+            self._close_delta_basis(current_file_transfer)
+            current_file_transfer.clear()
+            entries = [e for e in message.get("files") or [] if isinstance(e, dict) and "file_name" in e]
+            batch_id = message.get("batch_id")
+            current_file_transfer["batch"] = batch.BatchUnpacker(batch_id, entries, self._open_batch_file)
+            current_file_transfer["tree"] = message.get("tree") if isinstance(message.get("tree"), dict) else None
+            self.batch_results[(server_ip, batch_id)] = {}
+            while len(self.batch_results) > batch.BATCH_HISTORY:
+                del self.batch_results[next(iter(self.batch_results))]
+            print(f"Receiving a batch of {len(entries)} files from {server_ip}")
+            self.status_update.emit(f"Receiving {len(entries)} files from {server_ip}", "orange")
+        elif msg_type == "BATCH_SKIP":
+            unpacker = current_file_transfer.get("batch")
+            if unpacker and unpacker.batch_id == message.get("batch_id"):
+                unpacker.skip(message.get("indexes") or [])
+        elif msg_type == "BATCH_END":
+            unpacker = current_file_transfer.get("batch")
+            if unpacker and unpacker.batch_id == message.get("batch_id"):
+                self._finish_batch(server_ip, current_file_transfer)
+        elif msg_type == "TREE_MANIFEST":
+            self._receive_tree_manifest(server_ip, message)
+        elif msg_type == "BATCH_STATUS_REQUEST":
+            for (ip, batch_id), results in list(self.batch_results.items()):
+                if ip == server_ip:
+                    self._send_control_message(server_ip, {"type": "BATCH_STATUS", "batch_id": batch_id,
+                                                           "files": results})
+        elif msg_type == "MULTICAST_OFFER":
+            self._handle_multicast_offer(server_ip, message)
+        elif msg_type == "MULTICAST_END":
+            self._handle_multicast_end(server_ip, message)
+        elif msg_type == "SWARM_OFFER":
+            self._handle_swarm_offer(server_ip, message)
+        elif msg_type == "SWARM_PEERS":
+            entry = self.swarm_downloads.get((server_ip, message.get("swarm_id")))
+            if entry:
+                entry["downloader"].update_peers(message.get("peers", []))
+        elif msg_type == "SWARM_END":
+            self._handle_swarm_end(server_ip, message)
+        elif msg_type == "MULTICAST_REPAIR":
+            # The payload always follows; it is dropped if the receiver is already gone
+            if message.get("length", 0) > 0:
+                current_file_transfer["multicast_repair"] = {
+                    "key": (server_ip, message.get("transfer_id")),
+                    "offset": message.get("offset", 0),
+                    "remaining": message.get("length", 0)
+                }
         elif msg_type == "CANCEL_TRANSFER":
             file_name = message.get("file_name")
+            # A multicast reception abandoned in favour of unicast
+            entry = self.multicast_receivers.pop((server_ip, message.get("transfer_id")), None)
+            if entry:
+                entry["receiver"].close()
+                try:
+                    os.remove(entry["file_path"])
+                except OSError:
+                    pass
+                return
+            # A multi-stream reception; a retry means the server resends it on the command channel
+            if self.parallel_receiver and self.parallel_receiver.cancel(message.get("transfer_id")):
+                if not message.get("retry"):
+                    self.status_update_received.emit(file_name, server_ip, "Cancelled by Server")
+                    self.status_update.emit(f"Transfer of {file_name} cancelled by server {server_ip}", "red")
+                return
+            unpacker = current_file_transfer.get("batch")
+            if unpacker and unpacker.batch_id == message.get("transfer_id"):
+                # Files of the batch that were complete are kept
+                unpacker.abort()
+                self.hash_index.save()
+                current_file_transfer.clear()
+                self.status_update.emit(f"Batch of files from {server_ip} cancelled by server", "red")
+                return
             # If we are currently receiving this file, close it and mark cancelled
             if current_file_transfer.get("receiving_file") and current_file_transfer.get("file_name") == file_name:
                 try:
@@ -405,7 +621,19 @@ class NetworkClient(QObject):
                         fh.close()
                 except Exception:
                     pass
+                self._close_delta_basis(current_file_transfer)
+                current_file_transfer["checkpoint"].delete()
+                current_file_transfer.clear()
+            elif current_file_transfer.get("discarding") and current_file_transfer.get("file_name") == file_name:
+                current_file_transfer.clear()
+            elif current_file_transfer.get("awaiting_digest") and current_file_transfer.get("file_name") == file_name:
+                try:
+                    os.remove(current_file_transfer["file_path"])
+                except OSError:
+                    pass
                 current_file_transfer.clear()
+            for key in [k for k, r in self.pending_repairs.items() if k[0] == server_ip and r["file_name"] == file_name]:
+                self._drop_repair(self.pending_repairs.pop(key))
             self.status_update_received.emit(file_name, server_ip, "Cancelled by Server")
             self.status_update.emit(f"Transfer of {file_name} cancelled by server {server_ip}", "red")
         elif msg_type == "HEARTBEAT":
@@ -414,6 +642,23 @@ class NetworkClient(QObject):
         else:
             print(f"Unknown message type from {server_ip}: {message}")
 
+    def _has_free_space(self, needed_bytes):
+        """True if needed_bytes more still leave protocol.DISK_SPACE_RESERVE free on the receiving disk."""
+        free = fileio.free_space(self.dirs.get("tmp", self.received_files_path))
+        return free is None or needed_bytes + protocol.DISK_SPACE_RESERVE <= free
+
+    def _reject_file(self, server_ip, file_name, stream, reason, current_file_transfer):
+        """Turn down a file announced by FILE_METADATA before its body is written anywhere."""
+        print(f"Rejecting {file_name} from {server_ip}: {reason}")
+        self._send_control_message(server_ip, {"type": "FILE_REJECT", "file_name": file_name,
+                                               "stream": stream, "reason": reason})
+        if not stream:
+            # Stream 0 bodies follow on the channel regardless; multiplexed ones are dropped by stream id
+            current_file_transfer["discarding"] = True
+            current_file_transfer["file_name"] = file_name
+        self.status_update_received.emit(file_name, server_ip, f"Rejected ({reason})")
+        self.status_update.emit(f"Rejected {file_name} from {server_ip}: {reason}", "red")
+
     def _receive_file_chunk(self, server_ip, chunk_data, current_file_transfer):
         if not current_file_transfer.get("receiving_file"):
             print(f"Received unexpected file chunk from {server_ip} without metadata.")
@@ -424,29 +669,32 @@ class NetworkClient(QObject):
         file_size = current_file_transfer["file_size"]
 
         file_handle.write(chunk_data)
+        if current_file_transfer.get("hasher"):
+            current_file_transfer["hasher"].update(chunk_data)
+        if current_file_transfer.get("integrity"):
+            current_file_transfer["integrity"].update(chunk_data)
+        start = current_file_transfer["received_bytes"]
         current_file_transfer["received_bytes"] += len(chunk_data)
+        current_file_transfer["checkpoint"].record(start, current_file_transfer["received_bytes"], file_handle)
 
-        percentage = int((current_file_transfer["received_bytes"] / file_size) * 100)
+        percentage = int((current_file_transfer["received_bytes"] / file_size) * 100) if file_size else 100
         self.file_progress.emit(file_name, server_ip, percentage)
 
         if current_file_transfer["received_bytes"] >= file_size:
+            if current_file_transfer.get("integrity"):
+                self._await_file_digest(server_ip, current_file_transfer)
+                return
             try:
                 file_handle.close()
-                print(f"Finished receiving {file_name} from {server_ip}")
-                
-                # Send ACK immediately after file completion
-                self._send_file_ack(server_ip, file_name, "Received")
-                self._send_status_update(server_ip, file_name, "Received")
-                
-                # Update local UI
-                self.status_update_received.emit(file_name, server_ip, "Received")
-                self.status_update.emit(f"Successfully received {file_name} from {server_ip}", "green")
-                
-                # Offload install to background worker; do not block socket thread
-                file_path = current_file_transfer.get("file_path")
-                if file_path:
-                    threading.Thread(target=self._post_receive_actions_wrapper, args=(server_ip, file_name, file_path), daemon=True).start()
-                    
+                current_file_transfer["checkpoint"].delete()
+                self._close_delta_basis(current_file_transfer)
+                hasher = current_file_transfer.get("hasher")
+                if hasher and hasher.hexdigest() != current_file_transfer["sha256"]:
+                    self._reject_delta(server_ip, file_name, current_file_transfer.get("file_path"))
+                    return
+                self._complete_received_file(server_ip, file_name, current_file_transfer.get("file_path"),
+                                             sha256=current_file_transfer.get("sha256"),
+                                             tree=current_file_transfer.get("tree"))
             except Exception as e:
                 print(f"Error completing file reception for {file_name}: {e}")
                 self._send_file_ack(server_ip, file_name, "Error")
@@ -454,6 +702,764 @@ class NetworkClient(QObject):
             finally:
                 current_file_transfer.clear() # Reset for next file
 
+    def _await_file_digest(self, server_ip, current_file_transfer):
+        """The body is written; close it and leave the file to the FILE_DIGEST trailer that follows."""
+        file_name = current_file_transfer["file_name"]
+        try:
+            current_file_transfer["file_handle"].close()
+            current_file_transfer["checkpoint"].delete()
+        except Exception as e:
+            print(f"Error completing file reception for {file_name}: {e}")
+            self._send_file_ack(server_ip, file_name, "Error")
+            self.status_update_received.emit(file_name, server_ip, "Error")
+            self._close_delta_basis(current_file_transfer)
+            current_file_transfer.clear()
+            return
+        self._close_delta_basis(current_file_transfer)
+        del current_file_transfer["receiving_file"]
+        current_file_transfer["awaiting_digest"] = True
+
+    def _check_file_digest(self, server_ip, message, current_file_transfer):
+        """
+        Compare the FILE_DIGEST trailer with the chunk digests taken while the body
+        was written. A match completes the file; otherwise only the chunks that
+        differ are requested again.
+        """
+        state = dict(current_file_transfer)
+        current_file_transfer.clear()
+        file_name = state["file_name"]
+        hasher = state["integrity"]
+        _, chunks = hasher.digests()
+        expected = message.get("chunks") or []
+        if message.get("chunk_size") == hasher.chunk_size and chunks == expected:
+            self._complete_received_file(server_ip, file_name, state["file_path"],
+                                         sha256=message.get("sha256"), tree=state.get("tree"))
+            return
+        bad = integrity.mismatched_chunks(expected, chunks)
+        repair = {
+            "file_name": file_name,
+            "file_path": state["file_path"],
+            "file_size": state["file_size"],
+            "tree": state.get("tree"),
+            "sha256": message.get("sha256"),
+            "chunk_size": hasher.chunk_size,
+            "expected": expected,
+            "outstanding": set(bad),
+            "attempts": 0,
+            "awaiting": 0,
+            "file_handle": None
+        }
+        print(f"{file_name} from {server_ip} failed its digest check: {len(bad)} of {len(expected)} chunks differ")
+        if message.get("chunk_size") != hasher.chunk_size:
+            self._fail_integrity(server_ip, repair, "digest chunk size mismatch")
+            return
+        try:
+            repair["file_handle"] = open(state["file_path"], 'r+b')
+        except OSError as e:
+            self._fail_integrity(server_ip, repair, str(e))
+            return
+        self._request_repair(server_ip, (server_ip, random.getrandbits(32)), repair)
+
+    def _request_repair(self, server_ip, key, repair):
+        """Ask the server to resend the chunks of a received file that still differ from its digests."""
+        repair["attempts"] += 1
+        ranges = integrity.chunk_ranges(repair["outstanding"], repair["chunk_size"], repair["file_size"])
+        if repair["attempts"] > protocol.INTEGRITY_MAX_REPAIRS or not ranges:
+            self.pending_repairs.pop(key, None)
+            self._fail_integrity(server_ip, repair, "still corrupt after repair" if ranges else "size mismatch")
+            return
+        self.pending_repairs[key] = repair
+        repair["awaiting"] = len(ranges)
+        self._send_control_message(server_ip, {"type": "RANGE_REQUEST", "repair_id": key[1],
+                                               "file_name": repair["file_name"], "ranges": ranges})
+        self.status_update_received.emit(repair["file_name"], server_ip,
+                                         f"Repairing ({len(repair['outstanding'])} corrupt chunks)")
+
+    def _receive_file_repair(self, server_ip, data, current_file_transfer):
+        """Write resent bytes into a file that failed its digest check, hashing them as they land."""
+        state = current_file_transfer["file_repair"]
+        repair = self.pending_repairs.get(state["key"])
+        view = memoryview(data)[:state["remaining"]]
+        if repair and repair["file_handle"]:
+            try:
+                repair["file_handle"].seek(state["offset"])
+                repair["file_handle"].write(view)
+                state["hasher"].update(view)
+            except OSError as e:
+                self.pending_repairs.pop(state["key"], None)
+                self._fail_integrity(server_ip, repair, str(e))
+                repair = None
+        state["offset"] += len(view)
+        state["remaining"] -= len(view)
+        if state["remaining"] > 0:
+            return
+        current_file_transfer.clear()
+        if not repair:
+            return
+        if state["start"] % repair["chunk_size"] == 0:
+            first = state["start"] // repair["chunk_size"]
+            _, chunks = state["hasher"].digests()
+            for index, digest in enumerate(chunks, first):
+                if index < len(repair["expected"]) and digest == repair["expected"][index]:
+                    repair["outstanding"].discard(index)
+        repair["awaiting"] -= 1
+        if repair["awaiting"] > 0:
+            return
+        if repair["outstanding"]:
+            self._request_repair(server_ip, state["key"], repair)
+            return
+        self.pending_repairs.pop(state["key"], None)
+        try:
+            repair["file_handle"].close()
+        except OSError as e:
+            self._fail_integrity(server_ip, repair, str(e))
+            return
+        print(f"Repaired {repair['file_name']} from {server_ip}")
+        self._complete_received_file(server_ip, repair["file_name"], repair["file_path"],
+                                     sha256=repair["sha256"], tree=repair["tree"])
+
+    def _fail_integrity(self, server_ip, repair, reason):
+        """Give up on a file that could not be verified: drop it and report the error."""
+        file_name = repair["file_name"]
+        print(f"Integrity check of {file_name} from {server_ip} failed: {reason}")
+        self._drop_repair(repair)
+        self._send_file_ack(server_ip, file_name, "Error")
+        self.status_update_received.emit(file_name, server_ip, "Error (Integrity Check Failed)")
+        self.status_update.emit(f"{file_name} from {server_ip} is corrupt: {reason}", "red")
+
+    def _drop_repair(self, repair):
+        if repair.get("file_handle"):
+            try:
+                repair["file_handle"].close()
+            except OSError:
+                pass
+        try:
+            os.remove(repair["file_path"])
+        except OSError:
+            pass
+
+    def _receive_compressed_chunk(self, server_ip, chunk_data, current_file_transfer):
+        """Decompress a DATA frame of a compressed body into the file being received."""
+        try:
+            for block in current_file_transfer["decompressor"].feed(chunk_data):
+                if not current_file_transfer.get("receiving_file"):
+                    break
+                self._receive_file_chunk(server_ip, block, current_file_transfer)
+        except (zlib.error, lzma.LZMAError) as e:
+            # Offsets are lost with the stream; abandon the file and let the server resend it
+            file_name = current_file_transfer.get("file_name", "")
+            print(f"Corrupt compressed data for {file_name} from {server_ip}: {e}")
+            raise framing.FramingError(f"corrupt compressed stream for {file_name}")
+
+    def _open_batch_file(self, file_name):
+        unique_name, temp_path = self._unique_temp_path(file_name)
+        return temp_path, open(temp_path, 'wb')
+
+    def _receive_batch_chunk(self, server_ip, chunk_data, current_file_transfer):
+        unpacker = current_file_transfer["batch"]
+        for index, entry, path in unpacker.feed(chunk_data):
+            self._file_batched(server_ip, unpacker, index, entry, path, current_file_transfer.get("tree"))
+
+    def _file_batched(self, server_ip, unpacker, index, entry, path, tree=None):
+        """
+        File one completed member of a batch straight into its category, or its
+        place in a synced tree, without a per-file ACK.
+        """
+        file_name = entry["file_name"]
+        results = self.batch_results.setdefault((server_ip, unpacker.batch_id), {})
+        if index in unpacker.skipped:
+            results[file_name] = "Resent" # Changed on the server while batching; it follows on its own
+            return
+        if path is None:
+            results[file_name] = "Error"
+            self.status_update_received.emit(file_name, server_ip, "Error")
+            return
+        self.file_received.emit({
+            "name": file_name,
+            "size": entry.get("file_size", 0),
+            "sender": server_ip,
+            "path": path
+        })
+        if tree:
+            placed = self._place_tree_file(server_ip, file_name, path, dict(tree, path=entry.get("tree_path")),
+                                           save_index=False)
+            results[file_name] = "Received successfully" if placed else "Error"
+        elif self._is_installer(path):
+            # Installers still go through the install flow, which reports its own status
+            results[file_name] = "Received"
+            threading.Thread(target=self._post_receive_actions_wrapper, args=(server_ip, file_name, path),
+                             daemon=True).start()
+        else:
+            self.hash_index.add(path)
+            self._move_to_category(path, self._detect_category(path), save_index=False)
+            results[file_name] = "Received successfully"
+        self.file_progress.emit(file_name, server_ip, 100)
+        self.status_update_received.emit(file_name, server_ip, "Received")
+
+    def _finish_batch(self, server_ip, current_file_transfer):
+        """BATCH_END: complete the trailing files and answer with one BATCH_ACK."""
+        unpacker = current_file_transfer.pop("batch")
+        done, missing = unpacker.finish()
+        for index, entry, path in done:
+            self._file_batched(server_ip, unpacker, index, entry, path, current_file_transfer.get("tree"))
+        self.hash_index.save()
+        results = self.batch_results.setdefault((server_ip, unpacker.batch_id), {})
+        for file_name in missing:
+            results[file_name] = "Error"
+            self.status_update_received.emit(file_name, server_ip, "Not Received (Batch Incomplete)")
+        failed = [name for name, status in results.items() if status == "Error"]
+        received = sum(1 for status in results.values() if status != "Error" and status != "Resent")
+        self._send_control_message(server_ip, {"type": "BATCH_ACK", "batch_id": unpacker.batch_id,
+                                               "received": received, "failed": failed})
+        print(f"Finished receiving a batch of {received} files from {server_ip}")
+        self.status_update.emit(f"Received {received} files from {server_ip}", "green")
+        current_file_transfer.clear()
+
+    def _delta_basis(self, server_ip, file_name, file_size, tree=None):
+        """An earlier copy of file_name to rebuild the new version from, or None to receive it whole."""
+        if file_size < delta.DELTA_MIN_FILE_SIZE or self._server_framing(server_ip) < framing.FRAMING_VERSION:
+            return None
+        if tree:
+            # The stale copy at the same place in the tree is the closest earlier version
+            tree_path = self._tree_file_path(tree)
+            if tree_path and os.path.isfile(tree_path):
+                return tree_path
+        return self.hash_index.find_by_name(file_name)
+
+    def _request_delta(self, server_ip, reply, basis_path, file_size, sha256, current_file_transfer):
+        """
+        Worker thread: sign the delta basis and send FILE_NEED with the signatures.
+        The server holds the body back meanwhile; FILE_PREPARING every
+        DELTA_KEEPALIVE_INTERVAL keeps it waiting for as long as signing takes.
+        """
+        file_name = reply["file_name"]
+        signed = threading.Event()
+
+        def keepalive():
+            while not signed.wait(DELTA_KEEPALIVE_INTERVAL):
+                self._send_control_message(server_ip, {"type": "FILE_PREPARING", "file_name": file_name,
+                                                       "stream": reply["stream"]})
+
+        threading.Thread(target=keepalive, daemon=True).start()
+        try:
+            fields = self._open_delta_basis(basis_path, file_size, sha256, current_file_transfer)
+        finally:
+            signed.set()
+        if fields is None:
+            return  # The transfer was cancelled, or the server stopped waiting and sent the file whole
+        reply.update(fields)
+        self._send_control_message(server_ip, reply)
+
+    def _open_delta_basis(self, basis_path, file_size, sha256, current_file_transfer):
+        """
+        Prepare to rebuild the incoming file from basis_path. Returns the fields to add
+        to FILE_NEED: the basis block signatures, or nothing if the basis is unreadable.
+        None if the transfer moved on while the basis was signed.
+        """
+        file_name = current_file_transfer.get("file_name")
+        try:
+            basis = open(basis_path, 'rb')
+        except OSError as e:
+            print(f"Cannot use {basis_path} as a delta basis: {e}")
+            return {}
+        try:
+            signatures = delta.compute_signatures(basis_path, delta.block_size_for(file_size))
+        except OSError as e:
+            print(f"Cannot use {basis_path} as a delta basis: {e}")
+            basis.close()
+            return {}
+        if (current_file_transfer.get("file_name") != file_name or not current_file_transfer.get("receiving_file")
+                or current_file_transfer.get("received_bytes")):
+            basis.close()
+            return None
+        current_file_transfer["delta_basis"] = basis
+        # Copied blocks are only as good as the basis; the result is checked against the server's hash,
+        # or chunk by chunk against the digest trailer, which repairs bad blocks instead of resending all
+        if not current_file_transfer.get("integrity"):
+            current_file_transfer["hasher"] = hashing.TreeHasher()
+        current_file_transfer["sha256"] = sha256
+        print(f"Requesting {current_file_transfer.get('file_name')} as a delta against {basis_path}")
+        return {"delta": signatures}
+
+    def _apply_delta_copy(self, server_ip, message, current_file_transfer):
+        """Append a range of the delta basis to the file being received."""
+        basis = current_file_transfer["delta_basis"]
+        remaining = message.get("length", 0)
+        basis.seek(message.get("offset", 0))
+        while remaining > 0 and current_file_transfer.get("receiving_file"):
+            count = min(delta.COPY_READ_SIZE, remaining)
+            block = basis.read(count)
+            if len(block) < count:
+                # Basis shrank underneath us; keep offsets aligned and let the hash check fail
+                block += bytes(count - len(block))
+            remaining -= count
+            self._receive_file_chunk(server_ip, block, current_file_transfer)
+
+    def _close_delta_basis(self, current_file_transfer):
+        basis = current_file_transfer.pop("delta_basis", None)
+        if basis:
+            try:
+                basis.close()
+            except OSError:
+                pass
+
+    def _reject_delta(self, server_ip, file_name, file_path):
+        """A file rebuilt from a delta did not match; drop it and have the server send it whole."""
+        print(f"Delta of {file_name} from {server_ip} did not rebuild the file; requesting it in full")
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        self._send_control_message(server_ip, {"type": "DELTA_FAILED", "file_name": file_name})
+        self.status_update.emit(f"Re-requesting {file_name} from {server_ip} in full", "orange")
+
+    def _receive_existing_file(self, server_ip, file_name, file_size, existing_path, sha256, stream=0, tree=None):
+        """
+        Satisfy FILE_METADATA from a file we already hold: hard-link it into tmp (copy
+        where links are unsupported), tell the server, and complete it as if received.
+        """
+        unique_name, temp_path = self._unique_temp_path(file_name)
+        try:
+            os.link(existing_path, temp_path)
+        except OSError:
+            try:
+                shutil.copy2(existing_path, temp_path)
+            except OSError as e:
+                print(f"Cannot reuse {existing_path} for {file_name}: {e}")
+                return False
+        if not self._send_control_message(server_ip, {"type": "FILE_HAVE", "file_name": file_name,
+                                                      "sha256": sha256, "stream": stream}):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+        print(f"Already have {file_name} as {existing_path}; skipped transfer from {server_ip}")
+        self.file_received.emit({
+            "name": file_name,
+            "size": file_size,
+            "sender": server_ip,
+            "path": temp_path
+        })
+        self.file_progress.emit(file_name, server_ip, 100)
+        self._complete_received_file(server_ip, file_name, temp_path, sha256=sha256, tree=tree)
+        return True
+
+    def _begin_parallel_receive(self, server_ip, message):
+        """Register a file whose body arrives over several data connections."""
+        file_name = message.get("file_name")
+        file_size = message.get("file_size", 0)
+        parallel = message["parallel"]
+        unique_name, temp_path = self._unique_temp_path(file_name)
+        checkpoint = ResumeCheckpoint(temp_path, file_name, file_size, message.get("file_mtime"))
+
+        def on_progress(received_bytes):
+            percentage = int((received_bytes / file_size) * 100) if file_size else 100
+            self.file_progress.emit(file_name, server_ip, percentage)
+
+        try:
+            self.parallel_receiver.register(
+                parallel.get("transfer_id"), server_ip, temp_path, file_size,
+                parallel.get("segment_size", protocol.PARALLEL_SEGMENT_SIZE), checkpoint,
+                progress_callback=on_progress,
+                completion_callback=lambda: self._complete_received_file(server_ip, file_name, temp_path,
+                                                                         tree=message.get("tree"))
+            )
+        except OSError as e:
+            print(f"Cannot receive {file_name}: {e}")
+            self._send_file_ack(server_ip, file_name, "Error")
+            self.status_update_received.emit(file_name, server_ip, "Error")
+            return
+        print(f"Receiving file metadata: {file_name} ({file_size} bytes) from {server_ip} "
+              f"over {parallel.get('streams')} streams")
+        self.file_received.emit({
+            "name": file_name,
+            "size": file_size,
+            "sender": server_ip,
+            "path": temp_path
+        })
+        self.status_update.emit(f"Receiving {file_name} from {server_ip} ({parallel.get('streams')} streams)", "orange")
+
+    def _complete_received_file(self, server_ip, file_name, file_path, run_post_receive=True, sha256=None, tree=None):
+        """
+        ACK a fully written file to the server and hand it to post-receive actions,
+        or move it to its place in a synced tree.
+        """
+        print(f"Finished receiving {file_name} from {server_ip}")
+
+        # Send ACK immediately after file completion
+        self._send_file_ack(server_ip, file_name, "Received")
+        self._send_status_update(server_ip, file_name, "Received")
+
+        # Update local UI
+        self.status_update_received.emit(file_name, server_ip, "Received")
+        self.status_update.emit(f"Successfully received {file_name} from {server_ip}", "green")
+
+        if file_path and tree:
+            # Tree files are mirrored, never installed
+            threading.Thread(target=self._place_tree_file, args=(server_ip, file_name, file_path, tree, sha256),
+                             daemon=True).start()
+        # Offload install to background worker; do not block socket thread
+        elif file_path and run_post_receive:
+            threading.Thread(target=self._post_receive_actions_wrapper, args=(server_ip, file_name, file_path, sha256), daemon=True).start()
+
+    def _receive_tree_manifest(self, server_ip, message):
+        """Collect the parts of a TREE_MANIFEST; the complete manifest is compared off the socket thread."""
+        key = (server_ip, message.get("tree_id"))
+        with self.tree_lock:
+            sync = self.tree_syncs.get(key)
+            if sync is None or sync["entries"] is not None:
+                # New tree, or the server offers it again after a reconnect
+                tree_name = manifest.safe_tree_name(message.get("tree_name"))
+                sync = {"name": message.get("tree_name"), "dir": os.path.join(self.dirs["trees"], tree_name),
+                        "parts": {}, "entries": None, "pending": {}, "received": 0, "failed": []}
+                self.tree_syncs[key] = sync
+            sync["parts"][message.get("part", 0)] = message.get("entries") or []
+            if len(sync["parts"]) < message.get("parts", 1):
+                return
+            sync["entries"] = [entry for number in sorted(sync["parts"])
+                               for entry in sync["parts"][number] if isinstance(entry, dict)]
+            sync["parts"] = {}
+        threading.Thread(target=self._compare_tree, args=(server_ip, key), daemon=True).start()
+
+    def _compare_tree(self, server_ip, key):
+        """Answer a complete manifest with TREE_NEED: the entries missing here or different from ours."""
+        sync = self.tree_syncs.get(key)
+        if not sync:
+            return
+        entries = sync["entries"]
+        started = time.time()
+        needed = manifest.missing_entries(entries, sync["dir"], self.hash_index.digest)
+        self.hash_index.save()
+        print(f"Tree {sync['name']} from {server_ip}: {len(needed)} of {len(entries)} files to fetch "
+              f"(compared in {time.time() - started:.1f}s)")
+        with self.tree_lock:
+            sync["pending"] = {entries[i]["path"]: entries[i].get("sha256") for i in needed}
+        if not self._send_control_message(server_ip, {"type": "TREE_NEED", "tree_id": key[1], "indexes": needed}):
+            return
+        if needed:
+            self.status_update.emit(f"Syncing {len(needed)} of {len(entries)} files of {sync['name']} from {server_ip}", "orange")
+        else:
+            self._finish_tree_sync(server_ip, key)
+
+    def _tree_file_path(self, tree):
+        """Local path of a file of a synced tree, or None if its path is not acceptable."""
+        tree_dir = os.path.join(self.dirs["trees"], manifest.safe_tree_name(tree.get("name")))
+        return manifest.local_path(tree_dir, tree.get("path"))
+
+    def _place_tree_file(self, server_ip, file_name, file_path, tree, sha256=None, save_index=True):
+        """
+        Move a received file to its path in a synced tree, replacing the stale copy,
+        and check it against the manifest. Returns True if it is in place.
+        """
+        dest_path = self._tree_file_path(tree)
+        key = (server_ip, tree.get("id"))
+        sync = self.tree_syncs.get(key)
+        expected = sync["pending"].get(tree.get("path")) if sync else None
+        placed = False
+        if dest_path is None:
+            print(f"Refusing tree path {tree.get('path')!r} for {file_name} from {server_ip}")
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        else:
+            try:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                os.replace(file_path, dest_path)
+                digest = self.hash_index.add(dest_path, sha256)
+                placed = expected is None or digest == expected
+                if not placed:
+                    print(f"{tree.get('path')} of {tree.get('name')} does not match the manifest")
+                if save_index:
+                    self.hash_index.save()
+            except OSError as e:
+                print(f"Failed to place {file_name} at {dest_path}: {e}")
+        status = "Received successfully" if placed else "Error"
+        if save_index:
+            # Batched files are reported by BATCH_ACK instead
+            self._send_status_update(server_ip, file_name, status)
+        self.status_update_received.emit(file_name, server_ip, status)
+        if sync:
+            with self.tree_lock:
+                if tree.get("path") not in sync["pending"]:
+                    return placed
+                del sync["pending"][tree.get("path")]
+                if placed:
+                    sync["received"] += 1
+                else:
+                    sync["failed"].append(tree.get("path"))
+                finished = not sync["pending"]
+            if finished:
+                self._finish_tree_sync(server_ip, key)
+        return placed
+
+    def _finish_tree_sync(self, server_ip, key):
+        sync = self.tree_syncs.pop(key, None)
+        if not sync:
+            return
+        self.hash_index.save()
+        self._send_control_message(server_ip, {"type": "TREE_SYNCED", "tree_id": key[1], "tree_name": sync["name"],
+                                               "received": sync["received"], "failed": sync["failed"]})
+        print(f"Synced {sync['name']} from {server_ip}: {sync['received']} files received, "
+              f"{len(sync['failed'])} failed")
+        self.status_update.emit(f"Synced {sync['name']} from {server_ip}",
+                                "green" if not sync["failed"] else "orange")
+
+    def _unique_temp_path(self, file_name):
+        """Return (unique_name, path) for a not-yet-existing file in the tmp directory."""
+        base_name, ext = os.path.splitext(file_name)
+        unique_name = file_name
+        counter = 1
+        temp_path = os.path.join(self.dirs.get("tmp", self.received_files_path), unique_name)
+        while os.path.exists(temp_path):
+            unique_name = f"{base_name}_{counter}{ext}"
+            temp_path = os.path.join(self.dirs.get("tmp", self.received_files_path), unique_name)
+            counter += 1
+        return unique_name, temp_path
+
+    def _partial_file_report(self):
+        """Describe interrupted receives in the tmp directory for the CLIENT_INFO handshake."""
+        best = {}
+        for checkpoint in find_checkpoints(self.dirs.get("tmp", self.received_files_path)):
+            key = (checkpoint.file_name, checkpoint.file_size, checkpoint.file_mtime)
+            if key not in best or checkpoint.received_offset() > best[key].received_offset():
+                best[key] = checkpoint
+        report = []
+        for checkpoint in best.values():
+            entry = checkpoint.describe()
+            if entry:
+                report.append(entry)
+        return report
+
+    def _find_checkpoint(self, file_name, file_size, file_mtime, offset):
+        """Partial copy of a file holding at least offset contiguous bytes, or None."""
+        for checkpoint in find_checkpoints(self.dirs.get("tmp", self.received_files_path)):
+            if (checkpoint.file_name == file_name and checkpoint.file_size == file_size
+                    and checkpoint.file_mtime == file_mtime and checkpoint.received_offset() >= offset):
+                return checkpoint
+        return None
+
+    def _suspend_partial_file(self, server_ip, current_file_transfer):
+        """Connection lost mid-file: close it and checkpoint what is on disk for a later resume."""
+        if current_file_transfer.get("batch"):
+            # Batches are resent whole; keep the files already filed and drop the one in progress
+            current_file_transfer.pop("batch").abort()
+            self.hash_index.save()
+            return
+        if current_file_transfer.get("awaiting_digest"):
+            # Unverified without its trailer; the server sends the file again after reconnecting
+            try:
+                os.remove(current_file_transfer["file_path"])
+            except OSError:
+                pass
+            current_file_transfer.clear()
+            return
+        if not current_file_transfer.get("receiving_file"):
+            return
+        file_handle = current_file_transfer.get("file_handle")
+        self._close_delta_basis(current_file_transfer)
+        try:
+            current_file_transfer["checkpoint"].save(file_handle)
+            if file_handle:
+                file_handle.close()
+        except Exception:
+            pass
+        file_name = current_file_transfer.get("file_name", "")
+        self.status_update_received.emit(file_name, server_ip, "Not Received (Disconnected)")
+        self.status_update.emit(f"Disconnected during {file_name} from {server_ip}; will resume on reconnect", "red")
+        current_file_transfer.clear()
+
+    def _server_framing(self, server_ip):
+        server = self.connected_servers.get(server_ip)
+        return server.get("framing", framing.LEGACY_FRAMING) if server else framing.LEGACY_FRAMING
+
+    def _write_message(self, server_ip, message):
+        """Encode a message in the server's negotiated framing and send it; raises on failure."""
+        server = self.connected_servers[server_ip]
+        data = framing.encode_message(message, server.get("framing", framing.LEGACY_FRAMING))
+        with server["send_lock"]:
+            server["socket"].sendall(data)
+
+    def _send_control_message(self, server_ip, message):
+        """Send one control message to the server; returns True on success."""
+        if server_ip not in self.connected_servers:
+            return False
+        try:
+            self._write_message(server_ip, message)
+            return True
+        except Exception as e:
+            print(f"Failed to send {message.get('type')} to {server_ip}: {e}")
+            return False
+
+    def _handle_multicast_offer(self, server_ip, message):
+        """Join the multicast group for an offered file, or tell the server to use unicast."""
+        transfer_id = message.get("transfer_id")
+        file_name = message.get("file_name")
+        file_size = message.get("file_size", 0)
+        if not self._has_free_space(file_size):
+            print(f"Not enough disk space for {file_name}; declining multicast")
+            self._send_control_message(server_ip, {"type": "MULTICAST_REJECT", "transfer_id": transfer_id,
+                                                   "reason": "Insufficient disk space"})
+            return
+        unique_name, temp_path = self._unique_temp_path(file_name)
+        try:
+            interface_ip = self.connected_servers[server_ip]["socket"].getsockname()[0]
+        except Exception:
+            interface_ip = '0.0.0.0'
+
+        def on_progress(received_bytes):
+            percentage = int((received_bytes / file_size) * 100) if file_size else 100
+            self.file_progress.emit(file_name, server_ip, percentage)
+
+        try:
+            receiver = MulticastReceiver(transfer_id, temp_path, file_size,
+                                         interface_ip=interface_ip, progress_callback=on_progress)
+        except Exception as e:
+            print(f"Cannot join multicast group for {file_name}: {e}")
+            self._send_control_message(server_ip, {"type": "MULTICAST_REJECT", "transfer_id": transfer_id,
+                                                   "reason": str(e)})
+            return
+        self.multicast_receivers[(server_ip, transfer_id)] = {
+            "receiver": receiver,
+            "file_name": file_name,
+            "file_path": temp_path
+        }
+        self._send_control_message(server_ip, {"type": "MULTICAST_READY", "transfer_id": transfer_id})
+        print(f"Joined multicast for {file_name} ({file_size} bytes) from {server_ip}")
+        self.file_received.emit({
+            "name": file_name,
+            "size": file_size,
+            "sender": server_ip,
+            "path": temp_path
+        })
+        self.status_update.emit(f"Receiving {file_name} from {server_ip} (multicast)", "orange")
+
+    def _handle_multicast_end(self, server_ip, message):
+        """Server finished a multicast pass or repair round: report gaps or complete."""
+        transfer_id = message.get("transfer_id")
+        key = (server_ip, transfer_id)
+        entry = self.multicast_receivers.get(key)
+        if not entry:
+            return
+        receiver = entry["receiver"]
+        receiver.wait_idle()
+        missing = receiver.missing_ranges()
+        if missing:
+            print(f"Multicast {entry['file_name']}: requesting {len(missing)} missing ranges")
+            self._send_control_message(server_ip, {"type": "MULTICAST_NACK", "transfer_id": transfer_id,
+                                                   "ranges": missing})
+            return
+        del self.multicast_receivers[key]
+        receiver.close()
+        self._send_control_message(server_ip, {"type": "MULTICAST_COMPLETE", "transfer_id": transfer_id})
+        self.file_progress.emit(entry["file_name"], server_ip, 100)
+        self._complete_received_file(server_ip, entry["file_name"], entry["file_path"])
+
+    def _handle_swarm_offer(self, server_ip, message):
+        """Join a swarm: fetch chunks from peers and serve the ones we hold."""
+        swarm_id = message.get("swarm_id")
+        file_name = message.get("file_name")
+        file_size = message.get("file_size", 0)
+        key = (server_ip, swarm_id)
+        chunk_digests = message.get("chunks")
+        root = message.get("sha256")
+        if not isinstance(chunk_digests, list) or not root:
+            # Without digests chunks from other peers cannot be checked; take a unicast copy instead
+            print(f"Swarm offer for {file_name} carries no chunk digests; declining swarm")
+            self._send_control_message(server_ip, {"type": "SWARM_REJECT", "swarm_id": swarm_id,
+                                                   "reason": "No chunk digests"})
+            return
+        if not self._has_free_space(file_size):
+            print(f"Not enough disk space for {file_name}; declining swarm")
+            self._send_control_message(server_ip, {"type": "SWARM_REJECT", "swarm_id": swarm_id,
+                                                   "reason": "Insufficient disk space"})
+            return
+        unique_name, temp_path = self._unique_temp_path(file_name)
+        try:
+            if self.swarm_peer_server is None:
+                self.swarm_peer_server = SwarmPeerServer()
+
+            def on_progress(received_bytes):
+                percentage = int((received_bytes / file_size) * 100) if file_size else 100
+                self.file_progress.emit(file_name, server_ip, percentage)
+
+            def on_complete():
+                # Keep seeding until the server ends the swarm; install afterwards
+                self._send_control_message(server_ip, {"type": "SWARM_COMPLETE", "swarm_id": swarm_id})
+                self.file_progress.emit(file_name, server_ip, 100)
+                self._complete_received_file(server_ip, file_name, temp_path, run_post_receive=False, sha256=root)
+
+            def on_failure():
+                # The server re-sends files not completed by the end of the swarm by unicast
+                self.status_update_received.emit(file_name, server_ip, "Error (Integrity Check Failed)")
+
+            downloader = SwarmDownloader(
+                swarm_id, temp_path, file_size, message.get("chunk_size", protocol.SWARM_CHUNK_SIZE), server_ip,
+                request_peers=lambda: self._send_control_message(
+                    server_ip, {"type": "SWARM_PEERS_REQUEST", "swarm_id": swarm_id}),
+                report_have=lambda ranges: self._send_control_message(
+                    server_ip, {"type": "SWARM_HAVE", "swarm_id": swarm_id, "ranges": ranges}),
+                chunk_digests=chunk_digests,
+                root=root,
+                progress_callback=on_progress,
+                completion_callback=on_complete,
+                failure_callback=on_failure
+            )
+        except Exception as e:
+            print(f"Cannot join swarm for {file_name}: {e}")
+            self._send_control_message(server_ip, {"type": "SWARM_REJECT", "swarm_id": swarm_id, "reason": str(e)})
+            return
+        self.swarm_downloads[key] = {"downloader": downloader, "file_name": file_name, "file_path": temp_path,
+                                     "sha256": root}
+        self.swarm_peer_server.register(swarm_id, temp_path, downloader.has_range)
+        self._send_control_message(server_ip, {"type": "SWARM_JOIN", "swarm_id": swarm_id,
+                                               "port": self.swarm_peer_server.port})
+        print(f"Joined swarm for {file_name} ({file_size} bytes) from {server_ip}")
+        self.file_received.emit({
+            "name": file_name,
+            "size": file_size,
+            "sender": server_ip,
+            "path": temp_path
+        })
+        self.status_update.emit(f"Receiving {file_name} from {server_ip} (swarm)", "orange")
+        downloader.start()
+
+    def _handle_swarm_end(self, server_ip, message):
+        """Stop seeding a swarm file; install it if complete, discard it otherwise."""
+        entry = self._stop_swarm_download((server_ip, message.get("swarm_id")))
+        if not entry:
+            return
+        if entry["downloader"].completed:
+            threading.Thread(target=self._post_receive_actions_wrapper,
+                             args=(server_ip, entry["file_name"], entry["file_path"], entry["sha256"]),
+                             daemon=True).start()
+        else:
+            # The server re-sends incomplete swarm files by unicast
+            try:
+                os.remove(entry["file_path"])
+            except OSError:
+                pass
+
+    def _stop_swarm_download(self, key):
+        entry = self.swarm_downloads.pop(key, None)
+        if entry:
+            if self.swarm_peer_server:
+                self.swarm_peer_server.unregister(key[1])
+            entry["downloader"].close()
+        return entry
+
+    def _receive_multicast_repair(self, server_ip, data, current_file_transfer):
+        """Write unicast repair bytes of a multicast transfer at their offset."""
+        repair = current_file_transfer["multicast_repair"]
+        entry = self.multicast_receivers.get(repair["key"])
+        if entry:
+            entry["receiver"].write_at(repair["offset"], data)
+        repair["offset"] += len(data)
+        repair["remaining"] -= len(data)
+        if repair["remaining"] <= 0:
+            del current_file_transfer["multicast_repair"]
+
     def _send_file_ack(self, server_ip, file_name, status):
         if server_ip not in self.connected_servers:
             print(f"Server {server_ip} not in connected_servers, cannot send ACK")
@@ -470,7 +1476,7 @@ class NetworkClient(QObject):
 
         while retry_count <= max_retries:
             try:
-                self.connected_servers[server_ip]["socket"].sendall(json.dumps(ack_message).encode('utf-8') + b'\n')
+                self._write_message(server_ip, ack_message)
                 print(f"Sent ACK for {file_name} to {server_ip} with status: {status}")
                 break  # Success, exit retry loop
             except Exception as e:
@@ -494,7 +1500,7 @@ class NetworkClient(QObject):
             
             while retry_count <= max_retries:
                 try:
-                    self.connected_servers[server_ip]["socket"].sendall(json.dumps(msg).encode('utf-8') + b'\n')
+                    self._write_message(server_ip, msg)
                     print(f"Sent STATUS_UPDATE for {file_name} to {server_ip}: {status}")
                     break  # Success, exit retry loop
                 except Exception as e:
@@ -573,7 +1579,7 @@ class NetworkClient(QObject):
         if server_ip in self.connected_servers:
             try:
                 msg = {"type": "CANCEL_TRANSFER", "file_name": file_name}
-                self.connected_servers[server_ip]["socket"].sendall(json.dumps(msg).encode('utf-8') + b'\n')
+                self._write_message(server_ip, msg)
                 self.status_update.emit(f"Requested cancel for {file_name}", "orange")
             except Exception as e:
                 print(f"Failed to send cancel request for {file_name} to {server_ip}: {e}")
@@ -581,19 +1587,11 @@ class NetworkClient(QObject):
     def _detect_category(self, file_path):
         """Classify file into media or files categories by extension."""
         ext = os.path.splitext(file_path)[1].lower()
-        media_exts = {
-            # images
-            ".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".svg", ".webp", ".heic",
-            # audio
-            ".mp3", ".wav", ".flac", ".aac", ".ogg", ".m4a",
-            # video
-            ".mp4", ".mkv", ".avi", ".mov", ".wmv", ".webm"
-        }
-        if ext in media_exts:
+        if ext in protocol.MEDIA_EXTENSIONS:
             return "media"
         return "files"
 
-    def _move_to_category(self, file_path, category):
+    def _move_to_category(self, file_path, category, save_index=True):
         try:
             dest_dir = self.dirs.get(category, self.dirs.get("files", self.received_files_path))
             os.makedirs(dest_dir, exist_ok=True)
@@ -602,6 +1600,9 @@ class NetworkClient(QObject):
                 base, ext = os.path.splitext(dest_path)
                 dest_path = f"{base}_{int(time.time())}{ext}"
             shutil.move(file_path, dest_path)
+            self.hash_index.move(file_path, dest_path)
+            if save_index:
+                self.hash_index.save()
             return dest_path
         except Exception as e:
             print(f"Failed to move {file_path} to {category}: {e}")
@@ -640,6 +1641,8 @@ class NetworkClient(QObject):
                 base, ext = os.path.splitext(dest_path)
                 dest_path = f"{base}_{int(time.time())}{ext}"
             shutil.move(file_path, dest_path)
+            self.hash_index.move(file_path, dest_path)
+            self.hash_index.save()
             info_path = dest_path + ".info.txt"
             with open(info_path, "w", encoding="utf-8") as f:
                 f.write(f"Reason: {reason}\nTimestamp: {time.ctime()}\n")
@@ -647,8 +1650,11 @@ class NetworkClient(QObject):
         except Exception:
             return None
 
-    def _post_receive_actions_wrapper(self, server_ip, file_name, file_path):
+    def _post_receive_actions_wrapper(self, server_ip, file_name, file_path, sha256=None):
         try:
+            # Index before installing/moving; _move_to_category keeps the entry in step
+            if self.hash_index.add(file_path, sha256):
+                self.hash_index.save()
             self._post_receive_actions(server_ip, file_name, file_path)
         except Exception as e:
             # Keep errors in status bar; no ACKs here
@@ -663,7 +1669,7 @@ class NetworkClient(QObject):
                 heartbeat_interval = timeouts.get('heartbeat', 30)
                 
                 heartbeat_msg = {"type": "HEARTBEAT", "timestamp": time.time()}
-                self.connected_servers[server_ip]["socket"].sendall(json.dumps(heartbeat_msg).encode('utf-8') + b'\n')
+                self._write_message(server_ip, heartbeat_msg)
                 time.sleep(heartbeat_interval)  # Adaptive heartbeat interval
             except Exception as e:
                 print(f"Heartbeat failed for {server_ip}: {e}")
@@ -833,6 +1839,14 @@ class NetworkClient(QObject):
             self.status_update.emit(f"{file_name}: saved to {category}", "green")
 
     def _disconnect_from_server(self, server_ip):
+        # Abandon multicast receptions from this server; they restart by unicast on reconnect
+        for key in [k for k in self.multicast_receivers if k[0] == server_ip]:
+            self.multicast_receivers.pop(key)["receiver"].close()
+        for key in [k for k in self.swarm_downloads if k[0] == server_ip]:
+            self._stop_swarm_download(key)
+        # Files awaiting repaired ranges are dropped; the server sends them again on reconnect
+        for key in [k for k in self.pending_repairs if k[0] == server_ip]:
+            self._drop_repair(self.pending_repairs.pop(key))
         if server_ip in self.connected_servers:
             server_socket = self.connected_servers[server_ip]["socket"]
             try:
@@ -0,0 +1,119 @@
+"""
+Streaming compression of file bodies sent on the command channel.
+
+Clients list the codecs they can decode in CLIENT_INFO ("compression"). When
+the server's codec is among them and the file is not an already-compressed
+type, the body is sent as
+
+    COMPRESSION_START {"file_name", "codec"}
+    DATA frames       - the compressed stream
+    COMPRESSION_END   {"file_name", "offset"}
+
+and the client decompresses into the file as frames arrive. Everything else
+(progress, resume checkpoints, the final ACK) works on uncompressed offsets.
+The server keeps measuring while it compresses; if compressing costs more time
+than it saves on the wire it ends the stream early and the rest of the file,
+from "offset", follows raw.
+"""
+
+import lzma
+import os
+import zlib
+
+from . import protocol
+
+CODECS = ("zlib", "lzma")
+# Container formats and installer packages that are compressed already
+ARCHIVE_EXTENSIONS = {
+    ".zip", ".7z", ".rar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".cab",
+    ".jar", ".msix", ".appx",
+}
+COMPRESSION_BLOCK_SIZE = 1024 * 1024  # File bytes handed to the compressor at a time
+PROBE_BYTES = 16 * 1024 * 1024  # File bytes compressed before compression is judged
+MAX_OUTPUT_SIZE = 4 * 1024 * 1024  # Decompressed bytes produced per step, bounds memory
+
+
+def compressible(file_name):
+    """False for media and archive types that would not shrink."""
+    ext = os.path.splitext(file_name)[1].lower()
+    return ext not in protocol.MEDIA_EXTENSIONS and ext not in ARCHIVE_EXTENSIONS
+
+
+class Compressor:
+    def __init__(self, codec, level):
+        if codec == "zlib":
+            self._obj = zlib.compressobj(level)
+        elif codec == "lzma":
+            self._obj = lzma.LZMACompressor(preset=level)
+        else:
+            raise ValueError(f"unknown compression codec {codec!r}")
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class Decompressor:
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "zlib":
+            self._obj = zlib.decompressobj()
+        elif codec == "lzma":
+            self._obj = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f"unknown compression codec {codec!r}")
+
+    def feed(self, data):
+        """Yield the decompressed output of data, at most MAX_OUTPUT_SIZE bytes at a time."""
+        if self.codec == "zlib":
+            block = self._obj.decompress(data, MAX_OUTPUT_SIZE)
+            while True:
+                if block:
+                    yield block
+                if not self._obj.unconsumed_tail:
+                    return
+                block = self._obj.decompress(self._obj.unconsumed_tail, MAX_OUTPUT_SIZE)
+        else:
+            block = self._obj.decompress(data, max_length=MAX_OUTPUT_SIZE)
+            while True:
+                if block:
+                    yield block
+                if self._obj.needs_input or self._obj.eof:
+                    return
+                block = self._obj.decompress(b"", max_length=MAX_OUTPUT_SIZE)
+
+    def flush(self):
+        return self._obj.flush() if self.codec == "zlib" else b""
+
+
+class ThroughputMonitor:
+    """
+    Decides whether compressing is still paying off. Compressing N bytes to a
+    ratio r costs N/C seconds at compression throughput C and saves (1 - r)N/L
+    on a link of throughput L, so it pays while C > L / (1 - r). L is measured
+    from the time spent sending compressed data.
+    """
+    def __init__(self, probe_bytes=PROBE_BYTES):
+        self.probe_bytes = probe_bytes
+        self.in_bytes = 0
+        self.out_bytes = 0
+        self.compress_seconds = 0.0
+        self.send_seconds = 0.0
+
+    def record(self, in_bytes, out_bytes, compress_seconds, send_seconds):
+        self.in_bytes += in_bytes
+        self.out_bytes += out_bytes
+        self.compress_seconds += compress_seconds
+        self.send_seconds += send_seconds
+
+    def worthwhile(self):
+        if self.in_bytes < self.probe_bytes or not self.out_bytes:
+            return True
+        # Time taken per byte now vs. sending the same bytes raw at the measured link rate
+        raw_seconds = self.in_bytes * self.send_seconds / self.out_bytes
+        return self.compress_seconds + self.send_seconds < raw_seconds
+
+    def ratio(self):
+        return self.out_bytes / self.in_bytes if self.in_bytes else 1.0
@@ -0,0 +1,149 @@
+"""
+rsync-style delta transfer of files the client holds an older version of.
+
+The client splits its previous copy (the basis) into fixed-size blocks and
+sends a signature per block: the Adler-32 of the block as a rolling weak
+checksum and a truncated SHA-256 as the strong one. The server walks the new
+file looking for blocks whose checksums match and answers with a mix of
+
+    DELTA_COPY control messages  - copy [offset, offset + length) of the basis
+    DATA frames                  - literal bytes of the new file
+
+in file order, so the client rebuilds the new file by appending either and
+verifies the result against the SHA-256 from FILE_METADATA.
+
+Signing reads the whole basis, so the client does it on a worker thread and
+sends FILE_PREPARING every few seconds meanwhile; each one extends the time
+the server holds the body back waiting for FILE_NEED.
+
+Adler-32 of a window can be rolled one byte at a time (a' = a - out + in,
+b' = b - L*out + a' - 1, both mod 65521), which is how the search re-aligns
+after an insertion. Aligned positions are checked with zlib.adler32 in C; the
+per-byte roll in Python only runs after a miss and is abandoned, falling back
+to a full send, when most of the file turns out to be literal anyway.
+"""
+
+import base64
+import hashlib
+import mmap
+import struct
+import zlib
+
+ADLER_MOD = 65521
+STRONG_DIGEST_SIZE = 16
+SIGNATURE = struct.Struct('!I16s')  # weak checksum, truncated SHA-256
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+DELTA_MIN_FILE_SIZE = 1024 * 1024  # Below this a delta cannot save a meaningful amount
+# Give up on a delta once this share of the scanned bytes has been literal
+DELTA_MAX_LITERAL_RATIO = 0.5
+DELTA_PROBE_BLOCKS = 16  # Blocks scanned before the literal ratio is judged
+COPY_READ_SIZE = 1024 * 1024
+
+
+def block_size_for(file_size):
+    """Block size near sqrt(file_size), as rsync does, rounded to a power of two."""
+    size = 1 << max(0, int(file_size ** 0.5).bit_length())
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+
+def strong_digest(block):
+    return hashlib.sha256(block).digest()[:STRONG_DIGEST_SIZE]
+
+
+def compute_signatures(file_path, block_size):
+    """Signature message for file_path: {"block_size", "basis_size", "signatures"} (base64)."""
+    parts = []
+    size = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                # A short final block cannot be rolled against full windows
+                size += len(block)
+                break
+            parts.append(SIGNATURE.pack(zlib.adler32(block), strong_digest(block)))
+            size += len(block)
+    return {
+        "block_size": block_size,
+        "basis_size": size,
+        "signatures": base64.b64encode(b"".join(parts)).decode('ascii')
+    }
+
+
+def decode_signatures(message):
+    """{weak: {strong: basis block index}} from a signature message."""
+    blob = base64.b64decode(message.get("signatures", ""))
+    table = {}
+    for index in range(len(blob) // SIGNATURE.size):
+        weak, strong = SIGNATURE.unpack_from(blob, index * SIGNATURE.size)
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def generate_delta(file_path, signature_message):
+    """
+    Plan the delta of file_path against the client's basis. Returns a list of
+    ("copy", basis_offset, length) and ("literal", file_offset, length) ops in
+    file order, or None if a delta would not save enough to be worth it.
+    """
+    block_size = int(signature_message.get("block_size", 0))
+    if block_size <= 0:
+        return None
+    table = decode_signatures(signature_message)
+    if not table:
+        return None
+    ops = []
+    literal_bytes = 0
+
+    def add(kind, offset, length):
+        # Merge with the previous op when contiguous in both the output and the source
+        if ops and ops[-1][0] == kind and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1] = (kind, ops[-1][1], ops[-1][2] + length)
+        else:
+            ops.append((kind, offset, length))
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        size = len(m)
+        pos = 0
+        literal_start = 0
+        while pos + block_size <= size:
+            weak = zlib.adler32(m[pos:pos + block_size])
+            candidates = table.get(weak)
+            index = candidates.get(strong_digest(m[pos:pos + block_size])) if candidates else None
+            if index is not None:
+                if pos > literal_start:
+                    add("literal", literal_start, pos - literal_start)
+                    literal_bytes += pos - literal_start
+                add("copy", index * block_size, block_size)
+                pos += block_size
+                literal_start = pos
+                continue
+            # Roll forward up to one block looking for a window that matches again
+            a, b = weak & 0xffff, weak >> 16
+            limit = min(size - block_size, pos + block_size)
+            while pos < limit:
+                out_byte = m[pos]
+                in_byte = m[pos + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                pos += 1
+                if ((b << 16) | a) in table:
+                    break
+            else:
+                if pos == limit and limit == size - block_size:
+                    break  # Last window checked; the rest is literal
+            scanned = max(pos, 1)
+            if pos >= DELTA_PROBE_BLOCKS * block_size and \
+                    (literal_bytes + pos - literal_start) / scanned > DELTA_MAX_LITERAL_RATIO:
+                return None
+        if size > literal_start:
+            add("literal", literal_start, size - literal_start)
+            literal_bytes += size - literal_start
+    if literal_bytes > DELTA_MAX_LITERAL_RATIO * max(size, 1):
+        return None
+    return ops
+
+
+def literal_size(ops):
+    return sum(length for kind, _, length in ops if kind == "literal")
@@ -0,0 +1,148 @@
+"""
+Single-read fan-out of one file to many concurrent senders.
+
+A FanoutReader reads each chunk of a file from disk exactly once into a bounded
+ring shared by every per-client sender. Reads are paced by the fastest sender
+and chunks are evicted once every attached sender has moved past them. A sender
+that falls more than the ring window behind the read head is detached; it then
+falls back to reading the file on its own from its current offset.
+"""
+
+import threading
+import time
+
+# Default number of chunks kept in memory per shared file
+FANOUT_WINDOW_CHUNKS = 64
+# Seconds the read-ahead thread may sit idle before releasing the file
+FANOUT_IDLE_TIMEOUT = 300
+# Chunks read ahead of the fastest consumer
+FANOUT_PREFETCH_CHUNKS = 4
+
+
+class FanoutReader:
+    """
+    Shared read-ahead ring for one file.
+
+    Consumers are identified by an opaque key (the client IP on the server).
+    Each consumer calls read_chunk() with the offset it wants next; a return
+    value of None means the consumer is no longer served by the ring and must
+    read the file itself.
+    """
+
+    def __init__(self, file_path, consumers, file_size, chunk_size, window_chunks=FANOUT_WINDOW_CHUNKS):
+        self.file_path = file_path
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.window_chunks = max(2, window_chunks)
+        self.total_chunks = (file_size + chunk_size - 1) // chunk_size
+        self._cond = threading.Condition()
+        self._chunks = {}  # {chunk_index: bytes}
+        self._positions = {c: 0 for c in consumers}  # {consumer: chunk index it needs next}
+        self._detached = set()
+        self._head = 0  # Next chunk index to read from disk
+        self._closed = False
+        self._thread = None
+        self.disk_bytes_read = 0
+
+    def _start(self):
+        # Lazily start read-ahead on first demand so queued-but-idle files cost nothing
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._read_ahead_loop, daemon=True)
+            self._thread.start()
+
+    def read_chunk(self, consumer, offset):
+        """
+        Return a memoryview of file data starting at offset (up to the end of its
+        chunk), or None if the consumer was detached or the data left the window.
+        """
+        index = offset // self.chunk_size
+        with self._cond:
+            if consumer in self._detached or consumer not in self._positions or self._closed:
+                return None
+            self._positions[consumer] = index
+            self._evict()
+            self._start()
+            self._cond.notify_all()
+            while index not in self._chunks:
+                if consumer in self._detached or self._closed:
+                    return None
+                if index < self._head:
+                    # Chunk already evicted (e.g. resumed from an old offset)
+                    self._detach(consumer)
+                    return None
+                self._cond.wait(timeout=1.0)
+            chunk = self._chunks[index]
+        return memoryview(chunk)[offset - index * self.chunk_size:]
+
+    def release(self, consumer):
+        """Stop serving a consumer (finished, cancelled or disconnected)."""
+        with self._cond:
+            self._positions.pop(consumer, None)
+            self._detached.discard(consumer)
+            self._evict()
+            if not self._positions:
+                self._close()
+            self._cond.notify_all()
+
+    def _detach(self, consumer):
+        print(f"[Fanout] {consumer} lagged beyond the shared window for {self.file_path}; using a private reader")
+        self._detached.add(consumer)
+        self._positions.pop(consumer, None)
+        self._evict()
+        if not self._positions:
+            self._close()
+
+    def _evict(self):
+        # Drop chunks that every attached consumer has already moved past
+        low = min(self._positions.values()) if self._positions else self.total_chunks
+        for idx in [i for i in self._chunks if i < low]:
+            del self._chunks[idx]
+
+    def _close(self):
+        self._closed = True
+        self._chunks.clear()
+
+    def _read_ahead_loop(self):
+        try:
+            with open(self.file_path, 'rb') as f:
+                idle_since = time.time()
+                while True:
+                    with self._cond:
+                        if self._closed or not self._positions or self._head >= self.total_chunks:
+                            break
+                        # Pace disk reads by the fastest consumer, never by the slowest
+                        fastest = max(self._positions.values())
+                        if self._head >= fastest + FANOUT_PREFETCH_CHUNKS:
+                            if time.time() - idle_since > FANOUT_IDLE_TIMEOUT:
+                                self._close()
+                                self._cond.notify_all()
+                                break
+                            self._cond.wait(timeout=1.0)
+                            continue
+                        index = self._head
+                    f.seek(index * self.chunk_size)
+                    data = f.read(self.chunk_size)
+                    with self._cond:
+                        if not data:
+                            self._close()
+                            self._cond.notify_all()
+                            break
+                        self.disk_bytes_read += len(data)
+                        if not self._closed:
+                            self._chunks[index] = data
+                        self._head = index + 1
+                        idle_since = time.time()
+                        # Consumers that fell out of the window switch to a private reader
+                        for consumer, pos in list(self._positions.items()):
+                            if pos < self._head - self.window_chunks:
+                                self._detach(consumer)
+                        self._evict()
+                        self._cond.notify_all()
+        except Exception as e:
+            print(f"[Fanout] Read-ahead error for {self.file_path}: {e}")
+            with self._cond:
+                # Everybody falls back to private readers
+                self._detached.update(self._positions.keys())
+                self._positions.clear()
+                self._close()
+                self._cond.notify_all()
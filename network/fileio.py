@@ -0,0 +1,97 @@
+"""
+Low-level file helpers shared by the receivers that write data by offset.
+"""
+
+import errno
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import ctypes
+except ImportError:  # Minimal Python builds
+    ctypes = None
+
+# os.pwrite is POSIX-only; on Windows positional writes are emulated under a lock
+_seek_write_lock = threading.Lock()
+
+
+def open_for_positional_write(path, size=None):
+    """Open (creating if needed) a file for offset-based writes and return its fd."""
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o644)
+    if size is not None:
+        try:
+            preallocate(fd, size)
+        except OSError:
+            os.close(fd)
+            raise
+    return fd
+
+
+def preallocate(fd, size):
+    """
+    Give the file its full size with the disk blocks reserved, so a full disk
+    shows up now rather than midway and the file is laid out contiguously.
+    Only the fallocate(2) system call is used: glibc's posix_fallocate() falls
+    back to writing every block on file systems without native support
+    (FAT/exFAT, some network mounts), which for a large file would hold up the
+    caller for as long as writing it takes. Where fallocate is unavailable the
+    file is only extended (sparse). Existing content is kept; raises OSError
+    (ENOSPC) if the space is not there.
+    """
+    if size <= 0:
+        return
+    fallocate = _native_fallocate()
+    if fallocate is not None:
+        if fallocate(fd, 0, 0, size) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise OSError(err, os.strerror(err))
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+_fallocate = False  # Not looked up yet
+
+
+def _native_fallocate():
+    """libc's fallocate64(), a plain wrapper of the Linux system call; None elsewhere."""
+    global _fallocate
+    if _fallocate is False:
+        _fallocate = None
+        if ctypes is not None and sys.platform.startswith('linux'):
+            try:
+                func = ctypes.CDLL(None, use_errno=True).fallocate64
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+                func.restype = ctypes.c_int
+                _fallocate = func
+            except (OSError, AttributeError):
+                pass
+    return _fallocate
+
+
+def free_space(path):
+    """Free bytes on the file system holding path, or None if it cannot be determined."""
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+def pwrite(fd, data, offset):
+    """Write all of data at offset without moving a shared file position."""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with _seek_write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
@@ -0,0 +1,257 @@
+"""
+Wire format of the command channel.
+
+Version 1 (legacy) is newline-delimited JSON, with raw file bytes following a
+FILE_METADATA or MULTICAST_REPAIR line. Version 2 frames every message as a
+type byte and a 4-byte big-endian payload length:
+
+    CONTROL  JSON message
+    DATA     file payload belonging to the last FILE_METADATA / MULTICAST_REPAIR
+
+Version 3 adds multiplexing: several files may be in flight at once, each on
+its own stream id (carried as "stream" in the messages about that file), and
+their payload travels in STREAM_DATA frames whose header also holds the id:
+
+    STREAM_DATA  type byte, 4-byte stream id, 4-byte length, payload
+
+Peers negotiate the version in the handshake: the client advertises "framing"
+in CLIENT_INFO and a server that supports it answers with a SERVER_INFO line
+carrying the agreed version, after which both sides send frames. The decoder
+accepts JSON lines at any frame boundary, so it reads every format.
+"""
+
+import contextlib
+import json
+import struct
+
+LEGACY_FRAMING = 1
+FRAMING_VERSION = 2  # First framed version; ">= FRAMING_VERSION" means the peer reads frames
+MULTIPLEX_FRAMING = 3
+LATEST_FRAMING = MULTIPLEX_FRAMING
+
+FRAME_CONTROL = 0x01
+FRAME_DATA = 0x02
+FRAME_STREAM_DATA = 0x03
+FRAME_HEADER = struct.Struct('!BI')
+STREAM_FRAME_HEADER = struct.Struct('!BII')
+# Control messages are small; anything larger means the stream lost sync
+MAX_CONTROL_FRAME = 16 * 1024 * 1024
+# Default receive buffer; sized so one recv_into() can take a large slice of a DATA frame
+RECV_BUFFER_SIZE = 1024 * 1024
+
+
+class FramingError(ValueError):
+    """The byte stream is not a valid frame sequence."""
+
+
+def negotiate(advertised):
+    """Return the framing version to use with a peer that advertised `advertised`."""
+    try:
+        return max(LEGACY_FRAMING, min(int(advertised or LEGACY_FRAMING), LATEST_FRAMING))
+    except (TypeError, ValueError):
+        return LEGACY_FRAMING
+
+
+def encode_message(message, version=LEGACY_FRAMING):
+    """Serialise a control message for a peer using the given framing version."""
+    payload = json.dumps(message).encode('utf-8')
+    if version >= FRAMING_VERSION:
+        return FRAME_HEADER.pack(FRAME_CONTROL, len(payload)) + payload
+    return payload + b'\n'
+
+
+def _data_header(length, stream):
+    if stream:
+        return STREAM_FRAME_HEADER.pack(FRAME_STREAM_DATA, stream, length)
+    return FRAME_HEADER.pack(FRAME_DATA, length)
+
+
+def send_data(sock, data, version=LEGACY_FRAMING, stream=0):
+    """
+    Send a block of file payload, as a DATA frame when framing is negotiated
+    (a STREAM_DATA frame for a non-zero stream id, which needs MULTIPLEX_FRAMING).
+    """
+    if version >= FRAMING_VERSION:
+        sock.sendall(_data_header(len(data), stream))
+    sock.sendall(data)
+
+
+def sendfile_data(sock, f, offset, count, version=LEGACY_FRAMING, stream=0):
+    """
+    Send count bytes of f starting at offset with socket.sendfile(), as one
+    DATA (or STREAM_DATA) frame when framing is negotiated. Returns the number
+    of bytes sent.
+    """
+    if version < FRAMING_VERSION:
+        return sock.sendfile(f, offset=offset, count=count)
+    sock.sendall(_data_header(count, stream))
+    sent = sock.sendfile(f, offset=offset, count=count)
+    if sent != count:
+        # The frame header already promised count bytes; the stream cannot continue
+        raise FramingError(f"file changed during send: {sent} of {count} bytes")
+    return sent
+
+
+class StreamWriter:
+    """
+    Sends one file's messages and payload on a shared command channel.
+
+    Multiplexed streams (stream id != 0) take the channel's lock for every
+    frame, so other streams interleave between frames. Stream 0 is the
+    pre-multiplexing behaviour: the caller holds the lock for the whole body
+    and the writer does not take it again.
+    """
+
+    def __init__(self, sock, version, lock, stream=0):
+        self.sock = sock
+        self.version = version
+        self.stream = stream
+        self._lock = lock if stream else None
+
+    def _locked(self):
+        return self._lock if self._lock else contextlib.nullcontext()
+
+    def send_message(self, message):
+        if self.stream:
+            message = dict(message, stream=self.stream)
+        data = encode_message(message, self.version)
+        with self._locked():
+            self.sock.sendall(data)
+
+    def send_data(self, data):
+        with self._locked():
+            send_data(self.sock, data, self.version, self.stream)
+
+    def sendfile_data(self, f, offset, count):
+        with self._locked():
+            return sendfile_data(self.sock, f, offset, count, self.version, self.stream)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for one direction of a command channel.
+
+    Bytes are received with recv_into() straight into one preallocated buffer,
+    and events() yields (FRAME_CONTROL, 0, message_dict) and (FRAME_DATA,
+    stream_id, memoryview) events from it; stream_id is 0 except for the
+    payload of STREAM_DATA frames. DATA payloads are delivered as soon as they
+    arrive, possibly split across several events, as views into that buffer:
+    write them out before the next recv_into(), which invalidates them. With
+    legacy framing, call expect_raw() when a message announces raw bytes so
+    they are delivered as DATA events too.
+    """
+
+    def __init__(self, peer="", buffer_size=RECV_BUFFER_SIZE):
+        self.peer = peer
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # First byte not yet decoded
+        self._end = 0  # End of received bytes
+        self._scan = 0  # Bytes before this index are known to hold no newline
+        self._need = 0  # Size of an incomplete control frame waiting for more bytes
+        self._data_remaining = 0
+        self._data_stream = 0  # Stream id of the DATA payload being delivered
+        self._views = []
+
+    def expect_raw(self, length):
+        """Treat the next length bytes of the stream as unframed payload."""
+        self._data_remaining += max(0, length)
+        self._data_stream = 0
+
+    def recv_into(self, sock):
+        """Receive from sock into the buffer; returns the byte count (0 means EOF)."""
+        for view in self._views:
+            view.release()
+        self._views.clear()
+        self._make_room()
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def _make_room(self):
+        pending = self._end - self._start
+        if not pending:
+            self._start = self._end = self._scan = 0
+        min_free = max(len(self._buf) // 4, self._need - pending)
+        if len(self._buf) - self._end >= min_free:
+            return
+        if self._start:
+            # Move the undecoded tail to the front (memmove, no allocation)
+            self._view[:pending] = self._view[self._start:self._end]
+            self._scan = max(0, self._scan - self._start)
+            self._start, self._end = 0, pending
+        if len(self._buf) - self._end < min_free:
+            # Only a control frame or legacy line bigger than the buffer gets here
+            grown = bytearray(max(2 * len(self._buf), pending + min_free))
+            grown[:pending] = self._view[:pending]
+            self._view.release()
+            self._buf = grown
+            self._view = memoryview(grown)
+
+    def events(self):
+        buf = self._buf
+        while True:
+            avail = self._end - self._start
+            if self._data_remaining:
+                if not avail:
+                    return
+                take = min(avail, self._data_remaining)
+                view = self._view[self._start:self._start + take]
+                self._views.append(view)
+                self._start += take
+                self._data_remaining -= take
+                yield FRAME_DATA, self._data_stream, view
+                continue
+            if not avail:
+                return
+            first = buf[self._start]
+            if first == FRAME_STREAM_DATA:
+                if avail < STREAM_FRAME_HEADER.size:
+                    return
+                _, self._data_stream, self._data_remaining = STREAM_FRAME_HEADER.unpack_from(buf, self._start)
+                self._start += STREAM_FRAME_HEADER.size
+                continue
+            if first in (FRAME_CONTROL, FRAME_DATA):
+                if avail < FRAME_HEADER.size:
+                    return
+                kind, length = FRAME_HEADER.unpack_from(buf, self._start)
+                if kind == FRAME_DATA:
+                    self._start += FRAME_HEADER.size
+                    self._data_remaining = length
+                    self._data_stream = 0
+                    continue
+                if length > MAX_CONTROL_FRAME:
+                    raise FramingError(f"control frame of {length} bytes from {self.peer}")
+                if avail < FRAME_HEADER.size + length:
+                    self._need = FRAME_HEADER.size + length
+                    return
+                self._need = 0
+                start = self._start + FRAME_HEADER.size
+                self._start = start + length
+                message = self._parse(bytes(buf[start:self._start]))
+                if message is not None:
+                    yield FRAME_CONTROL, 0, message
+            else:
+                # Legacy JSON line
+                idx = buf.find(b'\n', max(self._start, self._scan), self._end)
+                if idx < 0:
+                    self._scan = self._end
+                    return
+                line = bytes(buf[self._start:idx])
+                self._start = idx + 1
+                if not line.strip():
+                    continue
+                message = self._parse(line)
+                if message is not None:
+                    yield FRAME_CONTROL, 0, message
+
+    def _parse(self, payload):
+        try:
+            message = json.loads(payload.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print(f"Non-JSON data from {self.peer}: {payload.decode('utf-8', errors='ignore')[:100]}...")
+            return None
+        if not isinstance(message, dict):
+            print(f"Unexpected message from {self.peer}: {str(message)[:100]}")
+            return None
+        return message
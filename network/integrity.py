@@ -0,0 +1,46 @@
+"""
+End-to-end integrity of files sent on the command channel, checked as the
+bytes flow rather than in a second pass over the file.
+
+The server promises a digest trailer in FILE_METADATA ("digest": {"chunk_size"})
+to clients that advertise "integrity". The client hashes every chunk_size chunk
+as it writes the body (utils.hashing.TreeHasher); after the last byte the server
+sends
+
+    FILE_DIGEST    {"file_name", "sha256", "chunk_size", "chunks": [...]}
+
+"sha256" being the tree-hash root over the chunks, with digests taken from
+the hash cache or while it read the file. If every chunk matches the file is
+complete. Otherwise the client asks for just the chunks that differ
+
+    RANGE_REQUEST  {"repair_id", "file_name", "ranges": [[offset, length], ...]}
+
+and the server resends each range as FILE_REPAIR {"repair_id", "file_name",
+"offset", "length"} followed by its bytes, which the client checks against the
+same digests. Files still corrupt after INTEGRITY_MAX_REPAIRS rounds fail.
+"""
+
+
+def mismatched_chunks(expected, actual):
+    """Indexes of the chunks whose digests differ, including chunks only one side has."""
+    count = max(len(expected), len(actual))
+    return [i for i in range(count)
+            if i >= len(expected) or i >= len(actual) or expected[i] != actual[i]]
+
+
+def chunk_ranges(indexes, chunk_size, file_size):
+    """
+    [offset, length] byte ranges covering the chunks at indexes, adjacent chunks
+    merged. None if a chunk lies wholly beyond file_size (the file changed size).
+    """
+    ranges = []
+    for index in sorted(indexes):
+        offset = index * chunk_size
+        if offset >= file_size and (offset or file_size):
+            return None
+        length = min(chunk_size, file_size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+    return ranges
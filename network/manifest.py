@@ -0,0 +1,119 @@
+"""
+Directory trees distributed by manifest.
+
+The server describes a shared tree as a manifest of its files, one entry per
+file: {"path", "size", "mtime", "sha256"}, path being relative to the tree root
+with "/" separators. The manifest goes to the client in one or more parts:
+
+    TREE_MANIFEST  {"tree_id", "tree_name", "part", "parts", "entries": [...]}
+
+Once it holds every part, the client compares the entries with its copy of the
+tree under received_files/trees/<tree_name> and answers with the indexes of
+the entries it is missing or holds a different version of:
+
+    TREE_NEED      {"tree_id", "indexes": [...]}
+
+Only those files are sent, as usual FILE_METADATA transfers or batches whose
+messages carry "tree" so the client files them at their path in the tree.
+When the last of them is in place the client reports
+
+    TREE_SYNCED    {"tree_id", "tree_name", "received", "failed"}
+
+Syncing the same tree again sends only what changed since the last sync.
+"""
+
+import os
+
+TREES_DIR = "trees"  # Client directory, under received_files, holding synced trees
+
+
+def walk_tree(root):
+    """Yield (relative path, absolute path) of every regular file under root, in sorted order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            file_path = os.path.join(dirpath, name)
+            if not os.path.isfile(file_path):
+                continue
+            rel_path = os.path.relpath(file_path, root).replace(os.sep, "/")
+            yield rel_path, file_path
+
+
+def tree_size(root):
+    """Total size in bytes of the files under root."""
+    total = 0
+    for _, file_path in walk_tree(root):
+        try:
+            total += os.path.getsize(file_path)
+        except OSError:
+            continue
+    return total
+
+
+def build_manifest(root, file_hash):
+    """
+    Manifest entries for the files under root. file_hash(path) returns the
+    file's SHA-256 (or None if unreadable, which leaves the file out).
+    """
+    entries = []
+    for rel_path, file_path in walk_tree(root):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        sha256 = file_hash(file_path)
+        if sha256 is None:
+            continue
+        entries.append({"path": rel_path, "size": st.st_size, "mtime": st.st_mtime, "sha256": sha256})
+    return entries
+
+
+def split_manifest(entries, part_entries):
+    """The manifest as a list of entry lists of at most part_entries each (one empty part for an empty tree)."""
+    parts = [entries[i:i + part_entries] for i in range(0, len(entries), part_entries)]
+    return parts or [[]]
+
+
+def source_path(root, rel_path):
+    """Server-side path of a manifest entry."""
+    return os.path.join(root, *rel_path.split("/"))
+
+
+def safe_tree_name(tree_name):
+    """Directory name for a tree on the client; never a path outside the trees directory."""
+    name = os.path.basename(str(tree_name or "").replace("\\", "/").rstrip("/"))
+    return name if name not in ("", ".", "..") else "tree"
+
+
+def local_path(tree_dir, rel_path):
+    """
+    Where the entry rel_path lives under tree_dir, or None for a path that is
+    absolute or climbs out of the tree.
+    """
+    if not isinstance(rel_path, str) or not rel_path:
+        return None
+    parts = rel_path.replace("\\", "/").split("/")
+    if any(part in ("", ".", "..") or os.path.splitdrive(part)[0] for part in parts):
+        return None
+    return os.path.join(tree_dir, *parts)
+
+
+def missing_entries(entries, tree_dir, file_digest):
+    """
+    Indexes of the entries whose file under tree_dir is absent or differs.
+    file_digest(path) returns the local file's SHA-256 (None if unreadable);
+    it is only called for files whose size matches.
+    """
+    needed = []
+    for index, entry in enumerate(entries):
+        path = local_path(tree_dir, entry.get("path"))
+        if path is None:
+            continue
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            needed.append(index)
+            continue
+        if size != entry.get("size") or file_digest(path) != entry.get("sha256"):
+            needed.append(index)
+    return needed
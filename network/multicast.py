@@ -0,0 +1,270 @@
+"""
+IP multicast bulk distribution.
+
+The server pushes every byte of a file once to MULTICAST_GROUP. Each client
+writes the datagrams it receives at their offset and, when the server signals
+the end of the pass, reports the byte ranges it is missing over the TCP command
+channel (NACK). The server repairs those ranges by unicast on the same channel.
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+from . import protocol
+from .fileio import open_for_positional_write, pwrite
+from .ranges import RangeSet, coalesce
+
+# Datagram header: magic, transfer id, byte offset, payload length
+PACKET_HEADER = struct.Struct('!4sIQI')
+PACKET_MAGIC = b'LAMC'
+# Bytes read from disk per syscall on the sending side
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class MulticastSender:
+    """
+    Sends file data to the multicast group, paced to rate_limit bytes per
+    second; set_rate() changes the pace of a send in progress.
+    """
+    def __init__(self, interface_ip=None, rate_limit=protocol.MULTICAST_RATE_LIMIT):
+        self.rate_limit = rate_limit
+        self._pace_reset = False  # Set by set_rate(); pacing restarts from the current offset
+        self.address = (protocol.MULTICAST_GROUP, protocol.MULTICAST_PORT)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, protocol.MULTICAST_TTL)
+        # Loopback so a client running on the server machine receives the data as well
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface_ip and interface_ip != '0.0.0.0':
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+            except OSError as e:
+                print(f"Could not select multicast interface {interface_ip}: {e}")
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * READ_BLOCK_SIZE)
+        except OSError:
+            pass
+
+    def send_file(self, transfer_id, file_path, file_size, progress_callback=None, cancel_event=None):
+        """
+        Send the whole file once. Returns False if cancelled.
+        progress_callback(sent_bytes) is called at most every 0.5 seconds.
+        """
+        payload_size = protocol.MULTICAST_PAYLOAD_SIZE
+        block = bytearray(READ_BLOCK_SIZE - READ_BLOCK_SIZE % payload_size)
+        view = memoryview(block)
+        use_sendmsg = hasattr(self.sock, 'sendmsg')
+        start_time = time.time()
+        paced_from = 0  # Offset pacing is measured from; moves when the rate changes
+        last_progress_update = 0
+        offset = 0
+        with open(file_path, 'rb') as f:
+            while offset < file_size:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                n = f.readinto(block)
+                if not n:
+                    break
+                for pos in range(0, n, payload_size):
+                    length = min(payload_size, n - pos)
+                    header = PACKET_HEADER.pack(PACKET_MAGIC, transfer_id, offset + pos, length)
+                    payload = view[pos:pos + length]
+                    self._send_datagram(header, payload, use_sendmsg)
+                offset += n
+
+                # Pace to the configured rate; UDP would otherwise overrun switches and receivers
+                if self._pace_reset:
+                    self._pace_reset = False
+                    start_time, paced_from = time.time(), offset
+                ahead = (offset - paced_from) / self.rate_limit - (time.time() - start_time)
+                if ahead > 0:
+                    time.sleep(ahead)
+                if progress_callback and time.time() - last_progress_update >= 0.5:
+                    progress_callback(offset)
+                    last_progress_update = time.time()
+        if progress_callback:
+            progress_callback(offset)
+        return True
+
+    def set_rate(self, rate_limit):
+        """Pace from now on at rate_limit bytes per second."""
+        self.rate_limit = rate_limit
+        self._pace_reset = True
+
+    def _send_datagram(self, header, payload, use_sendmsg):
+        for attempt in range(3):
+            try:
+                if use_sendmsg:
+                    self.sock.sendmsg([header, payload], [], 0, self.address)
+                else:
+                    self.sock.sendto(header + bytes(payload), self.address)
+                return
+            except (BlockingIOError, InterruptedError):
+                time.sleep(0.001)
+            except OSError:
+                # ENOBUFS: kernel queue full, back off briefly; lost packets are repaired later
+                time.sleep(0.001)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class MulticastReceiver:
+    """
+    Joins the multicast group and writes datagrams of one transfer into a file
+    by offset, tracking which byte ranges have arrived.
+    """
+    def __init__(self, transfer_id, file_path, file_size, interface_ip='0.0.0.0', progress_callback=None):
+        self.transfer_id = transfer_id
+        self.file_path = file_path
+        self.file_size = file_size
+        self.interface_ip = interface_ip or '0.0.0.0'
+        self.progress_callback = progress_callback
+        self.received = RangeSet()
+        self.last_packet_time = time.time()
+        self._lock = threading.Lock()
+        self.running = True
+        self.fd = open_for_positional_write(file_path, file_size)
+        try:
+            self.sock = self._open_socket()
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self.thread.start()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except OSError:
+                pass
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, protocol.LAN_BUFFER_SMALL)
+        except OSError:
+            pass
+        sock.bind(('', protocol.MULTICAST_PORT))
+        mreq = struct.pack('4s4s', socket.inet_aton(protocol.MULTICAST_GROUP), socket.inet_aton(self.interface_ip))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self._mreq = mreq
+        sock.settimeout(1.0)
+        return sock
+
+    def _receive_loop(self):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        header_size = PACKET_HEADER.size
+        last_progress_update = 0
+        while self.running:
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if n < header_size:
+                continue
+            magic, transfer_id, offset, length = PACKET_HEADER.unpack_from(buf, 0)
+            if magic != PACKET_MAGIC or transfer_id != self.transfer_id:
+                continue
+            if length != n - header_size or offset + length > self.file_size:
+                continue
+            self.write_at(offset, view[header_size:n])
+            self.last_packet_time = time.time()
+            if self.progress_callback and self.last_packet_time - last_progress_update >= 0.5:
+                self.progress_callback(self.received_bytes())
+                last_progress_update = self.last_packet_time
+
+    def write_at(self, offset, data):
+        """Store data at offset; used for datagrams and for TCP repairs alike."""
+        with self._lock:
+            if self.received.contains(offset, offset + len(data)):
+                return
+            pwrite(self.fd, data, offset)
+            self.received.add(offset, offset + len(data))
+
+    def received_bytes(self):
+        with self._lock:
+            return self.received.covered()
+
+    def wait_idle(self, quiet=0.2, timeout=2.0):
+        """Give datagrams still queued in the socket buffer a moment to land."""
+        deadline = time.time() + timeout
+        while time.time() < deadline and time.time() - self.last_packet_time < quiet:
+            time.sleep(quiet / 4)
+
+    def missing_ranges(self, max_ranges=protocol.MULTICAST_MAX_NACK_RANGES):
+        with self._lock:
+            return coalesce(self.received.missing(self.file_size), max_ranges)
+
+    def is_complete(self):
+        with self._lock:
+            return not self.received.missing(self.file_size)
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, self._mreq)
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class MulticastSession:
+    """
+    Server-side state of one multicast file: which clients joined, which are
+    complete and which ranges each client reported missing.
+    """
+    def __init__(self, transfer_id, file_info, client_ips):
+        self.transfer_id = transfer_id
+        self.file_info = file_info
+        self.client_ips = set(client_ips)
+        self.ready = set()
+        self.rejected = set()
+        self.complete = set()
+        self.nacks = {}  # {client_ip: [[start, end], ...]}
+        self.cond = threading.Condition()
+
+    def mark_ready(self, client_ip, ok=True):
+        with self.cond:
+            (self.ready if ok else self.rejected).add(client_ip)
+            self.cond.notify_all()
+
+    def mark_complete(self, client_ip):
+        with self.cond:
+            self.complete.add(client_ip)
+            self.nacks.pop(client_ip, None)
+            self.cond.notify_all()
+
+    def add_nack(self, client_ip, ranges):
+        with self.cond:
+            self.nacks[client_ip] = ranges
+            self.cond.notify_all()
+
+    def wait_for_joins(self, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.ready | self.rejected >= self.client_ips, timeout=timeout)
+            return set(self.ready)
+
+    def wait_for_reports(self, client_ips, timeout):
+        """Wait until each client either completed or sent a NACK."""
+        with self.cond:
+            self.cond.wait_for(lambda: all(ip in self.complete or ip in self.nacks for ip in client_ips),
+                               timeout=timeout)
+            nacks = {ip: self.nacks.pop(ip) for ip in list(self.nacks) if ip in client_ips}
+            return nacks
@@ -0,0 +1,392 @@
+"""
+Multi-stream transfer of a single large file.
+
+A single TCP stream can leave a high-latency or lossy path underused. Clients
+run a ParallelReceiver on FILE_TRANSFER_PORT and advertise it in CLIENT_INFO;
+for a large file the server announces the transfer in FILE_METADATA
+("parallel": {transfer_id, streams, segment_size}) and a ParallelSender opens
+that many data connections. Each connection pulls the next unsent segment from
+a shared queue, so a slow stream simply carries fewer segments. The receiver
+writes every segment at its offset with pwrite() and completes the file once its
+segment bitmap is full.
+
+Data connection wire format (TCP, server -> client):
+    {"type": "SEGMENT", "transfer_id": id, "index": i, "offset": o, "length": n}\n + n raw bytes
+
+The server half-closes a connection after its last segment and waits for the
+client to close it, which confirms every segment on that stream was read.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from . import protocol
+from .fileio import open_for_positional_write, pwrite
+
+# Seconds a data connection may sit idle before the receiver drops it
+STREAM_IDLE_TIMEOUT = 60
+# Seconds a data connection waits for the FILE_METADATA that registers its transfer
+REGISTER_TIMEOUT = 10
+# Receive buffer per data connection
+STREAM_BUFFER_SIZE = 1024 * 1024
+# Parallel transfers a tuner measurement stays valid for
+TUNER_MEMORY = 8
+
+
+class ParallelFile:
+    """
+    One file being received over several data connections.
+    """
+    def __init__(self, server_ip, file_path, file_size, segment_size, checkpoint=None,
+                 progress_callback=None, completion_callback=None):
+        self.server_ip = server_ip
+        self.file_path = file_path
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self.checkpoint = checkpoint
+        self.progress_callback = progress_callback
+        self.completion_callback = completion_callback
+        self.total_segments = max(1, (file_size + segment_size - 1) // segment_size)
+        self.done = bytearray(self.total_segments)  # Completion bitmap, one flag per segment
+        self.done_count = 0
+        self.received_bytes = 0
+        self.completed = False
+        self.lock = threading.Lock()
+        self.fd = open_for_positional_write(file_path, file_size)
+
+    def write(self, offset, data):
+        pwrite(self.fd, data, offset)
+
+    def segment_done(self, index, offset, length):
+        with self.lock:
+            if self.completed or self.done[index]:
+                return
+            self.done[index] = 1
+            self.done_count += 1
+            self.received_bytes += length
+            if self.checkpoint:
+                self.checkpoint.record(offset, offset + length)
+            received_bytes = self.received_bytes
+            finished = self.done_count == self.total_segments
+            if finished:
+                self.completed = True
+                self._close_fd()
+                if self.checkpoint:
+                    self.checkpoint.delete()
+        if self.progress_callback:
+            self.progress_callback(received_bytes)
+        if finished and self.completion_callback:
+            self.completion_callback()
+
+    def close(self, keep_checkpoint=False):
+        with self.lock:
+            if self.checkpoint and not self.completed:
+                if keep_checkpoint:
+                    self.checkpoint.save()
+                else:
+                    self.checkpoint.delete()
+            self._close_fd()
+
+    def _close_fd(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+class ParallelReceiver:
+    """
+    Accepts data connections and writes their segments into registered files.
+    """
+    def __init__(self, port=protocol.FILE_TRANSFER_PORT):
+        self.transfers = {}  # {transfer_id: ParallelFile}
+        self.cond = threading.Condition()
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind(('0.0.0.0', port))
+        except OSError:
+            # Another client on this machine owns the well-known port
+            self.sock.bind(('0.0.0.0', 0))
+        self.port = self.sock.getsockname()[1]
+        self.sock.listen(64)
+        self.sock.settimeout(1.0)
+        self.thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+
+    def register(self, transfer_id, server_ip, file_path, file_size, segment_size, checkpoint=None,
+                 progress_callback=None, completion_callback=None):
+        transfer = ParallelFile(server_ip, file_path, file_size, segment_size, checkpoint,
+                                progress_callback, completion_callback)
+        with self.cond:
+            self.transfers[transfer_id] = transfer
+            self.cond.notify_all()
+        return transfer
+
+    def cancel(self, transfer_id):
+        """Abandon a transfer and delete its partial file; returns False if it is unknown."""
+        with self.cond:
+            transfer = self.transfers.pop(transfer_id, None)
+        if not transfer:
+            return False
+        transfer.close()
+        if not transfer.completed:
+            try:
+                os.remove(transfer.file_path)
+            except OSError:
+                pass
+        return True
+
+    def suspend(self, server_ip):
+        """Connection to server_ip lost: close its transfers, keeping checkpoints for a resume."""
+        with self.cond:
+            lost = [tid for tid, t in self.transfers.items() if t.server_ip == server_ip]
+            transfers = [self.transfers.pop(tid) for tid in lost]
+        for transfer in transfers:
+            transfer.close(keep_checkpoint=True)
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        with self.cond:
+            transfers, self.transfers = list(self.transfers.values()), {}
+            self.cond.notify_all()
+        for transfer in transfers:
+            transfer.close(keep_checkpoint=True)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self._serve_stream, args=(conn, addr), daemon=True).start()
+
+    def _lookup(self, transfer_id, server_ip):
+        """The registered transfer, waiting briefly since data may race ahead of FILE_METADATA."""
+        deadline = time.time() + REGISTER_TIMEOUT
+        with self.cond:
+            while self.running:
+                transfer = self.transfers.get(transfer_id)
+                if transfer:
+                    # Only the server that announced the transfer may write into it
+                    return transfer if transfer.server_ip == server_ip else None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+        return None
+
+    def _serve_stream(self, conn, addr):
+        buf = bytearray(STREAM_BUFFER_SIZE)
+        view = memoryview(buf)
+        try:
+            conn.settimeout(STREAM_IDLE_TIMEOUT)
+            reader = conn.makefile('rb')
+            while self.running:
+                line = reader.readline(64 * 1024)
+                if not line:
+                    break  # Sender finished; closing confirms we read everything
+                header = json.loads(line.decode('utf-8'))
+                if header.get("type") != "SEGMENT":
+                    break
+                transfer = self._lookup(header.get("transfer_id"), addr[0])
+                if not transfer:
+                    print(f"[Parallel] Dropping stream from {addr[0]}: unknown transfer")
+                    break
+                index = int(header["index"])
+                offset = int(header["offset"])
+                length = int(header["length"])
+                if not 0 <= index < transfer.total_segments or offset + length > transfer.file_size:
+                    break
+                position, remaining = offset, length
+                while remaining:
+                    n = reader.readinto(view[:min(remaining, len(buf))])
+                    if not n:
+                        raise ConnectionError("stream closed inside a segment")
+                    transfer.write(position, view[:n])
+                    position += n
+                    remaining -= n
+                transfer.segment_done(index, offset, length)
+                if transfer.completed:
+                    with self.cond:
+                        if self.transfers.get(header["transfer_id"]) is transfer:
+                            del self.transfers[header["transfer_id"]]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[Parallel] Stream from {addr[0]} ended: {e}")
+        finally:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+
+class ParallelSender:
+    """
+    Sends one file to a client's ParallelReceiver over several data connections.
+    """
+    def __init__(self, client_ip, port, transfer_id, file_path, file_size,
+                 segment_size=protocol.PARALLEL_SEGMENT_SIZE, streams=protocol.PARALLEL_STREAMS):
+        self.client_ip = client_ip
+        self.port = port
+        self.transfer_id = transfer_id
+        self.file_path = file_path
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self.streams = streams
+        self.total_segments = max(1, (file_size + segment_size - 1) // segment_size)
+        self.pending = deque(range(self.total_segments))
+        self.sockets = []
+        self.lock = threading.Lock()
+        self.sent_bytes = 0
+        self.cancelled = False
+
+    def connect(self, count=None):
+        """Open up to count data connections; raises OSError if none can be opened."""
+        error = None
+        for _ in range(count or self.streams):
+            try:
+                sock = socket.create_connection((self.client_ip, self.port), timeout=protocol.PARALLEL_CONNECT_TIMEOUT)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(STREAM_IDLE_TIMEOUT)
+                self.sockets.append(sock)
+            except OSError as e:
+                error = e
+                break
+        if not self.sockets:
+            raise error or OSError("no data connection")
+        if count is None:
+            self.streams = len(self.sockets)
+        return len(self.sockets)
+
+    def run(self, is_cancelled=lambda: False, progress_callback=None, throttle=None, slice_size=None):
+        """
+        Send every segment; returns (sent_bytes, cancelled). Raises OSError if streams
+        keep failing. throttle(nbytes), if given, is called before each slice_size piece
+        is sent and returns False to cancel.
+        """
+        rounds = 0
+        while True:
+            workers = [threading.Thread(target=self._stream, args=(sock, is_cancelled, progress_callback,
+                                                                   throttle, slice_size), daemon=True)
+                       for sock in self.sockets]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.sockets = []
+            if self.cancelled or is_cancelled():
+                return self.sent_bytes, True
+            if not self.pending:
+                return self.sent_bytes, False
+            rounds += 1
+            if rounds >= protocol.PARALLEL_MAX_ROUNDS:
+                raise OSError(f"{len(self.pending)} segments undelivered after {rounds} rounds")
+            print(f"[Parallel] Resending {len(self.pending)} segments to {self.client_ip}")
+            self.connect(min(self.streams, len(self.pending)))
+
+    def _next_segment(self, is_cancelled):
+        with self.lock:
+            if self.cancelled or not self.pending:
+                return None
+            if is_cancelled():
+                self.cancelled = True
+                return None
+            return self.pending.popleft()
+
+    def _stream(self, sock, is_cancelled, progress_callback, throttle, slice_size):
+        unconfirmed = []
+        try:
+            with open(self.file_path, 'rb') as f:
+                while True:
+                    index = self._next_segment(is_cancelled)
+                    if index is None:
+                        break
+                    unconfirmed.append(index)
+                    offset = index * self.segment_size
+                    length = min(self.segment_size, self.file_size - offset)
+                    header = {"type": "SEGMENT", "transfer_id": self.transfer_id,
+                              "index": index, "offset": offset, "length": length}
+                    sock.sendall(json.dumps(header).encode('utf-8') + b'\n')
+                    end = offset + length
+                    while offset < end:
+                        count = min(slice_size() if slice_size else length, end - offset)
+                        if throttle and not throttle(count):
+                            self.cancelled = True
+                            return
+                        if sock.sendfile(f, offset=offset, count=count) != count:
+                            raise OSError("file changed during send")
+                        offset += count
+                    with self.lock:
+                        self.sent_bytes += length
+                        if progress_callback:
+                            progress_callback(self.sent_bytes)
+            if self.cancelled:
+                return
+            # Half-close and wait for the receiver to close: everything on this stream was read
+            sock.shutdown(socket.SHUT_WR)
+            while sock.recv(4096):
+                pass
+            unconfirmed = []
+        except OSError as e:
+            if not self.cancelled:
+                print(f"[Parallel] Stream to {self.client_ip} failed: {e}")
+        finally:
+            if unconfirmed:
+                with self.lock:
+                    for index in unconfirmed:
+                        self.sent_bytes -= min(self.segment_size, self.file_size - index * self.segment_size)
+                    self.pending.extendleft(reversed(unconfirmed))
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def close(self):
+        self.cancelled = True
+        for sock in self.sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self.sockets = []
+
+
+class StreamTuner:
+    """
+    Per-client choice of stream count. Every parallel transfer records its
+    throughput; the tuner moves to the best measured count and probes its
+    unmeasured neighbours (double first, then half) while the current count is
+    the best, so it climbs as long as more streams keep paying off. Measurements
+    expire after TUNER_MEMORY transfers so a changed network is re-explored.
+    """
+    def __init__(self, streams=protocol.PARALLEL_STREAMS, max_streams=protocol.PARALLEL_MAX_STREAMS):
+        self.streams = streams
+        self.max_streams = max_streams
+        self.rates = {}  # {streams: (bytes per second, transfer number)}
+        self.transfers = 0
+
+    def record(self, streams, nbytes, elapsed):
+        if nbytes <= 0 or elapsed <= 0:
+            return
+        self.transfers += 1
+        rate = nbytes / elapsed
+        previous = self.rates.get(streams)
+        if previous:
+            rate = (previous[0] + rate) / 2
+        self.rates[streams] = (rate, self.transfers)
+        self.rates = {n: r for n, r in self.rates.items() if self.transfers - r[1] < TUNER_MEMORY}
+        best = max(self.rates, key=lambda n: self.rates[n][0])
+        probes = [n for n in (best * 2, best // 2) if 2 <= n <= self.max_streams and n not in self.rates]
+        self.streams = probes[0] if best == streams and probes else best
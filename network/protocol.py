@@ -44,6 +44,7 @@ MSG_TYPE_STATUS_UPDATE = 'status_update'
 # LAN optimization constants for massive scale
 MAX_CONCURRENT_CLIENTS = 0   # 0 means unlimited clients
 MAX_CONCURRENT_TRANSFERS = 0  # 0 means unlimited concurrent transfers
+MULTIPLEX_STREAMS = 8  # Files in flight at once per client when the client reads multiplexed framing
 QUEUE_SIZE_PER_CLIENT = 1000 # Support large number of queued files
 
 # Network buffer sizes for massive files (optimized for 25GB+)
@@ -52,16 +53,65 @@ LAN_BUFFER_MEDIUM = 64 * 1024 * 1024     # 64MB for files 1GB-10GB
 LAN_BUFFER_LARGE = 128 * 1024 * 1024     # 128MB for files > 10GB
 LAN_BUFFER_MASSIVE = 256 * 1024 * 1024   # 256MB for files > 25GB
 
-# Chunk sizes optimized for massive file transfer
-CHUNK_SIZE_SMALL = 32 * 1024 * 1024      # 32MB chunks < 1GB files
-CHUNK_SIZE_MEDIUM = 64 * 1024 * 1024     # 64MB chunks 1GB-10GB files
-CHUNK_SIZE_LARGE = 128 * 1024 * 1024     # 128MB chunks 10GB-25GB files
-CHUNK_SIZE_MASSIVE = 256 * 1024 * 1024   # 256MB chunks > 25GB files
+# Chunk sizes are not fixed per file size: network/chunking.py learns them per client
 
 # Multicast configuration for efficient distribution
 MULTICAST_GROUP = '239.255.0.1'
 MULTICAST_PORT = 5005
 MULTICAST_TTL = 32  # Hop limit for multicast packets
+MULTICAST_PAYLOAD_SIZE = 1400  # Datagram payload bytes, stays below a 1500-byte Ethernet MTU
+MULTICAST_RATE_LIMIT = 100 * 1024 * 1024  # 100MB/s pacing - UDP has no congestion control
+MULTICAST_MIN_CLIENTS = 2  # Below this, unicast is just as cheap
+MULTICAST_JOIN_TIMEOUT = 5  # Seconds to wait for clients to join the group
+MULTICAST_REPAIR_ROUNDS = 5  # NACK/repair rounds before falling back to unicast
+MULTICAST_MAX_NACK_RANGES = 256  # Missing ranges reported per NACK
+
+# Peer-assisted (swarm) distribution
+SWARM_PORT = 5006  # Each peer's chunk server; falls back to an ephemeral port if busy
+SWARM_CHUNK_SIZE = 4 * 1024 * 1024  # Unit of exchange between peers
+SWARM_PARALLEL_DOWNLOADS = 4  # Concurrent chunk fetches per receiving peer
+SWARM_MAX_UPLOADS = 8  # Concurrent peer connections a node serves
+SWARM_HAVE_INTERVAL = 1.0  # Seconds between HAVE reports / peer list refreshes
+SWARM_JOIN_TIMEOUT = 5  # Seconds to wait for clients to join a swarm
+SWARM_STALL_TIMEOUT = 120  # Seconds without swarm progress before falling back to unicast
+
+# Multi-stream transfer of a single large file
+PARALLEL_STREAMS = 4  # Initial data connections per file; tuned per client from observed throughput
+PARALLEL_MAX_STREAMS = 16  # Upper bound a client advertises and the tuner may reach
+PARALLEL_MIN_FILE_SIZE = 64 * 1024 * 1024  # Smaller files stay on the command channel
+PARALLEL_SEGMENT_SIZE = 8 * 1024 * 1024  # Unit each stream takes from the shared queue
+PARALLEL_CONNECT_TIMEOUT = 5  # Seconds to open a data connection
+PARALLEL_MAX_ROUNDS = 3  # Reconnect rounds for segments lost with a failed stream
+
+# Streaming compression of file bodies on the command channel
+COMPRESSION_CODEC = "zlib"  # "zlib" or "lzma"; the server only uses it with clients that advertise it
+COMPRESSION_LEVEL = 1  # zlib 1-9 / lzma preset 0-9; low levels keep up with a 100Mbit link
+COMPRESSION_MIN_SIZE = 64 * 1024  # Smaller bodies are not worth the extra messages
+
+# Small-file batching: many tiny files streamed as one queue entry with a single ACK
+BATCH_MAX_FILE_SIZE = 256 * 1024  # Files up to this size may be batched
+BATCH_MIN_FILES = 16  # Fewer small files are sent one by one
+BATCH_MAX_FILES = 4096  # Files per batch; larger sets are split
+BATCH_MAX_BYTES = 64 * 1024 * 1024  # Payload per batch
+
+# Space a client keeps free on its disk; a file that would not leave this much is rejected at FILE_METADATA
+DISK_SPACE_RESERVE = 64 * 1024 * 1024
+
+# Directory trees synced by manifest: clients request only the entries they lack
+TREE_MANIFEST_PART_ENTRIES = 4096  # Manifest entries per TREE_MANIFEST message
+
+# End-to-end integrity: a digest trailer follows each body; corrupt chunks are resent by range
+INTEGRITY_MAX_REPAIRS = 3  # RANGE_REQUEST rounds before a file is given up as corrupt
+
+# Extensions received files are filed under "media" by; their content is already compressed
+MEDIA_EXTENSIONS = {
+    # images
+    ".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".svg", ".webp", ".heic",
+    # audio
+    ".mp3", ".wav", ".flac", ".aac", ".ogg", ".m4a",
+    # video
+    ".mp4", ".mkv", ".avi", ".mov", ".wmv", ".webm"
+}
 
 # Advanced network performance settings
 MAX_WINDOW_SIZE = 32       # Increased window size for better throughput
@@ -85,18 +135,6 @@ MAX_MEMORY_BUFFER = 1024 * 1024 * 1024  # 1GB max memory buffer
 BUFFER_FLUSH_THRESHOLD = 0.8  # Flush at 80% capacity
 STREAM_THRESHOLD = 10 * 1024 * 1024 * 1024  # Stream mode for files > 10GB
 
-# Chunk sizes for different file sizes
-CHUNK_SIZE_SMALL = 1024 * 1024  # 1MB for files < 100MB
-CHUNK_SIZE_MEDIUM = 4 * 1024 * 1024  # 4MB for files between 100MB and 1GB
-CHUNK_SIZE_LARGE = 8 * 1024 * 1024  # 8MB for files > 1GB
-
-# Adaptive chunk sizes based on network topology
-CROSS_MACHINE_CHUNK_SIZE = 2 * 1024 * 1024  # 2MB for cross-machine
-SAME_MACHINE_CHUNK_SIZE = 1024 * 1024  # 1MB for same-machine
-
-# Default chunk size (fallback)
-CHUNK_SIZE = 1024 * 1024
-
 # Adaptive timeouts based on network topology
 # Cross-machine timeouts (different subnets or slower connections)
 CROSS_MACHINE_CONNECTION_TIMEOUT = 300  # 5 minutes - increased for slow networks
@@ -189,7 +227,6 @@ def get_adaptive_timeouts(local_ip, remote_ip):
             'inactivity': CROSS_MACHINE_INACTIVITY_TIMEOUT,
             'ack': CROSS_MACHINE_ACK_TIMEOUT,
             'heartbeat': CROSS_MACHINE_HEARTBEAT_INTERVAL,
-            'chunk_size': CROSS_MACHINE_CHUNK_SIZE,
             'buffer_size': LAN_BUFFER_MASSIVE  # Use massive buffer for optimal LAN performance
         }
     else:
@@ -199,6 +236,5 @@ def get_adaptive_timeouts(local_ip, remote_ip):
             'inactivity': SAME_MACHINE_INACTIVITY_TIMEOUT,
             'ack': SAME_MACHINE_ACK_TIMEOUT,
             'heartbeat': SAME_MACHINE_HEARTBEAT_INTERVAL,
-            'chunk_size': SAME_MACHINE_CHUNK_SIZE,
             'buffer_size': LAN_BUFFER_LARGE  # Use large buffer for local transfers
         }
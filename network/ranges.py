@@ -0,0 +1,137 @@
+"""
+Byte-range bookkeeping for transfers that can arrive out of order.
+"""
+
+import bisect
+
+
+class RangeSet:
+    """
+    Sorted set of non-overlapping half-open byte ranges [start, end).
+
+    Adjacent and overlapping ranges are merged on insert, so a file received
+    mostly in order stays a single range and lookups stay cheap.
+    """
+
+    def __init__(self, ranges=None):
+        self._ranges = []
+        for start, end in ranges or []:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        r = self._ranges
+        i = bisect.bisect_left(r, [start, start])
+        if i > 0 and r[i - 1][1] >= start:
+            i -= 1
+        j = i
+        new_start, new_end = start, end
+        while j < len(r) and r[j][0] <= new_end:
+            new_start = min(new_start, r[j][0])
+            new_end = max(new_end, r[j][1])
+            j += 1
+        r[i:j] = [[new_start, new_end]]
+
+    def contains(self, start, end):
+        """True if [start, end) is fully covered."""
+        i = bisect.bisect_right(self._ranges, [start, float('inf')]) - 1
+        return i >= 0 and self._ranges[i][0] <= start and self._ranges[i][1] >= end
+
+    def covered(self):
+        """Total number of bytes covered."""
+        return sum(end - start for start, end in self._ranges)
+
+    def missing(self, total_size):
+        """Return the gaps within [0, total_size) as a list of [start, end) pairs."""
+        gaps = []
+        pos = 0
+        for start, end in self._ranges:
+            if start >= total_size:
+                break
+            if start > pos:
+                gaps.append([pos, start])
+            pos = max(pos, end)
+        if pos < total_size:
+            gaps.append([pos, total_size])
+        return gaps
+
+    def first_gap(self):
+        """Offset of the first byte not covered starting from zero."""
+        if self._ranges and self._ranges[0][0] == 0:
+            return self._ranges[0][1]
+        return 0
+
+    def to_list(self):
+        return [list(r) for r in self._ranges]
+
+    @classmethod
+    def from_list(cls, ranges):
+        return cls(ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __iter__(self):
+        return iter([tuple(r) for r in self._ranges])
+
+
+def coalesce(ranges, max_ranges):
+    """
+    Merge the closest neighbouring ranges until at most max_ranges remain, so a
+    request listing them stays bounded in size. Some already-held bytes may be
+    re-requested as a result.
+    """
+    ranges = [list(r) for r in ranges]
+    if len(ranges) <= max_ranges:
+        return ranges
+    by_gap = sorted(range(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1])
+    merge_after = set(by_gap[:len(ranges) - max(1, max_ranges)])
+    merged = [ranges[0]]
+    for i in range(1, len(ranges)):
+        if i - 1 in merge_after:
+            merged[-1][1] = ranges[i][1]
+        else:
+            merged.append(ranges[i])
+    return merged
+
+
+class ChunkBitmap:
+    """
+    One bit per chunk recording which chunks of a transfer are in, so tracking a
+    file of millions of chunks costs an eighth of a byte each.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.count = 0
+        self._bits = bytearray((total + 7) // 8)
+
+    def add(self, index):
+        """Mark a chunk as in; False if it already was."""
+        mask = 0x80 >> (index & 7)
+        if self._bits[index >> 3] & mask:
+            return False
+        self._bits[index >> 3] |= mask
+        self.count += 1
+        return True
+
+    def __contains__(self, index):
+        return 0 <= index < self.total and bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def complete(self):
+        return self.count == self.total
+
+    def missing(self, start=0, end=None, limit=None):
+        """Indexes in [start, end) not yet in, at most limit of them; whole bytes of set bits are skipped."""
+        end = self.total if end is None else min(end, self.total)
+        found = []
+        index = max(0, start)
+        while index < end and (limit is None or len(found) < limit):
+            if not index & 7 and self._bits[index >> 3] == 0xFF:
+                index += 8
+                continue
+            if index not in self:
+                found.append(index)
+            index += 1
+        return found
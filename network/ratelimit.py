@@ -0,0 +1,176 @@
+"""
+Token-bucket bandwidth scheduling for the file data the server sends.
+
+Every byte a transfer worker sends is taken from its client's bucket and from
+one global bucket, so the server as a whole stays under the global limit
+(BASE_RATE_LIMIT unless changed at runtime) and each client under its share.
+Every RATE_ADJUST_INTERVAL the global budget is re-divided among the clients
+that sent during the last interval: each is guaranteed MIN_CLIENT_RATE (or an
+even split, if the global limit cannot cover every minimum), none gets more
+than MAX_CLIENT_RATE, and budget a client left unused goes to the clients
+whose bucket held them back.
+"""
+
+import threading
+import time
+
+from . import protocol
+
+BURST_SECONDS = 0.05  # Idle time a bucket may bank tokens for, in seconds of its rate
+SLICE_SECONDS = 0.05  # Senders hand the socket at most this much time's worth of data at once
+MIN_SLICE_SIZE = 64 * 1024
+WAIT_STEP = 0.1  # Cancellation is checked at least this often while throttled
+SATURATED_WAIT_SHARE = 0.1  # A client throttled for this share of an interval wants more
+
+
+class TokenBucket:
+    """Byte-rate bucket that lets a send run into debt and reports how long to wait it off."""
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate  # Bytes per second; 0 or None means unlimited
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * BURST_SECONDS)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket; returns the seconds to wait before sending them."""
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthScheduler:
+    """
+    Global plus per-client token buckets, shared by all transfer workers.
+    """
+    def __init__(self, global_rate=protocol.BASE_RATE_LIMIT, min_rate=protocol.MIN_CLIENT_RATE,
+                 max_rate=protocol.MAX_CLIENT_RATE, adjust_interval=protocol.RATE_ADJUST_INTERVAL):
+        self.lock = threading.Lock()
+        self.global_rate = global_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.adjust_interval = adjust_interval
+        self.global_bucket = TokenBucket(global_rate)
+        self.clients = {}  # {client_ip: {"bucket": TokenBucket, "sent": bytes, "waited": seconds}} this interval
+        self.last_adjust = time.monotonic()
+
+    def set_global_rate(self, rate):
+        """Change the global limit (bytes/s, None for unlimited) and re-divide it right away."""
+        with self.lock:
+            self.global_rate = rate
+            self.global_bucket.set_rate(rate)
+            self._rebalance()
+
+    def remove_client(self, client_ip):
+        with self.lock:
+            self.clients.pop(client_ip, None)
+
+    def client_rate(self, client_ip):
+        with self.lock:
+            return self._client(client_ip)["bucket"].rate
+
+    def slice_size(self, client_ip, default):
+        """Largest single send for this client that keeps its traffic smooth."""
+        rate = self.client_rate(client_ip)
+        if self.global_rate:
+            rate = min(rate, self.global_rate) if rate else self.global_rate
+        if not rate:
+            return default
+        return max(MIN_SLICE_SIZE, min(default, int(rate * SLICE_SECONDS)))
+
+    def throttle(self, client_ip, nbytes, should_stop=None):
+        """
+        Block until client_ip may send nbytes more. Returns False if should_stop()
+        became true while waiting.
+        """
+        with self.lock:
+            if time.monotonic() - self.last_adjust >= self.adjust_interval:
+                self._rebalance()
+            state = self._client(client_ip)
+            state["sent"] += nbytes
+        wait = max(state["bucket"].reserve(nbytes), self.global_bucket.reserve(nbytes))
+        if wait <= 0:
+            return True
+        with self.lock:
+            state["waited"] += wait
+        deadline = time.monotonic() + wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if should_stop and should_stop():
+                return False
+            time.sleep(min(remaining, WAIT_STEP))
+
+    def _client(self, client_ip):
+        state = self.clients.get(client_ip)
+        if state is None:
+            active = sum(1 for s in self.clients.values() if s["sent"])
+            state = {"bucket": TokenBucket(self._idle_rate(active + 1)), "sent": 0, "waited": 0.0}
+            self.clients[client_ip] = state
+        return state
+
+    def _idle_rate(self, active):
+        """Rate for a client that was not sending: an even share of the global budget."""
+        if not self.global_rate:
+            return self.max_rate
+        return min(self.max_rate, max(self.min_rate, self.global_rate / max(active, 1)))
+
+    def _rebalance(self):
+        """Re-divide the global budget by what each client sent last interval. Caller holds self.lock."""
+        now = time.monotonic()
+        elapsed = max(now - self.last_adjust, 1e-3)
+        self.last_adjust = now
+        demands = {}
+        for client_ip, state in self.clients.items():
+            if not state["sent"]:
+                continue
+            if state["waited"] >= elapsed * SATURATED_WAIT_SHARE:
+                demand = self.max_rate  # Held back by its bucket; would take more
+            else:
+                demand = state["sent"] / elapsed * 1.25  # Headroom to grow into
+            demands[client_ip] = min(self.max_rate, max(self.min_rate, demand))
+        shares = self._divide(demands) if self.global_rate else demands
+        idle_rate = self._idle_rate(len(demands) + 1)
+        for client_ip, state in self.clients.items():
+            state["bucket"].set_rate(shares.get(client_ip, idle_rate))
+            state["sent"] = 0
+            state["waited"] = 0.0
+
+    def _divide(self, demands):
+        """Max-min fair split of the global rate over {client: demand}, floored at min_rate."""
+        if not demands:
+            return {}
+        total = self.global_rate
+        if self.min_rate * len(demands) >= total:
+            return {client_ip: total / len(demands) for client_ip in demands}
+        shares = {client_ip: self.min_rate for client_ip in demands}
+        remaining = total - self.min_rate * len(demands)
+        unsatisfied = {client_ip for client_ip, demand in demands.items() if demand > self.min_rate}
+        while remaining > 1 and unsatisfied:
+            each = remaining / len(unsatisfied)
+            for client_ip in list(unsatisfied):
+                give = min(each, demands[client_ip] - shares[client_ip])
+                shares[client_ip] += give
+                remaining -= give
+                if shares[client_ip] >= demands[client_ip]:
+                    unsatisfied.discard(client_ip)
+        if remaining > 1:
+            # Everyone got what they asked for; leave the rest as room to grow
+            each = remaining / len(shares)
+            for client_ip in shares:
+                shares[client_ip] = min(self.max_rate, shares[client_ip] + each)
+        return shares
@@ -0,0 +1,230 @@
+"""
+Single-threaded event loop for the server's command channels.
+
+One selector watches the listening socket and every client command socket, so
+idle clients cost no threads and no wake-ups. Incoming bytes are decoded into
+control messages (see framing.py) and handed to callbacks on the loop thread;
+callbacks must not block. Qt signals emitted from these callbacks are
+delivered to the GUI thread through Qt's queued connections.
+"""
+
+import selectors
+import socket
+import threading
+import time
+from .framing import FrameDecoder, FramingError, FRAME_CONTROL
+
+# Per-client receive buffer; clients only send small control messages
+RECV_BUFFER_SIZE = 64 * 1024
+
+
+class Connection:
+    """
+    Per-client read state kept by the reactor.
+    """
+    def __init__(self, sock, ip):
+        self.sock = sock
+        self.ip = ip
+        self.decoder = FrameDecoder(peer=f"client {ip}", buffer_size=RECV_BUFFER_SIZE)
+        self.accepted_at = time.time()
+        self.last_activity = self.accepted_at
+        self.handshake_done = False
+
+    def receive(self):
+        """Read what the socket has; returns (byte count, complete control messages)."""
+        n = self.decoder.recv_into(self.sock)
+        if not n:
+            return 0, []
+        # Clients send no file payload on the command channel, so DATA frames are dropped
+        return n, [payload for kind, _, payload in self.decoder.events() if kind == FRAME_CONTROL]
+
+
+class CommandReactor:
+    """
+    Accepts clients and multiplexes all command channels on one thread.
+
+    Callbacks (all run on the reactor thread):
+        on_accept(sock, addr)          -> configure the socket; return False to refuse
+        on_handshake(conn, message)    -> first message, or None if none arrived in time
+        on_message(conn, message)      -> every later message
+        on_disconnect(conn)            -> peer closed, errored or went idle
+    """
+    def __init__(self, on_accept, on_handshake, on_message, on_disconnect,
+                 handshake_timeout=5, inactivity_timeout=600):
+        self.on_accept = on_accept
+        self.on_handshake = on_handshake
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.handshake_timeout = handshake_timeout
+        self.inactivity_timeout = inactivity_timeout
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # {sock: Connection}
+        self.listen_sock = None
+        self.running = False
+        self.thread = None
+        self._tasks = []
+        self._tasks_lock = threading.Lock()
+        # Self-pipe so other threads can wake the selector
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def start(self, listen_sock):
+        self.listen_sock = listen_sock
+        listen_sock.setblocking(False)
+        self.selector.register(listen_sock, selectors.EVENT_READ, "accept")
+        self.selector.register(self._wake_r, selectors.EVENT_READ, "wake")
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="command-reactor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the reactor thread."""
+        with self._tasks_lock:
+            self._tasks.append((fn, args))
+        self._wake()
+
+    def remove_connection(self, sock):
+        """Stop watching sock; safe to call from any thread, before or after closing it."""
+        if threading.current_thread() is self.thread:
+            self._unregister(sock)
+        else:
+            self.call_soon(self._unregister, sock)
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Already pending or shutting down
+
+    def _unregister(self, sock):
+        self.connections.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _run(self):
+        last_sweep = time.time()
+        while self.running:
+            try:
+                events = self.selector.select(timeout=1.0)
+            except OSError as e:
+                print(f"Reactor select error: {e}")
+                time.sleep(0.1)
+                continue
+            self._run_tasks()
+            for key, _ in events:
+                if key.data == "wake":
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                elif key.data == "accept":
+                    self._accept()
+                else:
+                    conn = self.connections.get(key.fileobj)
+                    if conn:
+                        self._read(conn)
+            now = time.time()
+            if now - last_sweep >= 1.0:
+                self._sweep(now)
+                last_sweep = now
+        self._run_tasks()
+        for sock in list(self.connections):
+            self._unregister(sock)
+        for sock in (self.listen_sock, self._wake_r):
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError, OSError):
+                pass
+        self.selector.close()
+
+    def _run_tasks(self):
+        with self._tasks_lock:
+            tasks, self._tasks = self._tasks, []
+        for fn, args in tasks:
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Reactor task error: {e}")
+
+    def _accept(self):
+        # Drain the backlog: several clients may be waiting
+        while True:
+            try:
+                sock, addr = self.listen_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    print(f"Error accepting connections: {e}")
+                return
+            try:
+                if self.on_accept(sock, addr) is False:
+                    sock.close()
+                    continue
+                conn = Connection(sock, addr[0])
+                self.connections[sock] = conn
+                self.selector.register(sock, selectors.EVENT_READ, "client")
+            except Exception as e:
+                print(f"Unexpected error accepting {addr[0]}: {e}")
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
+    def _read(self, conn):
+        try:
+            # The selector reported data, so this does not block even on a socket with a timeout
+            received, messages = conn.receive()
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except FramingError as e:
+            print(f"Protocol error from {conn.ip}: {e}")
+            received, messages = 0, []
+        except OSError as e:
+            print(f"Connection error from {conn.ip}: {e}")
+            received, messages = 0, []
+        if not received:
+            self._drop(conn)
+            return
+        conn.last_activity = time.time()
+        for message in messages:
+            try:
+                if not conn.handshake_done:
+                    conn.handshake_done = True
+                    self.on_handshake(conn, message)
+                else:
+                    self.on_message(conn, message)
+            except Exception as e:
+                print(f"Error processing message from {conn.ip}: {e}")
+            if conn.sock not in self.connections:
+                return  # Dropped by a callback
+
+    def _drop(self, conn):
+        self._unregister(conn.sock)
+        try:
+            self.on_disconnect(conn)
+        except Exception as e:
+            print(f"Error handling disconnect of {conn.ip}: {e}")
+
+    def _sweep(self, now):
+        for conn in list(self.connections.values()):
+            if not conn.handshake_done and now - conn.accepted_at > self.handshake_timeout:
+                print(f"Timeout waiting for client info from {conn.ip}")
+                conn.handshake_done = True
+                try:
+                    self.on_handshake(conn, None)
+                except Exception as e:
+                    print(f"Error completing handshake for {conn.ip}: {e}")
+            elif now - conn.last_activity > self.inactivity_timeout:
+                print(f"Client {conn.ip} timed out due to extended inactivity")
+                self._drop(conn)
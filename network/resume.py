@@ -0,0 +1,136 @@
+"""
+Checkpoints that let an interrupted unicast transfer continue after a reconnect.
+
+The client keeps a small JSON sidecar next to each partially received file in
+received_files/tmp recording which byte ranges are on disk. On connect it
+reports the contiguous prefix of every partial file together with a SHA-256 of
+the last block of that prefix; the server resumes from that offset only if its
+own copy of the file hashes identically over the same block.
+"""
+
+import hashlib
+import json
+import os
+import time
+from .ranges import RangeSet
+
+CHECKPOINT_SUFFIX = ".resume"
+# Minimum seconds between checkpoint rewrites while receiving
+CHECKPOINT_INTERVAL = 2.0
+# Bytes before the resume offset that both sides hash to confirm they hold the same data
+TAIL_VERIFY_SIZE = 1024 * 1024
+
+
+def tail_hash(file_path, offset, block_size=TAIL_VERIFY_SIZE):
+    """SHA-256 hex digest of the block_size bytes of file_path ending at offset."""
+    start = max(0, offset - block_size)
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = offset - start
+        while remaining:
+            data = f.read(min(remaining, 1024 * 1024))
+            if not data:
+                raise ValueError(f"{file_path} is shorter than {offset} bytes")
+            h.update(data)
+            remaining -= len(data)
+    return h.hexdigest()
+
+
+class ResumeCheckpoint:
+    """
+    Received ranges of one partial file, persisted beside it as <file>.resume.
+    """
+
+    def __init__(self, file_path, file_name, file_size, file_mtime=None, ranges=None):
+        self.file_path = file_path
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.ranges = RangeSet(ranges)
+        self.checkpoint_path = file_path + CHECKPOINT_SUFFIX
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, checkpoint_path):
+        """Read a sidecar; returns None if it is unreadable or its data file is gone."""
+        try:
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            file_path = checkpoint_path[:-len(CHECKPOINT_SUFFIX)]
+            if not os.path.exists(file_path):
+                return None
+            return cls(file_path, state["file_name"], state["file_size"],
+                       state.get("file_mtime"), state.get("ranges"))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def received_offset(self):
+        """Length of the contiguous prefix on disk, i.e. where a sequential resend continues."""
+        return self.ranges.first_gap()
+
+    def record(self, start, end, file_handle=None):
+        """Note that [start, end) was written; rewrites the sidecar at most every CHECKPOINT_INTERVAL."""
+        self.ranges.add(start, end)
+        if time.time() - self._last_save >= CHECKPOINT_INTERVAL:
+            self.save(file_handle)
+
+    def save(self, file_handle=None):
+        """Persist the ranges. Buffered data is flushed first so the sidecar never runs ahead of the file."""
+        if file_handle is not None:
+            try:
+                file_handle.flush()
+            except (OSError, ValueError):
+                return
+        state = {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "file_mtime": self.file_mtime,
+            "ranges": self.ranges.to_list()
+        }
+        tmp_path = self.checkpoint_path + ".new"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.checkpoint_path)
+            self._last_save = time.time()
+        except OSError as e:
+            print(f"Could not write checkpoint for {self.file_name}: {e}")
+
+    def delete(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except OSError:
+            pass
+
+    def describe(self):
+        """Entry reported to the server in CLIENT_INFO, or None if nothing usable is on disk."""
+        offset = self.received_offset()
+        if offset <= 0 or offset >= self.file_size:
+            return None
+        try:
+            digest = tail_hash(self.file_path, offset)
+        except (OSError, ValueError):
+            return None
+        return {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "file_mtime": self.file_mtime,
+            "offset": offset,
+            "tail_hash": digest
+        }
+
+
+def find_checkpoints(directory):
+    """Load every checkpoint in directory."""
+    checkpoints = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return checkpoints
+    for name in names:
+        if name.endswith(CHECKPOINT_SUFFIX):
+            checkpoint = ResumeCheckpoint.load(os.path.join(directory, name))
+            if checkpoint:
+                checkpoints.append(checkpoint)
+    return checkpoints
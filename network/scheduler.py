@@ -0,0 +1,182 @@
+"""
+Central scheduling of the server's unicast file queues.
+
+Each client's pending files are a FileQueue: a heap ordered by priority, then
+(with shortest-job-first) by bytes left to send, then by arrival, so enqueue
+and dequeue are O(log n) and an urgent patch overtakes a queued 30GB dataset.
+
+A client's transfer workers (one, or several when its files are multiplexed)
+take their next file from TransferScheduler.acquire(). With
+MAX_CONCURRENT_TRANSFERS unlimited that is simply the head of the queue.
+With a cap, workers wait for a free slot, and a freed slot goes to the waiting
+client whose head file has the most urgent priority, ties broken by weighted
+fair queuing: every client carries a virtual time that advances by the bytes
+it was sent divided by its weight, and the client furthest behind goes first.
+"""
+
+import heapq
+import itertools
+import threading
+
+from . import protocol
+
+PRIORITY_URGENT = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BULK = 3
+
+POLICY_FIFO = "fifo"
+POLICY_SJF = "sjf"  # Shortest job first within a priority level
+
+WAIT_STEP = 0.5  # Waiting workers re-check cancellation at least this often
+
+
+class FileQueue:
+    """
+    One client's pending files. Iteration yields them in send order; all methods
+    are safe to call from any thread.
+    """
+    def __init__(self, scheduler, weight=1.0):
+        self._scheduler = scheduler
+        self._heap = []  # [(priority, size key, seq), file_info]
+        self.weight = weight
+
+    def _key(self, file_info):
+        priority = file_info.setdefault("priority", PRIORITY_NORMAL)
+        if "queue_seq" not in file_info:
+            file_info["queue_seq"] = next(self._scheduler.sequence)
+        size = 0
+        if self._scheduler.policy == POLICY_SJF:
+            size = file_info.get("file_size", 0) - file_info.get("sent_bytes", 0)
+        return (priority, size, file_info["queue_seq"])
+
+    def push(self, file_info):
+        """Queue a file; a requeued file keeps its place by its original arrival."""
+        with self._scheduler.cond:
+            heapq.heappush(self._heap, (self._key(file_info), file_info))
+            self._scheduler.cond.notify_all()
+
+    def pop(self):
+        with self._scheduler.cond:
+            return heapq.heappop(self._heap)[1] if self._heap else None
+
+    def head_priority(self):
+        with self._scheduler.cond:
+            return self._heap[0][0][0] if self._heap else None
+
+    def remove_if(self, predicate):
+        """Drop the files predicate(file_info) is true for; returns them."""
+        with self._scheduler.cond:
+            removed = [entry[1] for entry in self._heap if predicate(entry[1])]
+            if removed:
+                self._heap = [entry for entry in self._heap if not predicate(entry[1])]
+                heapq.heapify(self._heap)
+            return removed
+
+    def clear(self):
+        """Drop every queued file; returns them."""
+        with self._scheduler.cond:
+            removed = [entry[1] for entry in self._heap]
+            self._heap = []
+            return removed
+
+    def reprioritize(self, predicate, priority):
+        """Move matching files to a new priority level; returns how many changed."""
+        with self._scheduler.cond:
+            changed = 0
+            for entry in self._heap:
+                if predicate(entry[1]):
+                    entry[1]["priority"] = priority
+                    changed += 1
+            if changed:
+                self._heap = [(self._key(info), info) for _, info in self._heap]
+                heapq.heapify(self._heap)
+                self._scheduler.cond.notify_all()
+            return changed
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def __iter__(self):
+        with self._scheduler.cond:
+            entries = sorted(self._heap, key=lambda entry: entry[0])
+        return iter([entry[1] for entry in entries])
+
+
+class TransferScheduler:
+    """
+    Hands out transfer slots across all clients' FileQueues.
+    """
+    def __init__(self, max_concurrent=protocol.MAX_CONCURRENT_TRANSFERS, policy=POLICY_SJF):
+        self.cond = threading.Condition()
+        self.max_concurrent = max_concurrent  # 0 means unlimited
+        self.policy = policy
+        self.sequence = itertools.count()
+        self.active = 0
+        self.waiting = {}  # {(client_ip, thread id): FileQueue} workers blocked in acquire()
+        self.virtual_time = {}  # {client_ip: bytes sent / weight}
+        self.weights = {}  # {client_ip: weight of its queue}
+
+    def new_queue(self, weight=1.0):
+        return FileQueue(self, weight)
+
+    def set_max_concurrent(self, max_concurrent):
+        with self.cond:
+            self.max_concurrent = max_concurrent
+            self.cond.notify_all()
+
+    def acquire(self, client_ip, queue, should_stop=lambda: False):
+        """
+        Next file for one of client_ip's workers to send, once a slot is free and this
+        worker is next in line. None if its queue ran empty or should_stop() became
+        true. Every file returned must be handed back through release().
+        """
+        worker = (client_ip, threading.get_ident())
+        with self.cond:
+            if client_ip not in self.virtual_time:
+                # Newcomers start level with the others instead of owing them nothing
+                self.virtual_time[client_ip] = min(self.virtual_time.values(), default=0.0)
+            self.waiting[worker] = queue
+            self.weights[client_ip] = queue.weight
+            try:
+                while True:
+                    if not queue or should_stop():
+                        return None
+                    if not self.max_concurrent or (self.active < self.max_concurrent
+                                                   and self._next_worker() == worker):
+                        self.active += 1
+                        return queue.pop()
+                    self.cond.wait(WAIT_STEP)
+            finally:
+                self.waiting.pop(worker, None)
+                self.cond.notify_all()
+
+    def release(self, client_ip, sent_bytes):
+        """A file handed out by acquire() finished, failed or was cancelled."""
+        with self.cond:
+            self.active -= 1
+            if client_ip in self.virtual_time:
+                self.virtual_time[client_ip] += max(sent_bytes, 1) / self.weights.get(client_ip, 1.0)
+            self.cond.notify_all()
+
+    def forget(self, client_ip):
+        with self.cond:
+            self.virtual_time.pop(client_ip, None)
+            self.weights.pop(client_ip, None)
+            self.cond.notify_all()
+
+    def _next_worker(self):
+        """Waiting worker whose client has the most urgent head file and is furthest behind in virtual time."""
+        best = None
+        best_key = None
+        for worker, queue in self.waiting.items():
+            priority = queue.head_priority()
+            if priority is None:
+                continue
+            key = (priority, self.virtual_time.get(worker[0], 0.0))
+            if best_key is None or key < best_key:
+                best, best_key = worker, key
+        return best
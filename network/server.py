@@ -2,18 +2,44 @@ from pathlib import Path
 from auto_installer import AutoInstaller
 import socket
 import threading
+import contextlib
+import itertools
 import json
 import os
 import time
 import platform
+import random
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import QObject, pyqtSignal, QTimer
 from collections import defaultdict
 from utils.virus_scanner import VirusScanner
+from utils.hash_cache import get_hash_cache
+from utils import hashing
+from utils.hashing import TreeHashes, TreeHasher
+from .chunking import ChunkSizer
 from .connection_handler import ConnectionHandler
+from .fanout import FanoutReader
+from .multicast import MulticastSender, MulticastSession
+from .parallel import ParallelSender, StreamTuner
+from .ratelimit import BandwidthScheduler
+from .scheduler import TransferScheduler, PRIORITY_NORMAL, PRIORITY_URGENT
+from .reactor import CommandReactor
+from .resume import tail_hash
+from .swarm import SwarmPeerServer, SwarmSession
 
 # Define chunk size for file transfers - increased for better performance
 CHUNK_SIZE = 1048576  # 1MB chunks for better throughput
 MAX_MEMORY_BUFFER = 104857600  # 100MB max memory buffer
+# Zero-copy transmission: let the kernel push file pages to the socket (sendfile)
+ZERO_COPY_ENABLED = True
+SENDFILE_BLOCK_SIZE = 16 * CHUNK_SIZE  # Bytes per sendfile() call on parallel data connections
+MULTIPLEX_BLOCK_SIZE = CHUNK_SIZE  # Cap on slices when several files share the channel, so none waits long
+# Read each distributed file once and feed all client senders from a shared ring
+FANOUT_ENABLED = True
+# Threads streaming file bodies; idle command channels cost none, they all live on the reactor
+TRANSFER_WORKERS = 128
+# Seconds to wait for a dedup-capable client to answer FILE_METADATA with FILE_HAVE / FILE_NEED
+DEDUP_REPLY_TIMEOUT = 30
 RECEIVED_FILES_DIR = "received_files"
 
 # Constants for connection management
@@ -22,6 +48,11 @@ MAX_RETRIES = 5  # Maximum number of retry attempts
 RETRY_DELAY = 2  # Seconds between retries
 
 from . import protocol
+from . import framing
+from . import delta
+from . import manifest
+from . import compression
+from . import batch
 
 class NetworkServer(QObject):
     # Qt signals
@@ -212,6 +243,7 @@ class NetworkServer(QObject):
     client_connected = pyqtSignal(dict) # Emits client info {ip, hostname, os_type, is_windows}
     client_disconnected = pyqtSignal(str) # Emits client IP
     file_progress = pyqtSignal(str, str, int) # Emits (file_name, client_ip, percentage)
+    file_chunk_size = pyqtSignal(str, str, int) # Emits (file_name, client_ip, bytes per slice) when the ChunkSizer changes it
     status_update_received = pyqtSignal(str, str, str) # Emits (file_name, client_ip, status_message)
     status_update = pyqtSignal(str, str) # Emits (message, color)
     server_ip_updated = pyqtSignal(str) # Emits the server's IP address
@@ -223,7 +255,7 @@ class NetworkServer(QObject):
         self.discovery_port = discovery_port
         self.server_socket = None
         self.discovery_socket = None
-        self.clients = {} # {ip: {socket: ..., thread: ..., info: ..., files_to_send: []}}
+        self.clients = {} # {ip: {socket: ..., thread: ..., info: ..., files_to_send: FileQueue}}
         self.running = False
         self.discovery_server_running = False
         self.discovery_thread = None
@@ -233,6 +265,27 @@ class NetworkServer(QObject):
         self.host = host
         self.virus_scanner = VirusScanner()
         self.scan_results = {}  # Cache for scan results
+        self.multicast_enabled = False # Send each file once to the multicast group instead of per-client copies
+        self.multicast_sessions = {} # {transfer_id: MulticastSession}
+        self.swarm_enabled = False # Let clients re-serve chunks to each other, server acts as tracker + seed
+        self.swarm_sessions = {} # {swarm_id: SwarmSession}
+        self.swarm_seed = None # SwarmPeerServer serving original files, created on first use
+        self.multicast_senders = set() # MulticastSenders sending now, re-paced when the rate limit changes
+        self.parallel_enabled = False # Split large files over several data connections to clients that listen for them
+        self.parallel_tuners = {} # {client_ip: StreamTuner} stream count learned from observed throughput
+        self.chunk_sizers = {} # {client_ip: ChunkSizer} command-channel slice size learned from goodput and latency
+        # (codec, level) for compressing file bodies to clients that can decode it; None sends raw
+        self.compression = (protocol.COMPRESSION_CODEC, protocol.COMPRESSION_LEVEL)
+        # Global and per-client token buckets every unicast file byte passes through
+        self.rate_limiter = BandwidthScheduler()
+        # Orders every client's queue and caps concurrent unicast transfers across clients
+        self.scheduler = TransferScheduler()
+        self.file_priorities = {} # {file_path: priority} for files queued from now on (scheduler.PRIORITY_*)
+        self.hash_cache = get_hash_cache() # Persistent SHA-256 + chunk digests shared with the scanner
+        self.reactor = None # CommandReactor multiplexing every client command channel
+        self.transfer_pool = None # Bounded pool running _process_file_queue per busy client
+        self.interrupted_transfers = {} # {client_ip: (disconnected_at, [file_path, ...])} re-queued on reconnect
+        self.tree_syncs = {} # {tree_id: {"root", "name", "entries", "pending": {client_ip}}} directory trees being synced
 
     def start_server(self):
         if self.running:
@@ -244,9 +297,12 @@ class NetworkServer(QObject):
             # Enable TCP keepalive
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)  # Increased backlog for better connection handling
+            self.server_socket.listen(128)  # Room for many clients connecting at once
             self.running = True
-            threading.Thread(target=self._accept_connections, daemon=True).start()
+            self.transfer_pool = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS, thread_name_prefix="transfer")
+            self.reactor = CommandReactor(self._on_client_accepted, self._on_client_handshake,
+                                          self._on_client_message, self._on_client_closed)
+            self.reactor.start(self.server_socket)
             # Get all available IPs
             self.server_ips = self._get_local_ips()
             # Use first IP as primary but keep all for discovery
@@ -272,6 +328,10 @@ class NetworkServer(QObject):
         
         # Stop discovery server first
         self.stop_discovery_server()
+
+        # No more accepts or command messages
+        if self.reactor:
+            self.reactor.stop()
         
         # Disconnect all clients with proper cleanup
         client_ips = list(self.clients.keys())  # Create a copy since we'll be modifying self.clients
@@ -292,6 +352,15 @@ class NetworkServer(QObject):
             except Exception as e:
                 print(f"Error closing server socket: {e}")
         
+        if self.swarm_seed:
+            self.swarm_seed.close()
+            self.swarm_seed = None
+
+        if self.transfer_pool:
+            # Workers see running == False and closed sockets and finish on their own
+            self.transfer_pool.shutdown(wait=False, cancel_futures=True)
+            self.transfer_pool = None
+
         # Clear all remaining data
         self.clients.clear()
         self.file_transfer_states.clear()
@@ -302,203 +371,154 @@ class NetworkServer(QObject):
         except RuntimeError:
             pass  # Qt might already be shut down
 
-    def _accept_connections(self):
-        while self.running:
-            try:
-                self.server_socket.settimeout(1.0)  # Add timeout to prevent blocking
-                client_socket, client_address = self.server_socket.accept()
-                client_ip = client_address[0]
-                print(f"Client connected from {client_ip}")
-                
-                # Configure client socket with better settings for multiple connections
-                client_socket.settimeout(120)  # Longer timeout for file operations
-                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                # Enable TCP keepalive with more aggressive settings
-                if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
-                if hasattr(socket, 'TCP_KEEPINTVL'):
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-                if hasattr(socket, 'TCP_KEEPCNT'):
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-                
-                # Increase socket buffer sizes for better performance
-                try:
-                    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)  # 1MB receive buffer
-                    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)  # 1MB send buffer
-                except Exception:
-                    pass  # Some systems may not support these options
-                    
-                # Check if this is a reconnecting client
-                existing_client = self.clients.get(client_ip)
-                if existing_client and existing_client.get("reconnect_pending"):
-                    print(f"Client {client_ip} is reconnecting")
-                    # Update socket and clear reconnection flag
-                    existing_client["socket"] = client_socket
-                    existing_client["reconnect_pending"] = False
-                    # Resume any pending transfers
-                    if existing_client.get("current_file_transfer"):
-                        self.status_update.emit(f"Resuming transfers for {client_ip}", "green")
-                        threading.Thread(target=self._process_file_queue, args=(client_ip,), daemon=True).start()
-                
-                # Wait for client information
-                try:
-                    # Receive client info with timeout
-                    client_socket.settimeout(5)  # Short timeout for initial info
-                    data = client_socket.recv(4096)
-                    client_socket.settimeout(120)  # Restore longer timeout for file operations
-                    
-                    if data:
-                        try:
-                            # Parse client information
-                            message = json.loads(data.decode('utf-8').strip())
-                            if message.get("type") == "CLIENT_INFO":
-                                client_info = {
-                                    "ip": client_ip,
-                                    "hostname": message.get("hostname", "Unknown Client"),
-                                    "os_type": message.get("os_type", "Unknown OS"),
-                                    "is_windows": message.get("is_windows", False),
-                                    "connected_at": time.time()
-                                }
-                                print(f"Received client info: {client_info['hostname']} ({client_info['os_type']})")
-                            else:
-                                # Fallback if no proper client info received
-                                client_info = {
-                                    "ip": client_ip,
-                                    "hostname": "Unknown Client",
-                                    "os_type": "Unknown OS",
-                                    "is_windows": False,
-                                    "connected_at": time.time()
-                                }
-                        except (json.JSONDecodeError, UnicodeDecodeError):
-                            # Fallback for invalid JSON
-                            client_info = {
-                                "ip": client_ip,
-                                "hostname": "Unknown Client",
-                                "os_type": "Unknown OS",
-                                "is_windows": False,
-                                "connected_at": time.time()
-                            }
-                    else:
-                        # No data received, use fallback
-                        client_info = {
-                            "ip": client_ip,
-                            "hostname": "Unknown Client",
-                            "os_type": "Unknown OS",
-                            "is_windows": False,
-                            "connected_at": time.time()
-                        }
-                        
-                except socket.timeout:
-                    print(f"Timeout waiting for client info from {client_ip}")
-                    client_info = {
-                        "ip": client_ip,
-                        "hostname": "Timeout Client",
-                        "os_type": "Unknown OS",
-                        "is_windows": False,
-                        "connected_at": time.time()
-                    }
-                
-                # Store client information
-                self.clients[client_ip] = {
-                    "socket": client_socket,
-                    "thread": None,
-                    "info": client_info,
-                    "files_to_send": [],
-                    "current_file_transfer": None
-                }
-                
-                # Start a thread to handle this client
-                client_thread = threading.Thread(target=self._handle_client, args=(client_socket, client_ip), daemon=True)
-                client_thread.start()
-                self.clients[client_ip]["thread"] = client_thread
-                
-                # Emit signal for UI update with complete client info
-                self.client_connected.emit(client_info)
-                self.status_update.emit(f"Client connected: {client_info['hostname']} ({client_ip})", "green")
-                
-            except socket.timeout:
-                # Timeout is expected, continue the loop
-                continue
-            except OSError:
-                if self.running:
-                    print("Error accepting connections")
-                break
-            except Exception as e:
-                if self.running:
-                    print(f"Unexpected error in accept_connections: {e}")
-                    self.status_update.emit(f"Connection error: {e}", "red")
-                    time.sleep(1) # Brief pause before retrying
+    def _on_client_accepted(self, client_socket, client_address):
+        """Reactor callback: configure a freshly accepted command socket."""
+        client_ip = client_address[0]
+        print(f"Client connected from {client_ip}")
 
-    def _handle_client(self, client_socket, client_ip):
-        buffer = b""
-        last_activity = time.time()
-        reconnect_attempts = 0
-        max_reconnect_attempts = 5
-        
-        while self.running:
-            try:
-                # Use non-blocking socket with select for better concurrent handling
-                client_socket.settimeout(0.1)  # Short timeout for non-blocking behavior
-                try:
-                    data = client_socket.recv(CHUNK_SIZE)
-                    if data:
-                        last_activity = time.time()
-                        reconnect_attempts = 0  # Reset attempts on successful data
-                    else:
-                        # Empty data might mean graceful disconnect or temporary issue
-                        # Wait a bit before considering it a disconnect
-                        time.sleep(1)
-                        try:
-                            # Try to send a ping to check connection
-                            client_socket.sendall(b'ping\n')
-                            continue
-                        except:
-                            if reconnect_attempts < max_reconnect_attempts:
-                                print(f"Connection issue with {client_ip}, attempting to maintain...")
-                                reconnect_attempts += 1
-                                time.sleep(2)  # Wait before retry
-                                continue
-                            else:
-                                print(f"Client {client_ip} disconnected after {max_reconnect_attempts} attempts")
-                                break
-                except socket.timeout:
-                    # Only timeout after extended period of no activity
-                    if time.time() - last_activity > 600:  # 10 minutes timeout
-                        print(f"Client {client_ip} timed out due to extended inactivity")
-                        break
-                    continue  # Continue waiting for data
-                except (ConnectionResetError, OSError) as e:
-                    # Don't immediately disconnect on connection errors
-                    if reconnect_attempts < max_reconnect_attempts:
-                        print(f"Connection issue with {client_ip}: {e}, attempting to maintain...")
-                        reconnect_attempts += 1
-                        time.sleep(2)  # Wait before retry
-                        continue
-                    else:
-                        print(f"Client {client_ip} disconnected after {max_reconnect_attempts} attempts")
-                        break
+        # Sockets stay blocking for senders; the reactor only reads once select() reports data
+        client_socket.settimeout(120)  # Longer timeout for file operations
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Enable TCP keepalive with more aggressive settings
+        if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
+
+        # Increase socket buffer sizes for better performance
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)  # 1MB receive buffer
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)  # 1MB send buffer
+        except Exception:
+            pass  # Some systems may not support these options
+        return True
 
-                buffer += data
+    def _on_client_handshake(self, conn, message):
+        """Reactor callback: first message on a new connection (None if it never came)."""
+        client_ip = conn.ip
+        if message and message.get("type") == "CLIENT_INFO":
+            client_info = {
+                "ip": client_ip,
+                "hostname": message.get("hostname", "Unknown Client"),
+                "os_type": message.get("os_type", "Unknown OS"),
+                "is_windows": message.get("is_windows", False),
+                "connected_at": time.time()
+            }
+            print(f"Received client info: {client_info['hostname']} ({client_info['os_type']})")
+        else:
+            # Fallback if no proper client info received
+            client_info = {
+                "ip": client_ip,
+                "hostname": "Timeout Client" if message is None else "Unknown Client",
+                "os_type": "Unknown OS",
+                "is_windows": False,
+                "connected_at": time.time()
+            }
+
+        # Clients that advertise framing get a SERVER_INFO line with the agreed version;
+        # everything after it is framed. Older clients keep newline-delimited JSON.
+        wire_version = framing.negotiate(message.get("framing") if message else None)
+        if wire_version >= framing.FRAMING_VERSION:
+            server_info = {
+                "type": "SERVER_INFO",
+                "ip": self.server_ip,
+                "port": self.port,
+                "hostname": socket.gethostname(),
+                "os_type": platform.system(),
+                "is_windows": platform.system() == "Windows",
+                "framing": wire_version
+            }
+            try:
+                conn.sock.sendall(framing.encode_message(server_info))
+            except OSError as e:
+                print(f"Failed to send server info to {client_ip}: {e}")
+                wire_version = framing.LEGACY_FRAMING
 
-                # Process complete JSON messages
-                while b'\n' in buffer:
-                    line, remaining_buffer = buffer.split(b'\n', 1)
+        pending_files = self.scheduler.new_queue()
+        existing_client = self.clients.get(client_ip)
+        if existing_client:
+            if existing_client.get("reconnect_pending"):
+                print(f"Client {client_ip} is reconnecting")
+                # Keep the queue; the old worker already stopped with the old socket
+                pending_files = existing_client["files_to_send"]
+            elif existing_client.get("socket") is not conn.sock:
+                # Stale connection from the same host; its worker notices the closed socket and exits
+                old_socket = existing_client.get("socket")
+                if old_socket:
+                    self.reactor.remove_connection(old_socket)
                     try:
-                        message = json.loads(line.decode('utf-8'))
-                        self._process_client_message(client_ip, message)
-                        buffer = remaining_buffer
-                    except json.JSONDecodeError:
-                        print(f"Non-JSON data from client {client_ip}: {line.decode('utf-8', errors='ignore')[:100]}...")
-                        buffer = remaining_buffer
-                        break
+                        old_socket.close()
+                    except Exception:
+                        pass
 
-            except Exception as e:
-                if self.running:
-                    print(f"Unexpected error handling client {client_ip}: {e}")
-                break
-                
-        self._disconnect_client(client_ip)
+        # Store client information
+        self.clients[client_ip] = {
+            "socket": conn.sock,
+            "thread": None,
+            "info": client_info,
+            "files_to_send": pending_files,
+            "transfers": {}, # {stream id: file_info} of files being sent; stream 0 unless multiplexed
+            "stream_ids": itertools.count(1),
+            "send_lock": threading.Lock(), # Serialises writes to the command channel
+            "framing": wire_version, # Wire format negotiated in the handshake
+            # Partial copies the client already holds: {(file_name, file_size): {offset, tail_hash, file_mtime}}
+            "partials": {(p.get("file_name"), p.get("file_size")): p
+                         for p in (message.get("partial_files") or [] if message else [])
+                         if isinstance(p, dict)},
+            "queue_lock": threading.Lock(),
+            "queue_workers": 0, # Transfer workers draining files_to_send
+            # Client's data connection listener for multi-stream transfers, and how many streams it accepts
+            "parallel_port": message.get("parallel_port") if message else None,
+            "max_streams": message.get("max_streams", 1) if message else 1,
+            # Client answers hashed FILE_METADATA with FILE_HAVE / FILE_NEED before any body is sent
+            "dedup": bool(message.get("dedup")) if message else False,
+            "file_replies": {}, # {stream id: {"event": Event, "reply": message, "deadline": time}} awaited by the transfer worker
+            "delta_sent": {}, # {file_name: file_info} sent as a delta, resent in full if the client cannot apply it
+            "no_delta": set(), # File names whose delta failed to rebuild on this client
+            "compression": message.get("compression") or [] if message else [], # Codecs the client decodes
+            # Client unpacks batches of small files; {batch_id: {"entries", "changed"}} awaiting BATCH_ACK
+            "batch": bool(message.get("batch")) if message else False,
+            "batches": {},
+            # Client checks each body against a FILE_DIGEST trailer and asks for corrupt ranges again
+            "integrity": bool(message.get("integrity")) if message else False,
+            "digests_sent": {} # {file_name: file_info} whose trailer went out, until the client's FILE_ACK
+        }
+
+        # Emit signal for UI update with complete client info
+        self.client_connected.emit(client_info)
+        self.status_update.emit(f"Client connected: {client_info['hostname']} ({client_ip})", "green")
+        if pending_files:
+            self.status_update.emit(f"Resuming transfers for {client_ip}", "green")
+            self._schedule_file_queue(client_ip)
+
+        # Files cut off by a recent disconnect go out again; reported partial copies let them resume
+        disconnected_at, interrupted = self.interrupted_transfers.pop(client_ip, (0, []))
+        if interrupted and time.time() - disconnected_at <= RECONNECT_TIMEOUT:
+            self.status_update.emit(f"Resuming {len(interrupted)} interrupted transfer(s) for {client_ip}", "green")
+            self._queue_files(client_ip, interrupted)
+
+        # Trees this client had not finished syncing are offered again; it asks only for what it still lacks
+        unfinished = [tree for tree in list(self.tree_syncs.values()) if client_ip in tree["pending"]]
+        if unfinished:
+            threading.Thread(target=self._offer_trees, args=(client_ip, unfinished), daemon=True).start()
+
+    def _on_client_message(self, conn, message):
+        """Reactor callback: runs on the reactor thread, so handlers must not block."""
+        self._process_client_message(conn.ip, message)
+
+    def _on_client_closed(self, conn):
+        """Reactor callback: peer closed the command channel, errored or went idle."""
+        client_data = self.clients.get(conn.ip)
+        if client_data and client_data.get("socket") is conn.sock:
+            self._disconnect_client(conn.ip)
+        else:
+            try:
+                conn.sock.close()
+            except Exception:
+                pass
 
     def _process_client_message(self, client_ip, message):
         msg_type = message.get("type")
@@ -513,6 +533,9 @@ class NetworkServer(QObject):
             st["ack_status"] = status
             if status in ("Acknowledged", "Received"):
                 st["completed"] = True
+            client_data = self.clients.get(client_ip)
+            if client_data:
+                client_data["digests_sent"].pop(file_name, None)
         elif msg_type == "STATUS_UPDATE":
             file_name = message.get("file_name")
             status = message.get("status")
@@ -521,19 +544,133 @@ class NetworkServer(QObject):
                 status = "Received successfully"
             print(f"STATUS_UPDATE from {client_ip} for {file_name}: {status}")
             self.status_update_received.emit(file_name, client_ip, status)
+        elif msg_type in ("MULTICAST_READY", "MULTICAST_REJECT", "MULTICAST_NACK", "MULTICAST_COMPLETE"):
+            session = self.multicast_sessions.get(message.get("transfer_id"))
+            if not session:
+                return
+            if msg_type == "MULTICAST_READY":
+                session.mark_ready(client_ip)
+            elif msg_type == "MULTICAST_REJECT":
+                print(f"Client {client_ip} cannot join multicast: {message.get('reason')}")
+                session.mark_ready(client_ip, ok=False)
+            elif msg_type == "MULTICAST_NACK":
+                session.add_nack(client_ip, message.get("ranges", []))
+            else:
+                session.mark_complete(client_ip)
+        elif msg_type in ("SWARM_JOIN", "SWARM_REJECT", "SWARM_HAVE", "SWARM_PEERS_REQUEST", "SWARM_COMPLETE"):
+            self._handle_swarm_message(client_ip, message)
+        elif msg_type in ("FILE_HAVE", "FILE_NEED"):
+            client_data = self.clients.get(client_ip)
+            waiter = client_data["file_replies"].get(message.get("stream", 0)) if client_data else None
+            if msg_type == "FILE_HAVE":
+                # Emitted here so it precedes the FILE_ACK the client sends right after
+                self.status_update_received.emit(message.get("file_name"), client_ip, "Already on Client")
+            if waiter:
+                waiter["reply"] = message
+                waiter["event"].set()
+        elif msg_type == "FILE_PREPARING":
+            # The client is still signing its delta basis; keep holding the body back
+            client_data = self.clients.get(client_ip)
+            waiter = client_data["file_replies"].get(message.get("stream", 0)) if client_data else None
+            if waiter:
+                waiter["deadline"] = time.time() + DEDUP_REPLY_TIMEOUT
+        elif msg_type == "FILE_REJECT":
+            # The client cannot take the file (e.g. not enough disk space); stop sending it
+            file_name = message.get("file_name")
+            reason = message.get("reason", "Rejected")
+            client_data = self.clients.get(client_ip)
+            if not client_data:
+                return
+            print(f"Client {client_ip} rejected {file_name}: {reason}")
+            for current in self._active_transfers(client_data, file_name, message.get("stream")):
+                current["rejected"] = reason
+                current["cancel_event"].set()
+            waiter = client_data["file_replies"].get(message.get("stream", 0))
+            if waiter:
+                waiter["reply"] = message
+                waiter["event"].set()
+            st = self.file_transfer_states[client_ip][file_name]
+            st["status"] = f"Rejected by Client ({reason})"
+            st["ack_status"] = st["status"]
+            self.status_update_received.emit(file_name, client_ip, st["status"])
+            self.status_update.emit(f"{client_ip} rejected {file_name}: {reason}", "red")
+        elif msg_type == "DELTA_FAILED":
+            # The client's rebuilt copy did not match; send this file whole from now on
+            file_name = message.get("file_name")
+            client_data = self.clients.get(client_ip)
+            if not client_data:
+                return
+            client_data["no_delta"].add(file_name)
+            sent = client_data["delta_sent"].pop(file_name, None)
+            if sent:
+                print(f"Client {client_ip} could not apply the delta of {file_name}; resending in full")
+                self.send_file(client_ip, sent["file_path"], tree=sent.get("tree"))
+        elif msg_type == "RANGE_REQUEST":
+            self._queue_repair(client_ip, message)
+        elif msg_type == "BATCH_ACK":
+            client_data = self.clients.get(client_ip)
+            sent = client_data["batches"].pop(message.get("batch_id"), None) if client_data else None
+            if not sent:
+                return
+            failed = set(message.get("failed") or [])
+            print(f"Batch {message.get('batch_id')} received by {client_ip}: "
+                  f"{message.get('received', 0)} files, {len(failed)} failed")
+            for entry in sent["entries"]:
+                file_name = entry["file_name"]
+                if file_name in sent["changed"]:
+                    continue # Sent again on its own
+                status = "Not Received (Batch Error)" if file_name in failed else "Received successfully"
+                st = self.file_transfer_states[client_ip][file_name]
+                st["status"] = status
+                st["ack_status"] = status
+                if file_name not in failed:
+                    st["completed"] = True
+                self.status_update_received.emit(file_name, client_ip, status)
+            self.status_update.emit(f"{client_ip} received a batch of {len(sent['entries'])} files", "green")
+        elif msg_type == "TREE_NEED":
+            self._queue_tree_files(client_ip, message)
+        elif msg_type == "TREE_SYNCED":
+            tree = self.tree_syncs.get(message.get("tree_id"))
+            tree_name = tree["name"] if tree else message.get("tree_name")
+            failed = message.get("failed") or []
+            status = "Synced" if not failed else f"Synced ({len(failed)} failed)"
+            print(f"Tree {tree_name} synced to {client_ip}: {message.get('received', 0)} files received, "
+                  f"{len(failed)} failed")
+            if tree and not failed:
+                tree["pending"].discard(client_ip)
+                if not tree["pending"]:
+                    self.tree_syncs.pop(tree["id"], None)
+            st = self.file_transfer_states[client_ip][tree_name]
+            st["status"] = status
+            st["ack_status"] = status
+            st["completed"] = not failed
+            self.status_update_received.emit(tree_name, client_ip, status)
+            self.status_update.emit(f"{client_ip} synced {tree_name}", "green" if not failed else "orange")
+        elif msg_type == "BATCH_STATUS":
+            for file_name, status in (message.get("files") or {}).items():
+                self.status_update_received.emit(file_name, client_ip, status)
+        elif msg_type == "RESUME_REJECT":
+            # The client lost the partial copy we resumed into; start the file over
+            file_name = message.get("file_name")
+            client_data = self.clients.get(client_ip)
+            if not client_data:
+                return
+            for current in self._active_transfers(client_data, file_name, message.get("stream")):
+                current["cancel_event"].set()
+                print(f"Client {client_ip} cannot resume {file_name}; resending from the start")
+                self.send_file(client_ip, current["file_path"], tree=current.get("tree"))
         elif msg_type == "CANCEL_TRANSFER":
             file_name = message.get("file_name")
             # If currently sending this file, signal cancel; also remove from queue
             if client_ip in self.clients:
                 client_data = self.clients[client_ip]
-                current = client_data.get("current_file_transfer")
-                if current and current.get("file_name") == file_name:
-                    if "cancel_event" in client_data:
-                        client_data["cancel_event"].set()
+                for current in self._active_transfers(client_data, file_name):
+                    current["cancel_event"].set()
                     self.status_update_received.emit(file_name, client_ip, "Cancelled by Client")
                     self.status_update.emit(f"Client requested cancel for {file_name}", "red")
                 # Remove from queued files
-                client_data["files_to_send"] = [f for f in client_data["files_to_send"] if f.get("file_name") != file_name]
+                self._release_fanout(client_ip, client_data["files_to_send"].remove_if(
+                    lambda f: f.get("file_name") == file_name))
         else:
             print(f"Unknown message type from client {client_ip}: {message}")
 
@@ -603,7 +740,7 @@ class NetworkServer(QObject):
         return [client_data["info"] for client_data in self.clients.values()]
 
     def add_files_for_distribution(self, file_paths):
-        """Add files to distribution queue without automatic scanning"""
+        """Add files, or directory trees to sync, to distribution queue without automatic scanning"""
         try:
             for path in file_paths:
                 if not os.path.exists(path):
@@ -611,6 +748,20 @@ class NetworkServer(QObject):
                     continue
                     
                 try:
+                    if os.path.isdir(path):
+                        # Synced by manifest: clients receive only the files they lack
+                        tree_name = os.path.basename(os.path.normpath(path))
+                        self.files_to_distribute.append({
+                            "path": path,
+                            "name": tree_name,
+                            "size": manifest.tree_size(path),
+                            "tree": True,
+                            "scan_result": "not_scanned",
+                            "scan_details": "Not scanned yet"
+                        })
+                        self.status_update.emit(f"Added folder {tree_name} to queue", "blue")
+                        continue
+
                     file_name = os.path.basename(path)
                     self.status_update.emit(f"Added {file_name} to queue", "blue")
                     
@@ -623,6 +774,8 @@ class NetworkServer(QObject):
                         "scan_details": "Not scanned yet"
                     }
                     self.files_to_distribute.append(file_info)
+                    # Hash now so the first send (FILE_METADATA) and the scanner find it cached
+                    threading.Thread(target=self._content_hash, args=(path,), daemon=True).start()
                     
                 except Exception as e:
                     print(f"Error processing file {path}: {e}")
@@ -652,12 +805,57 @@ class NetworkServer(QObject):
             self.status_update.emit("No active clients to distribute files to.", "orange")
             return
 
+        # Directory trees are synced by manifest, every client fetching only what it lacks
+        trees = [f for f in self.files_to_distribute if f.get("tree")]
+        for tree_info in trees:
+            self.sync_tree(tree_info["path"], active_clients)
+        files = [f for f in self.files_to_distribute if not f.get("tree")]
+        if not files:
+            threading.Thread(target=self._monitor_distribution_progress,
+                             args=(self.files_to_distribute, active_clients),
+                             daemon=True).start()
+            return
+
+        # Group distribution modes: one multicast pass, or a peer-assisted swarm
+        runner, mode = None, None
+        if self.multicast_enabled and len(active_clients) >= protocol.MULTICAST_MIN_CLIENTS:
+            runner, mode = self._run_multicast_distribution, "multicast"
+        elif self.swarm_enabled and len(active_clients) > 1:
+            runner, mode = self._run_swarm_distribution, "swarm"
+        if runner:
+            threading.Thread(target=runner,
+                             args=(files, active_clients),
+                             daemon=True).start()
+            threading.Thread(target=self._monitor_distribution_progress,
+                             args=(self.files_to_distribute, active_clients),
+                             daemon=True).start()
+            self.status_update.emit(
+                f"Started {mode} distribution of {len(self.files_to_distribute)} files to {len(active_clients)} clients.",
+                "green"
+            )
+            return
+
+        # Runs of small files go out as batches, one queue entry per batch
+        batched = self._batchable_paths([f["path"] for f in files])
+        if batched:
+            for client_ip in active_clients:
+                self.send_batch(client_ip, batched)
+
         # Initialize distribution tracking
-        for file_info in self.files_to_distribute:
+        for file_info in files:
+            if file_info["path"] in batched:
+                continue
+            fanout = None
+            if FANOUT_ENABLED and len(active_clients) > 1 and os.path.exists(file_info["path"]):
+                # One disk read shared by every client instead of one read per client
+                fanout = FanoutReader(file_info["path"], active_clients,
+                                      os.path.getsize(file_info["path"]), CHUNK_SIZE)
             for client_ip in active_clients:
                 if client_ip in self.clients:
                     # Queue file for each client
-                    self.send_file(client_ip, file_info["path"])
+                    self.send_file(client_ip, file_info["path"], fanout=fanout)
+                elif fanout:
+                    fanout.release(client_ip)
 
         # Start a monitoring thread for overall progress
         threading.Thread(target=self._monitor_distribution_progress, 
@@ -688,21 +886,28 @@ class NetworkServer(QObject):
         else:
             self.status_update.emit(f"Client {ip_address} not found. Waiting for client to connect.", "orange")
 
+    def set_rate_limit(self, bytes_per_second):
+        """Cap the total rate of file data sent to clients; None or 0 restores BASE_RATE_LIMIT."""
+        rate = bytes_per_second or protocol.BASE_RATE_LIMIT
+        self.rate_limiter.set_global_rate(rate)
+        for sender in list(self.multicast_senders):
+            sender.set_rate(self._multicast_rate())
+        if bytes_per_second:
+            self.status_update.emit(f"Bandwidth limited to {rate / (1024 * 1024):.0f} MB/s", "orange")
+        else:
+            self.status_update.emit("Bandwidth limit removed", "green")
+
     def cancel_all_transfers(self):
         for client_ip in self.clients:
-            self.clients[client_ip]["files_to_send"].clear()
+            self._release_fanout(client_ip, self.clients[client_ip]["files_to_send"].clear())
             # signal cancel for any ongoing transfer
-            if "cancel_event" in self.clients[client_ip]:
-                self.clients[client_ip]["cancel_event"].set()
-            current = self.clients[client_ip]["current_file_transfer"]
-            if current:
+            for current in self._active_transfers(self.clients[client_ip]):
+                current["cancel_event"].set()
                 file_name = current["file_name"]
                 # Inform client to stop receiving this file
-                try:
-                    cancel_msg = json.dumps({"type": "CANCEL_TRANSFER", "file_name": file_name}).encode("utf-8") + b"\n"
-                    self.clients[client_ip]["socket"].sendall(cancel_msg)
-                except Exception:
-                    pass
+                self._send_control_message(client_ip, {"type": "CANCEL_TRANSFER", "file_name": file_name,
+                                                       "transfer_id": current.get("transfer_id"),
+                                                       "stream": current["stream_id"]}, timeout=5)
                 self.status_update_received.emit(file_name, client_ip, "Cancelled")
                 self.status_update.emit(f"Cancelled transfer of {file_name} to {client_ip}", "red")
         self.status_update.emit("All transfers cancelled.", "red")
@@ -710,24 +915,22 @@ class NetworkServer(QObject):
     def cancel_file_transfer(self, client_ip, file_name):
         if client_ip in self.clients:
             # Check if the file is currently being transferred
-            current = self.clients[client_ip]["current_file_transfer"]
-            if current and current["file_name"] == file_name:
+            for current in self._active_transfers(self.clients[client_ip], file_name):
                 # signal cancellation to the sending loop
-                if "cancel_event" in self.clients[client_ip]:
-                    self.clients[client_ip]["cancel_event"].set()
+                current["cancel_event"].set()
                 # Inform client to stop receiving this file
-                try:
-                    cancel_msg = json.dumps({"type": "CANCEL_TRANSFER", "file_name": file_name}).encode("utf-8") + b"\n"
-                    self.clients[client_ip]["socket"].sendall(cancel_msg)
-                except Exception:
-                    pass
+                self._send_control_message(client_ip, {"type": "CANCEL_TRANSFER", "file_name": file_name,
+                                                       "transfer_id": current.get("transfer_id"),
+                                                       "stream": current["stream_id"]}, timeout=5)
                 self.status_update_received.emit(file_name, client_ip, "Cancelled")
                 self.status_update.emit(f"Cancelled current transfer of {file_name} to {client_ip}", "red")
             
-            # Remove from queue
-            self.clients[client_ip]["files_to_send"] = [
-                f for f in self.clients[client_ip]["files_to_send"] if f["file_name"] != file_name
-            ]
+            # Remove from queue, including queued batches
+            self._release_fanout(client_ip, self.clients[client_ip]["files_to_send"].remove_if(
+                lambda f: f["file_name"] == file_name))
+            for queued in self.clients[client_ip]["files_to_send"]:
+                if queued.get("batch"):
+                    queued["batch"] = [p for p in queued["batch"] if os.path.basename(p) != file_name]
             self.status_update.emit(f"Removed {file_name} from queue for {client_ip}", "red")
         else:
             self.status_update.emit(f"Client {client_ip} not found, cannot cancel transfer.", "orange")
@@ -806,6 +1009,8 @@ class NetworkServer(QObject):
             print(f"Temporary disconnection for client {client_ip}")
             # Just close the socket but keep the client data
             if client_socket:
+                if self.reactor:
+                    self.reactor.remove_connection(client_socket)
                 try:
                     client_socket.shutdown(socket.SHUT_RDWR)
                 except OSError:
@@ -819,17 +1024,11 @@ class NetworkServer(QObject):
             self.status_update.emit(f"Client {client_ip} temporarily disconnected", "orange")
             return
         
-        # For permanent disconnections or shutdown
-        if "cancel_event" in client_data:
-            try:
-                client_data["cancel_event"].set()
-            except Exception:
-                pass
-        
-        # Handle current transfer
-        current_transfer = client_data.get("current_file_transfer")
-        if current_transfer:
+        # For permanent disconnections or shutdown, stop and report the files in flight
+        current_transfers = self._active_transfers(client_data)
+        for current_transfer in current_transfers:
             try:
+                current_transfer["cancel_event"].set()
                 file_name = current_transfer.get("file_name", "Unknown")
                 if not is_shutdown:
                     self.status_update_received.emit(file_name, client_ip, "Paused")
@@ -837,12 +1036,26 @@ class NetworkServer(QObject):
             except Exception:
                 pass
         
+        # Remember what this client was still due so a reconnect picks it up again
+        if not is_shutdown:
+            # Tree files are not among them: the tree is offered again and the client asks for what it lacks.
+            # Files still being verified against their digest trailer are dropped by the client, so they count.
+            unverified = list(client_data["digests_sent"].values())
+            interrupted = list(dict.fromkeys(
+                path for f in current_transfers + list(client_data["files_to_send"]) + unverified
+                if not f.get("tree")
+                for path in (f.get("batch") or [f["file_path"]])))
+            if interrupted:
+                self.interrupted_transfers[client_ip] = (time.time(), interrupted)
+
         # Don't clear pending transfers unless it's a shutdown
         if is_shutdown:
-            client_data["files_to_send"].clear()
+            self._release_fanout(client_ip, client_data["files_to_send"].clear())
         
         # Close socket safely
         if client_socket:
+            if self.reactor:
+                self.reactor.remove_connection(client_socket)
             try:
                 client_socket.shutdown(socket.SHUT_RDWR)
             except OSError:
@@ -855,7 +1068,10 @@ class NetworkServer(QObject):
         # Clean up client data only on permanent disconnect or shutdown
         if not is_temporary:
             try:
+                self._release_fanout(client_ip, client_data["files_to_send"])
                 del self.clients[client_ip]
+                self.rate_limiter.remove_client(client_ip)
+                self.scheduler.forget(client_ip)
                 if not is_shutdown:
                     self.client_disconnected.emit(client_ip)
                     self.status_update.emit(f"Client {client_ip} disconnected", "red")
@@ -863,124 +1079,337 @@ class NetworkServer(QObject):
                 print(f"Error cleaning up client data for {client_ip}: {e}")
             print(f"Disconnected client {client_ip}")
 
-    def send_file(self, client_ip, file_path):
+    def set_file_priority(self, file_path, priority):
+        """Send file_path with this scheduler.PRIORITY_* level, including copies already queued."""
+        self.file_priorities[file_path] = priority
+        for client_data in list(self.clients.values()):
+            client_data["files_to_send"].reprioritize(lambda f: f["file_path"] == file_path, priority)
+
+    def send_batch(self, client_ip, file_paths, priority=None, tree=None):
+        """
+        Queue small files as batches (see network/batch.py): each batch is one
+        transfer with one ACK. Clients that cannot unpack batches get the files
+        one by one. tree is the synced tree the files belong to, if any.
+        """
+        client_data = self.clients.get(client_ip)
+        if not client_data:
+            print(f"Client {client_ip} not connected.")
+            self.status_update.emit(f"Client {client_ip} not connected", "red")
+            return
+        if not client_data["batch"] or client_data["framing"] < framing.FRAMING_VERSION:
+            for file_path in file_paths:
+                self.send_file(client_ip, file_path, priority=priority, tree=tree)
+            return
+        batches = batch.plan_batches(file_paths)
+        for paths, total_size in batches:
+            client_data["files_to_send"].push({
+                "file_path": None,
+                "file_name": f"{len(paths)} small files",
+                "file_size": total_size,
+                "sent_bytes": 0,
+                "batch": paths, # Read and indexed when the batch is sent
+                "tree": tree,
+                "fanout": None,
+                "priority": priority if priority is not None else PRIORITY_NORMAL
+            })
+        self.status_update.emit(f"Queued {len(file_paths)} small files for {client_ip} in {len(batches)} batch(es)", "blue")
+        print(f"Queued {len(file_paths)} small files for {client_ip} in {len(batches)} batch(es)")
+        self._schedule_file_queue(client_ip)
+
+    def request_batch_status(self, client_ip):
+        """Ask a client for the per-file results of the batches it received recently."""
+        return self._send_control_message(client_ip, {"type": "BATCH_STATUS_REQUEST"}, timeout=5)
+
+    def _batchable_paths(self, file_paths):
+        """The small files among file_paths, if there are enough of them to be worth batching."""
+        small = []
+        for path in file_paths:
+            try:
+                if os.path.isfile(path) and os.path.getsize(path) <= protocol.BATCH_MAX_FILE_SIZE:
+                    small.append(path)
+            except OSError:
+                continue
+        return small if len(small) >= protocol.BATCH_MIN_FILES else []
+
+    def _queue_files(self, client_ip, file_paths):
+        """send_file() each path, batching the small ones when there are enough of them."""
+        batched = self._batchable_paths(file_paths)
+        for file_path in file_paths:
+            if file_path not in batched:
+                self.send_file(client_ip, file_path)
+        if batched:
+            self.send_batch(client_ip, batched)
+
+    def sync_tree(self, tree_root, client_ips=None):
+        """
+        Sync a directory tree to clients (see network/manifest.py): the manifest is
+        built, reusing cached hashes of unchanged files, and each client is sent
+        only the files it is missing or holds an older version of.
+        """
+        if not os.path.isdir(tree_root):
+            self.status_update.emit(f"Folder not found: {tree_root}", "red")
+            return
+        client_ips = [ip for ip in (client_ips if client_ips is not None else list(self.clients)) if ip in self.clients]
+        if not client_ips:
+            self.status_update.emit("No active clients to sync to.", "orange")
+            return
+        threading.Thread(target=self._run_tree_sync, args=(tree_root, client_ips), daemon=True).start()
+
+    def _run_tree_sync(self, tree_root, client_ips):
+        tree_name = os.path.basename(os.path.normpath(tree_root))
+        self.status_update.emit(f"Building manifest of {tree_name}", "blue")
+        started = time.time()
+        entries = manifest.build_manifest(tree_root, self._content_hash)
+        print(f"Manifest of {tree_name}: {len(entries)} files in {time.time() - started:.1f}s")
+        tree = {"id": random.getrandbits(32), "root": tree_root, "name": tree_name,
+                "entries": entries, "pending": set(client_ips)}
+        # A newer sync of the same tree replaces any still running; files already queued keep their old tree id
+        for old_id, old in list(self.tree_syncs.items()):
+            if old["root"] == tree_root:
+                tree["pending"] |= {ip for ip in old["pending"] if ip in self.clients}
+                self.tree_syncs.pop(old_id, None)
+        self.tree_syncs[tree["id"]] = tree
+        for client_ip in list(tree["pending"]):
+            self.file_transfer_states[client_ip].pop(tree_name, None) # Completed again by TREE_SYNCED
+            self._offer_trees(client_ip, [tree])
+
+    def _offer_trees(self, client_ip, trees):
+        """Send each tree's manifest to a client, which answers with TREE_NEED."""
+        for tree in trees:
+            parts = manifest.split_manifest(tree["entries"], protocol.TREE_MANIFEST_PART_ENTRIES)
+            for number, entries in enumerate(parts):
+                if not self._send_control_message(client_ip, {"type": "TREE_MANIFEST", "tree_id": tree["id"],
+                                                              "tree_name": tree["name"], "part": number,
+                                                              "parts": len(parts), "entries": entries}):
+                    return
+            self.status_update_received.emit(tree["name"], client_ip, "Comparing")
+            print(f"Sent manifest of {tree['name']} ({len(tree['entries'])} files) to {client_ip}")
+
+    def _queue_tree_files(self, client_ip, message):
+        """TREE_NEED: queue the tree files a client is missing, batching the small ones."""
+        tree = self.tree_syncs.get(message.get("tree_id"))
+        if not tree or client_ip not in self.clients:
+            return
+        entries = tree["entries"]
+        indexes = [i for i in message.get("indexes") or [] if isinstance(i, int) and 0 <= i < len(entries)]
+        if not indexes:
+            print(f"{client_ip} already has every file of {tree['name']}")
+            return
+        needed_bytes = sum(entries[i]["size"] for i in indexes)
+        print(f"{client_ip} needs {len(indexes)} of {len(entries)} files of {tree['name']} ({needed_bytes} bytes)")
+        self.status_update.emit(f"Syncing {len(indexes)} of {len(entries)} files of {tree['name']} to {client_ip}", "blue")
+        self.status_update_received.emit(tree["name"], client_ip, f"Syncing {len(indexes)} files")
+        paths = [manifest.source_path(tree["root"], entries[i]["path"]) for i in indexes]
+        queued = {"id": tree["id"], "name": tree["name"], "root": tree["root"]}
+        batched = self._batchable_paths(paths)
+        batched_set = set(batched)
+        for file_path in paths:
+            if file_path not in batched_set:
+                self.send_file(client_ip, file_path, tree=queued)
+        if batched:
+            self.send_batch(client_ip, batched, tree=queued)
+
+    def send_file(self, client_ip, file_path, fanout=None, priority=None, tree=None):
         if client_ip not in self.clients:
             print(f"Client {client_ip} not connected.")
             self.status_update.emit(f"Client {client_ip} not connected", "red")
+            if fanout:
+                fanout.release(client_ip)
             return
 
         if not os.path.exists(file_path):
             print(f"File not found: {file_path}")
             self.status_update.emit(f"File not found: {file_path}", "red")
+            if fanout:
+                fanout.release(client_ip)
             return
 
         file_name = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
-        client_socket = self.clients[client_ip]["socket"]
 
         # Add to queue for this client
-        self.clients[client_ip]["files_to_send"].append({
+        self.clients[client_ip]["files_to_send"].push({
             "file_path": file_path,
             "file_name": file_name,
             "file_size": file_size,
+            "file_mtime": os.path.getmtime(file_path), # Lets a reconnecting client's partial copy be matched
             "sent_bytes": 0,
-            "chunks_acked": set() # For chunk-based retransmission (advanced)
+            "chunks_acked": set(), # For chunk-based retransmission (advanced)
+            "fanout": fanout, # Shared single-read ring, None for a private reader
+            "tree": tree, # Synced tree the file belongs to; the client files it at its path in the tree
+            "priority": priority if priority is not None else self.file_priorities.get(file_path, PRIORITY_NORMAL)
         })
         self.status_update.emit(f"Queued {file_name} for {client_ip}", "blue")
         print(f"Queued {file_name} for {client_ip}")
         
         # Start sending if not already sending
-        if not self.clients[client_ip]["current_file_transfer"]:
-            threading.Thread(target=self._process_file_queue, args=(client_ip,), daemon=True).start()
+        self._schedule_file_queue(client_ip)
+
+    def _schedule_file_queue(self, client_ip):
+        """
+        Hand the client's queue to the transfer pool: one worker, or up to
+        MULTIPLEX_STREAMS for a client that takes several files at once.
+        """
+        client_data = self.clients.get(client_ip)
+        if not client_data or not self.transfer_pool:
+            return
+        limit = protocol.MULTIPLEX_STREAMS if client_data["framing"] >= framing.MULTIPLEX_FRAMING else 1
+        with client_data["queue_lock"]:
+            pending = len(client_data["transfers"]) + len(client_data["files_to_send"])
+            wanted = min(limit, max(1, pending)) - client_data["queue_workers"]
+            if wanted <= 0:
+                return
+            client_data["queue_workers"] += wanted
+        for _ in range(wanted):
+            try:
+                self.transfer_pool.submit(self._process_file_queue, client_ip)
+            except RuntimeError:
+                with client_data["queue_lock"]:
+                    client_data["queue_workers"] -= 1 # Pool shut down with the server
 
     def _process_file_queue(self, client_ip):
-        client_data = self.clients[client_ip]
-        while self.running and client_data["files_to_send"]:
-            if client_data["current_file_transfer"]:
-                time.sleep(0.1) # Reduced wait time for faster processing
-                continue
+        client_data = self.clients.get(client_ip)
+        if not client_data:
+            return
+        try:
+            self._drain_file_queue(client_ip, client_data)
+        finally:
+            with client_data["queue_lock"]:
+                client_data["queue_workers"] -= 1
+            # A file queued just before the count dropped would otherwise sit until the next send_file
+            if self.running and client_data["files_to_send"] and self.clients.get(client_ip) is client_data:
+                self._schedule_file_queue(client_ip)
+
+    def _drain_file_queue(self, client_ip, client_data):
+        multiplexed = client_data["framing"] >= framing.MULTIPLEX_FRAMING
+        while self.running:
+            # Next file by priority, once the scheduler grants this client a transfer slot
+            file_info = self.scheduler.acquire(
+                client_ip, client_data["files_to_send"],
+                should_stop=lambda: not self.running or self.clients.get(client_ip) is not client_data)
+            if file_info is None:
+                break
             print(f"[Network] Processing next file for client {client_ip}")
+            # Files in flight together each get a stream id; one at a time they use stream 0
+            stream_id = next(client_data["stream_ids"]) if multiplexed else 0
+            file_info["stream_id"] = stream_id
+            file_info["cancel_event"] = threading.Event()
+            file_info["writer"] = framing.StreamWriter(client_data["socket"], client_data["framing"],
+                                                       client_data["send_lock"], stream_id)
+            client_data["transfers"][stream_id] = file_info
 
-            file_info = client_data["files_to_send"].pop(0) # Get next file from queue
-            client_data["current_file_transfer"] = file_info
-            
             file_path = file_info["file_path"]
             file_name = file_info["file_name"]
             file_size = file_info["file_size"]
-            sent_bytes = file_info["sent_bytes"]
+            parallel = None
+            delta_ops = None
 
             try:
+                if file_info.get("batch"):
+                    self._send_batch(client_ip, client_data, file_info)
+                    continue
+                if file_info.get("repair"):
+                    self._send_repair(client_ip, client_data, file_info)
+                    continue
+
+                sent_bytes = self._resume_offset(client_ip, client_data, file_info)
+                file_info["sent_bytes"] = sent_bytes
+                if sent_bytes:
+                    # The shared ring streams from the start; a resumed client reads privately
+                    self._release_fanout(client_ip, [file_info])
+                    file_info["fanout"] = None
+                    print(f"Resuming {file_name} for {client_ip} at {sent_bytes}/{file_size} bytes")
+                    self.status_update.emit(f"Resuming {file_name} for {client_ip} at {int(sent_bytes * 100 / file_size)}%", "blue")
+
                 # Send file metadata
-                # ensure cancel_event exists and is cleared before metadata so duplicate ACK can set it later
-                if "cancel_event" not in client_data:
-                    client_data["cancel_event"] = threading.Event()
-                client_data["cancel_event"].clear()
                 metadata = {
                     "type": "FILE_METADATA",
                     "file_name": file_name,
                     "file_size": file_size,
+                    "file_mtime": file_info.get("file_mtime"),
                     "scan_result": file_info.get("scan_result", "not_scanned"),
                     "scan_details": file_info.get("scan_details", "File not scanned")
                 }
-                client_data["socket"].sendall(json.dumps(metadata).encode('utf-8') + b'\n')
-                self.status_update.emit(f"Sending metadata for {file_name} to {client_ip}", "orange")
-                print(f"Sending metadata for {file_name} to {client_ip}")
-                time.sleep(0.05) # Brief pause to let client process metadata
-                # Check for cancellation only, allow duplicates
-                if client_data["cancel_event"].is_set():
-                    self.status_update_received.emit(file_name, client_ip, "Cancelled")
-                    self.status_update.emit(f"Cancelled: {file_name} to {client_ip}", "red")
-                    client_data["current_file_transfer"] = None
-                    continue
+                tree = file_info.get("tree")
+                if tree:
+                    metadata["tree"] = {"id": tree["id"], "name": tree["name"],
+                                        "path": os.path.relpath(file_path, tree["root"]).replace(os.sep, "/")}
+                if sent_bytes:
+                    metadata["resume_offset"] = sent_bytes
+                else:
+                    if client_data.get("dedup"):
+                        digest = self._content_hash(file_path)
+                        if digest:
+                            metadata["sha256"] = digest
+                    parallel = self._open_parallel_streams(client_ip, client_data, file_info)
+                if (not sent_bytes and not parallel and client_data["integrity"]
+                        and client_data["framing"] >= framing.FRAMING_VERSION):
+                    # A FILE_DIGEST trailer follows the body; the client verifies as it writes
+                    metadata["digest"] = {"chunk_size": self.hash_cache.chunk_size}
+                    file_info["digest"] = self.hash_cache.peek(file_path)
+                    if file_info["digest"] is None:
+                        # Not hashed yet: take the digests from the bytes as they are read for sending
+                        file_info["hasher"] = TreeHasher(self.hash_cache.chunk_size)
+                if parallel:
+                    # The body goes over the data connections; nothing follows on the command channel
+                    metadata["parallel"] = {
+                        "transfer_id": parallel.transfer_id,
+                        "streams": len(parallel.sockets),
+                        "segment_size": parallel.segment_size
+                    }
+                if "sha256" in metadata:
+                    # The client looks the hash up before any body bytes flow
+                    self.status_update.emit(f"Sending metadata for {file_name} to {client_ip}", "orange")
+                    reply = self._request_file_reply(client_ip, client_data, file_info, metadata)
+                    if reply and reply.get("type") == "FILE_HAVE":
+                        print(f"{client_ip} already has {file_name}; nothing to send")
+                        self.file_progress.emit(file_name, client_ip, 100)
+                        self.status_update.emit(f"{client_ip} already has {file_name}", "lightblue")
+                        continue
+                    if file_info.get("rejected"):
+                        continue
+                    if reply and reply.get("delta"):
+                        # The client holds an older version and expects the body on this channel
+                        if parallel:
+                            parallel.close()
+                            parallel = None
+                        delta_ops = self._plan_delta(client_ip, client_data, file_info, reply["delta"])
+                # Metadata and raw body must not interleave with other writers on this socket
+                with self._channel_lock(client_data, file_info):
+                    if "sha256" not in metadata:
+                        file_info["writer"].send_message(metadata)
+                        self.status_update.emit(f"Sending metadata for {file_name} to {client_ip}", "orange")
+                        print(f"Sending metadata for {file_name} to {client_ip}")
+                    # Check for cancellation only, allow duplicates
+                    if file_info["cancel_event"].is_set():
+                        self.status_update_received.emit(file_name, client_ip, "Cancelled")
+                        self.status_update.emit(f"Cancelled: {file_name} to {client_ip}", "red")
+                        continue
 
-                with open(file_path, 'rb') as f:
-                    f.seek(sent_bytes) # Resume from where it left off if needed
-                    cancelled = False
-                    buffer_size = 0
-                    last_progress_update = time.time()
-                    
-                    while sent_bytes < file_size and self.running:
-                        if client_data["cancel_event"].is_set():
-                            cancelled = True
-                            break
-                            
-                        # Determine chunk size based on remaining buffer space
-                        remaining_buffer = MAX_MEMORY_BUFFER - buffer_size
-                        current_chunk_size = min(CHUNK_SIZE, remaining_buffer)
-                        
-                        chunk = f.read(current_chunk_size)
-                        if not chunk:
-                            break
-                            
-                        try:
-                            client_data["socket"].sendall(chunk)
-                            chunk_size = len(chunk)
-                            sent_bytes += chunk_size
-                            buffer_size += chunk_size
-                            
-                            # Update progress every 0.5 seconds to reduce UI load
-                            current_time = time.time()
-                            if current_time - last_progress_update >= 0.5:
-                                percentage = int((sent_bytes / file_size) * 100)
-                                self.file_progress.emit(file_name, client_ip, percentage)
-                                last_progress_update = current_time
-                            
-                            self.file_transfer_states[client_ip][file_name].update({
-                                "sent_bytes": sent_bytes,
-                                "total_bytes": file_size,
-                                "last_activity": time.time()
-                            })
-                            
-                            # Memory management: if buffer is full, wait for network to catch up
-                            if buffer_size >= MAX_MEMORY_BUFFER * 0.8:  # 80% full
-                                time.sleep(0.1)  # Brief pause to allow network to catch up
-                                buffer_size = 0  # Reset buffer tracking
-                        except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
-                            print(f"Socket error during chunk send to {client_ip}: {e}")
-                            cancelled = True
-                            break
-
-                if cancelled:
+                    if not parallel:
+                        with open(file_path, 'rb') as f:
+                            codec = self._compression_for(client_data, file_info) if delta_ops is None else None
+                            if delta_ops is not None:
+                                sent_bytes, cancelled = self._stream_file_delta(client_ip, client_data, file_info, f, delta_ops)
+                            elif codec:
+                                sent_bytes, cancelled = self._stream_file_compressed(client_ip, client_data, file_info, f, sent_bytes, codec)
+                            elif file_info.get("fanout"):
+                                sent_bytes, cancelled = self._stream_file_fanout(client_ip, client_data, file_info, f, sent_bytes)
+                            elif ZERO_COPY_ENABLED and not file_info.get("hasher"):
+                                sent_bytes, cancelled = self._stream_file_zero_copy(client_ip, client_data, file_info, f, sent_bytes)
+                            else:
+                                sent_bytes, cancelled = self._stream_file_buffered(client_ip, client_data, file_info, f, sent_bytes)
+                        if not cancelled and "digest" in metadata:
+                            self._send_file_digest(client_ip, client_data, file_info)
+
+                if parallel:
+                    sent_bytes, cancelled = self._stream_file_parallel(client_ip, client_data, file_info, parallel)
+                    if cancelled is None:
+                        continue # Requeued for the command channel
+
+                if cancelled and file_info.get("rejected"):
+                    print(f"Stopped sending {file_name} to {client_ip}: {file_info['rejected']}")
+                elif cancelled:
                     print(f"Transfer of {file_name} to {client_ip} cancelled.")
                     self.status_update_received.emit(file_name, client_ip, "Cancelled")
                     self.status_update.emit(f"Cancelled transfer of {file_name} to {client_ip}", "red")
@@ -996,20 +1425,827 @@ class NetworkServer(QObject):
                 print(f"Client {client_ip} disconnected during transfer of {file_name}.")
                 self.status_update_received.emit(file_name, client_ip, "Not Sent (Client Disconnected)")
                 self.status_update.emit(f"Client {client_ip} disconnected during {file_name} transfer", "red")
-                self._disconnect_client(client_ip)
+                if self.clients.get(client_ip) is client_data:
+                    self._disconnect_client(client_ip)
                 break # Exit loop for this client
             except OSError:
                 print(f"Socket error sending {file_name} to {client_ip}; disconnecting client.")
                 self.status_update_received.emit(file_name, client_ip, "Not Sent (Socket Error)")
                 self.status_update.emit(f"Socket error during {file_name} to {client_ip}", "red")
-                self._disconnect_client(client_ip)
+                if self.clients.get(client_ip) is client_data:
+                    self._disconnect_client(client_ip)
+                break
+            except framing.FramingError as e:
+                # A short DATA frame leaves the client unable to parse the rest of the stream
+                print(f"Aborting stream to {client_ip}: {e}")
+                self.status_update_received.emit(file_name, client_ip, "Not Sent (File Changed)")
+                self.status_update.emit(f"{file_name} changed while sending to {client_ip}", "red")
+                if self.clients.get(client_ip) is client_data:
+                    self._disconnect_client(client_ip)
                 break
             except Exception:
                 print(f"Unexpected error sending {file_name} to {client_ip}; marking as not sent.")
                 self.status_update_received.emit(file_name, client_ip, "Not Sent (Unexpected Error)")
                 self.status_update.emit(f"Error sending {file_name} to {client_ip}", "red")
             finally:
-                client_data["current_file_transfer"] = None # Reset for next file
+                if parallel:
+                    parallel.close()
+                self._release_fanout(client_ip, [file_info])
+                self.scheduler.release(client_ip, file_info.get("sent_bytes", 0))
+                client_data["transfers"].pop(stream_id, None)
+
+    def _send_batch(self, client_ip, client_data, batch_info):
+        """
+        Stream one batch of small files as BATCH_START, packed DATA frames and
+        BATCH_END. The client answers with a single BATCH_ACK; files that changed
+        while being read are announced with BATCH_SKIP and queued on their own.
+        """
+        tree = batch_info.get("tree")
+        paths, entries = batch.build_index(batch_info["batch"], tree["root"] if tree else None)
+        if not entries:
+            return
+        batch_id = random.getrandbits(32)
+        batch_info["transfer_id"] = batch_id # Carried by CANCEL_TRANSFER so the client drops the batch
+        writer = batch_info["writer"]
+        packer = batch.BatchPacker(paths, entries)
+        sent = {"entries": entries, "changed": set()}
+        client_data["batches"][batch_id] = sent
+        print(f"Sending {len(entries)} files to {client_ip} as batch {batch_id}")
+        self.status_update.emit(f"Sending {len(entries)} files to {client_ip} as one batch", "orange")
+        skipped = 0
+        progressed = 0
+        with self._channel_lock(client_data, batch_info):
+            start = {"type": "BATCH_START", "batch_id": batch_id, "files": entries}
+            if tree:
+                start["tree"] = {"id": tree["id"], "name": tree["name"]}
+            writer.send_message(start)
+            for block in packer.blocks():
+                if (batch_info["cancel_event"].is_set() or not self.running
+                        or not self._throttle(client_ip, batch_info, len(block))):
+                    client_data["batches"].pop(batch_id, None)
+                    for entry in entries[progressed:]:
+                        self.status_update_received.emit(entry["file_name"], client_ip, "Cancelled")
+                    print(f"Batch {batch_id} to {client_ip} cancelled.")
+                    return
+                if len(packer.changed) > skipped:
+                    # Announced before the padded bytes arrive, so the client never files them
+                    writer.send_message({"type": "BATCH_SKIP", "batch_id": batch_id,
+                                         "indexes": packer.changed[skipped:]})
+                    skipped = len(packer.changed)
+                writer.send_data(block)
+                batch_info["sent_bytes"] += len(block)
+                for entry in entries[progressed:packer.files_done]:
+                    self.file_progress.emit(entry["file_name"], client_ip, 100)
+                progressed = packer.files_done
+            writer.send_message({"type": "BATCH_END", "batch_id": batch_id})
+        for index in packer.changed:
+            sent["changed"].add(entries[index]["file_name"])
+            print(f"{entries[index]['file_name']} changed while batching; sending it on its own")
+            self.send_file(client_ip, paths[index], tree=tree)
+        for entry in entries:
+            if entry["file_name"] not in sent["changed"]:
+                self.status_update_received.emit(entry["file_name"], client_ip, "Sent - Awaiting ACK")
+
+    def _send_file_digest(self, client_ip, client_data, file_info):
+        """
+        Send the FILE_DIGEST trailer after a body: the file's SHA-256 and chunk
+        digests, from the hash cache or taken while the body was read.
+        """
+        file_path = file_info["file_path"]
+        hashes = file_info.get("digest")
+        hasher = file_info.get("hasher")
+        if hashes is None and hasher and hasher.size == file_info["file_size"]:
+            root, chunks = hasher.digests()
+            hashes = TreeHashes(root, hasher.chunk_size, chunks)
+        if hashes is None:
+            # Parts of the body never passed through user space (delta copies)
+            try:
+                hashes = self.hash_cache.get(file_path)
+            except OSError as e:
+                print(f"Could not hash {file_path} for the digest trailer: {e}")
+                return
+        file_info["writer"].send_message({
+            "type": "FILE_DIGEST",
+            "file_name": file_info["file_name"],
+            "sha256": hashes.root,
+            "chunk_size": hashes.chunk_size,
+            "chunks": hashes.chunks
+        })
+        client_data["digests_sent"][file_info["file_name"]] = file_info
+
+    def _queue_repair(self, client_ip, message):
+        """RANGE_REQUEST: queue the corrupt ranges of a file the client checked against FILE_DIGEST."""
+        client_data = self.clients.get(client_ip)
+        file_name = message.get("file_name")
+        sent = client_data["digests_sent"].get(file_name) if client_data else None
+        if not sent:
+            print(f"{client_ip} asked to repair {file_name}, which is not awaiting verification")
+            return
+        file_size = sent["file_size"]
+        ranges = []
+        for item in message.get("ranges") or []:
+            try:
+                offset, length = int(item[0]), int(item[1])
+            except (TypeError, ValueError, IndexError):
+                continue
+            if 0 <= offset and 0 < length and offset + length <= file_size:
+                ranges.append((offset, length))
+        if not ranges:
+            return
+        repair_bytes = sum(length for _, length in ranges)
+        print(f"{client_ip} found {file_name} corrupt; resending {len(ranges)} range(s), {repair_bytes} bytes")
+        self.status_update.emit(f"Repairing {file_name} on {client_ip}", "orange")
+        client_data["files_to_send"].push({
+            "file_path": sent["file_path"],
+            "file_name": file_name,
+            "file_size": repair_bytes,
+            "sent_bytes": 0,
+            "fanout": None,
+            "tree": sent.get("tree"),
+            "repair": {"id": message.get("repair_id"), "ranges": ranges},
+            "priority": PRIORITY_URGENT # The client holds the rest of the file open meanwhile
+        })
+        self._schedule_file_queue(client_ip)
+
+    def _send_repair(self, client_ip, client_data, repair_info):
+        """Resend byte ranges of a file, each as FILE_REPAIR followed by its DATA frames."""
+        repair = repair_info["repair"]
+        file_name = repair_info["file_name"]
+        writer = repair_info["writer"]
+        with self._channel_lock(client_data, repair_info), open(repair_info["file_path"], 'rb') as f:
+            for offset, length in repair["ranges"]:
+                writer.send_message({"type": "FILE_REPAIR", "repair_id": repair["id"], "file_name": file_name,
+                                     "offset": offset, "length": length})
+                end = offset + length
+                while offset < end:
+                    block_size = self._slice_size(client_ip, repair_info)
+                    count = min(self.rate_limiter.slice_size(client_ip, block_size), end - offset)
+                    if (repair_info["cancel_event"].is_set() or not self.running
+                            or not self._throttle(client_ip, repair_info, count)):
+                        print(f"Repair of {file_name} for {client_ip} cancelled.")
+                        return
+                    sent = self._sendfile_slice(client_ip, writer, f, offset, count, block_size)
+                    offset += sent
+                    repair_info["sent_bytes"] += sent
+        print(f"Resent {repair_info['file_size']} bytes of {file_name} to {client_ip}")
+        self.status_update_received.emit(file_name, client_ip, "Sent - Awaiting ACK")
+
+    def _content_hash(self, file_path):
+        """Content hash (tree-hash root) of a file being distributed, from the persistent hash cache; None if unreadable."""
+        try:
+            return self.hash_cache.file_hash(file_path)
+        except OSError as e:
+            print(f"Could not hash {file_path}: {e}")
+            return None
+
+    def _request_file_reply(self, client_ip, client_data, file_info, metadata):
+        """
+        Send hashed FILE_METADATA and wait for the client's FILE_HAVE or FILE_NEED.
+        Each FILE_PREPARING from the client extends the wait by DEDUP_REPLY_TIMEOUT.
+        Returns the reply message, or None on cancel or timeout (the body is then sent).
+        """
+        file_name = metadata["file_name"]
+        stream_id = file_info["stream_id"]
+        waiter = {"event": threading.Event(), "reply": None, "deadline": time.time() + DEDUP_REPLY_TIMEOUT}
+        client_data["file_replies"][stream_id] = waiter
+        try:
+            with self._channel_lock(client_data, file_info):
+                file_info["writer"].send_message(metadata)
+            print(f"Sending metadata for {file_name} to {client_ip}")
+            while not waiter["event"].wait(0.5):
+                if (file_info["cancel_event"].is_set() or not self.running or time.time() > waiter["deadline"]
+                        or self.clients.get(client_ip) is not client_data):
+                    return None
+            return waiter["reply"]
+        finally:
+            client_data["file_replies"].pop(stream_id, None)
+
+    def _channel_lock(self, client_data, file_info):
+        """
+        Lock to hold around a file's metadata and body. A file on its own stream
+        id interleaves with others frame by frame, so its StreamWriter locks per
+        frame instead.
+        """
+        return contextlib.nullcontext() if file_info["stream_id"] else client_data["send_lock"]
+
+    def _active_transfers(self, client_data, file_name=None, stream=None):
+        """file_infos being sent to a client: the one on stream if given, else those named file_name (None: all)."""
+        transfers = list(client_data["transfers"].values())
+        if stream:
+            return [f for f in transfers if f["stream_id"] == stream]
+        return [f for f in transfers if file_name is None or f["file_name"] == file_name]
+
+    def _plan_delta(self, client_ip, client_data, file_info, signatures):
+        """
+        Delta ops for a file the client holds an older version of (see network/delta.py),
+        or None to send it whole: the delta failed here before, the client speaks the
+        legacy protocol, or too little of the file matches the client's copy.
+        """
+        file_name = file_info["file_name"]
+        if file_name in client_data["no_delta"] or client_data["framing"] < framing.FRAMING_VERSION:
+            return None
+        try:
+            ops = delta.generate_delta(file_info["file_path"], signatures)
+        except (OSError, ValueError) as e:
+            print(f"Could not compute delta of {file_name} for {client_ip}: {e}")
+            return None
+        if ops is None:
+            print(f"{file_name} differs too much from the copy on {client_ip}; sending in full")
+            return None
+        # Ops read the file directly, so the shared ring is not needed
+        self._release_fanout(client_ip, [file_info])
+        file_info["fanout"] = None
+        client_data["delta_sent"][file_name] = file_info
+        literal = delta.literal_size(ops)
+        print(f"Sending {file_name} to {client_ip} as a delta: {literal} of {file_info['file_size']} bytes literal")
+        return ops
+
+    def _compression_for(self, client_data, file_info):
+        """(codec, level) to compress this file's body with, or None to send it raw."""
+        if not self.compression or client_data["framing"] < framing.FRAMING_VERSION:
+            return None
+        if self.compression[0] not in client_data.get("compression", []):
+            return None
+        if file_info["file_size"] - file_info.get("sent_bytes", 0) < protocol.COMPRESSION_MIN_SIZE:
+            return None
+        if not compression.compressible(file_info["file_name"]):
+            return None
+        return self.compression
+
+    def _open_parallel_streams(self, client_ip, client_data, file_info):
+        """
+        Connected ParallelSender for a large file if multi-stream transfer is enabled
+        and the client listens for data connections; None to use the command channel.
+        """
+        port = client_data.get("parallel_port")
+        if not self.parallel_enabled or not port or file_info["file_size"] < protocol.PARALLEL_MIN_FILE_SIZE:
+            return None
+        tuner = self.parallel_tuners.setdefault(client_ip, StreamTuner())
+        streams = min(tuner.streams, client_data.get("max_streams") or 1)
+        if streams < 2:
+            return None
+        sender = ParallelSender(client_ip, port, random.getrandbits(32), file_info["file_path"],
+                                file_info["file_size"], protocol.PARALLEL_SEGMENT_SIZE, streams)
+        try:
+            sender.connect()
+        except OSError as e:
+            print(f"Data connections to {client_ip} unavailable ({e}); using the command channel")
+            client_data["parallel_port"] = None
+            return None
+        # Each stream reads the file itself, so the shared ring is not needed
+        self._release_fanout(client_ip, [file_info])
+        file_info["fanout"] = None
+        file_info["transfer_id"] = sender.transfer_id
+        return sender
+
+    def _stream_file_parallel(self, client_ip, client_data, file_info, sender):
+        """
+        Send the file body over the client's data connections and feed the measured
+        throughput to the client's StreamTuner. Returns (sent_bytes, cancelled), with
+        cancelled None if the streams failed and the file was requeued for the
+        command channel.
+        """
+        file_name = file_info["file_name"]
+        last_progress_update = [time.time()]
+
+        def on_progress(sent_bytes):
+            last_progress_update[0] = self._record_send_progress(client_ip, file_info, sent_bytes,
+                                                                 last_progress_update[0])
+
+        started = time.time()
+        try:
+            sent_bytes, cancelled = sender.run(
+                is_cancelled=lambda: file_info["cancel_event"].is_set() or not self.running,
+                progress_callback=on_progress,
+                throttle=lambda nbytes: self._throttle(client_ip, file_info, nbytes),
+                slice_size=lambda: self.rate_limiter.slice_size(client_ip, SENDFILE_BLOCK_SIZE))
+        except OSError as e:
+            print(f"Parallel transfer of {file_name} to {client_ip} failed: {e}; resending on the command channel")
+            self._send_control_message(client_ip, {"type": "CANCEL_TRANSFER", "file_name": file_name,
+                                                   "transfer_id": sender.transfer_id, "retry": True})
+            client_data["parallel_port"] = None
+            file_info.update({"sent_bytes": 0, "transfer_id": None})
+            client_data["files_to_send"].push(file_info)
+            return 0, None
+        if not cancelled:
+            self.parallel_tuners[client_ip].record(sender.streams, sent_bytes, time.time() - started)
+            print(f"Sent {file_name} to {client_ip} over {sender.streams} streams")
+        return sent_bytes, cancelled
+
+    def _resume_offset(self, client_ip, client_data, file_info):
+        """
+        Offset to continue file_info from, if the client reported a partial copy at
+        connect time whose last block matches our file. 0 means send everything.
+        """
+        partial = client_data.get("partials", {}).pop((file_info["file_name"], file_info["file_size"]), None)
+        if not partial:
+            return 0
+        offset = partial.get("offset", 0)
+        if not isinstance(offset, int) or not 0 < offset < file_info["file_size"]:
+            return 0
+        if partial.get("file_mtime") != file_info.get("file_mtime"):
+            return 0
+        try:
+            if tail_hash(file_info["file_path"], offset) != partial.get("tail_hash"):
+                print(f"Partial copy of {file_info['file_name']} on {client_ip} differs; sending in full")
+                return 0
+        except (OSError, ValueError):
+            return 0
+        return offset
+
+    def _send_control_message(self, client_ip, message, timeout=None):
+        """
+        Send one control message on the command channel without interleaving with a
+        file body being streamed by _process_file_queue. Returns True if sent.
+        """
+        client_data = self.clients.get(client_ip)
+        if not client_data or not client_data.get("socket"):
+            return False
+        lock = client_data["send_lock"]
+        if not lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        try:
+            client_data["socket"].sendall(framing.encode_message(message, client_data["framing"]))
+            return True
+        except Exception as e:
+            print(f"Failed to send {message.get('type')} to {client_ip}: {e}")
+            return False
+        finally:
+            lock.release()
+
+    def _run_multicast_distribution(self, files, client_ips):
+        """Multicast files one after another so they do not compete for the group bandwidth."""
+        for file_info in files:
+            if not self.running:
+                break
+            try:
+                self._run_multicast_session(file_info, client_ips)
+            except Exception as e:
+                print(f"Multicast of {file_info.get('name')} failed: {e}")
+                self.status_update.emit(f"Multicast of {file_info.get('name')} failed, using unicast: {e}", "orange")
+                for client_ip in client_ips:
+                    self.send_file(client_ip, file_info["path"])
+
+    def _run_multicast_session(self, file_info, client_ips):
+        """
+        Offer one file to the clients, push it once to the multicast group, then run
+        NACK/repair rounds over each client's command channel. Clients that cannot
+        join or do not complete within MULTICAST_REPAIR_ROUNDS get a unicast copy.
+        """
+        file_path = file_info["path"]
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        transfer_id = random.getrandbits(32)
+        session = MulticastSession(transfer_id, file_info, client_ips)
+        self.multicast_sessions[transfer_id] = session
+        try:
+            offer = {
+                "type": "MULTICAST_OFFER",
+                "transfer_id": transfer_id,
+                "file_name": file_name,
+                "file_size": file_size,
+                "group": protocol.MULTICAST_GROUP,
+                "port": protocol.MULTICAST_PORT,
+                "scan_result": file_info.get("scan_result", "not_scanned"),
+                "scan_details": file_info.get("scan_details", "File not scanned")
+            }
+            offered = [ip for ip in client_ips
+                       if self._send_control_message(ip, offer, timeout=protocol.MULTICAST_JOIN_TIMEOUT)]
+            session.client_ips = set(offered)
+            joined = session.wait_for_joins(protocol.MULTICAST_JOIN_TIMEOUT)
+            for client_ip in set(client_ips) - joined:
+                self.send_file(client_ip, file_path)
+            if not joined:
+                return
+
+            self.status_update.emit(f"Multicasting {file_name} to {len(joined)} clients", "orange")
+            for client_ip in joined:
+                self.status_update_received.emit(file_name, client_ip, "Multicasting")
+
+            def on_progress(sent_bytes):
+                percentage = int((sent_bytes / file_size) * 100) if file_size else 100
+                for ip in joined:
+                    self.file_progress.emit(file_name, ip, percentage)
+                    self.file_transfer_states[ip][file_name].update({
+                        "sent_bytes": sent_bytes,
+                        "total_bytes": file_size,
+                        "last_activity": time.time()
+                    })
+
+            sender = MulticastSender(interface_ip=self.server_ip, rate_limit=self._multicast_rate())
+            self.multicast_senders.add(sender)
+            try:
+                sender.send_file(transfer_id, file_path, file_size, progress_callback=on_progress)
+            finally:
+                self.multicast_senders.discard(sender)
+                sender.close()
+
+            # NACK/repair rounds over the TCP command channels
+            pending = set(joined)
+            end_msg = {"type": "MULTICAST_END", "transfer_id": transfer_id, "file_name": file_name}
+            for _ in range(protocol.MULTICAST_REPAIR_ROUNDS):
+                pending = {ip for ip in pending if ip in self.clients and ip not in session.complete}
+                if not pending:
+                    break
+                for client_ip in pending:
+                    self._send_control_message(client_ip, end_msg)
+                nacks = session.wait_for_reports(pending, protocol.ACK_TIMEOUT * 6)
+                for client_ip, ranges in nacks.items():
+                    self._send_multicast_repair(client_ip, transfer_id, file_path, ranges)
+            pending = {ip for ip in pending if ip in self.clients and ip not in session.complete}
+            for client_ip in pending:
+                print(f"Multicast of {file_name} incomplete for {client_ip}; falling back to unicast")
+                self._send_control_message(client_ip, {"type": "CANCEL_TRANSFER", "file_name": file_name,
+                                                       "transfer_id": transfer_id})
+                self.send_file(client_ip, file_path)
+        finally:
+            self.multicast_sessions.pop(transfer_id, None)
+
+    def _multicast_rate(self):
+        """Multicast pace: MULTICAST_RATE_LIMIT, or the global bandwidth limit if that is lower."""
+        global_rate = self.rate_limiter.global_rate
+        return min(protocol.MULTICAST_RATE_LIMIT, global_rate) if global_rate else protocol.MULTICAST_RATE_LIMIT
+
+    def _send_multicast_repair(self, client_ip, transfer_id, file_path, ranges):
+        """
+        Unicast the byte ranges a client reported missing, in slices the bandwidth
+        scheduler allows, each as a MULTICAST_REPAIR message plus payload.
+        """
+        client_data = self.clients.get(client_ip)
+        if not client_data:
+            return
+        with client_data["send_lock"]:
+            try:
+                with open(file_path, 'rb') as f:
+                    for start, end in ranges:
+                        while start < end:
+                            count = min(self.rate_limiter.slice_size(client_ip, SENDFILE_BLOCK_SIZE), end - start)
+                            if not self.rate_limiter.throttle(client_ip, count, lambda: not self.running):
+                                return
+                            header = {"type": "MULTICAST_REPAIR", "transfer_id": transfer_id,
+                                      "offset": start, "length": count}
+                            client_data["socket"].sendall(framing.encode_message(header, client_data["framing"]))
+                            sent = framing.sendfile_data(client_data["socket"], f, start, count, client_data["framing"])
+                            if not sent:
+                                return  # File shrank underneath us
+                            start += sent
+            except (OSError, ValueError) as e:
+                print(f"Multicast repair to {client_ip} failed: {e}")
+
+    def _run_swarm_distribution(self, files, client_ips):
+        """Distribute files one after another through peer-assisted swarms."""
+        for file_info in files:
+            if not self.running:
+                break
+            try:
+                self._run_swarm_session(file_info, client_ips)
+            except Exception as e:
+                print(f"Swarm distribution of {file_info.get('name')} failed: {e}")
+                self.status_update.emit(f"Swarm of {file_info.get('name')} failed, using unicast: {e}", "orange")
+                for client_ip in client_ips:
+                    self.send_file(client_ip, file_info["path"])
+
+    def _run_swarm_session(self, file_info, client_ips):
+        """
+        Track one swarm: seed the original file, hand out peer lists, and wait until
+        every joined client holds the whole file. Clients that cannot join, or
+        stall for SWARM_STALL_TIMEOUT, fall back to a unicast copy.
+        """
+        file_path = file_info["path"]
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        # Clients verify every chunk they get from a peer against these
+        hashes = self.hash_cache.get(file_path)
+        if hashes.chunk_size != protocol.SWARM_CHUNK_SIZE:
+            hashes = hashing.hash_file(file_path, protocol.SWARM_CHUNK_SIZE)
+        if self.swarm_seed is None:
+            self.swarm_seed = SwarmPeerServer(throttle=lambda peer_ip, nbytes: self.rate_limiter.throttle(
+                peer_ip, nbytes, lambda: not self.running))
+        swarm_id = random.getrandbits(32)
+        session = SwarmSession(swarm_id, file_info, file_size, self.swarm_seed.port)
+        self.swarm_sessions[swarm_id] = session
+        self.swarm_seed.register(swarm_id, file_path)
+        joined = set()
+        try:
+            offer = {
+                "type": "SWARM_OFFER",
+                "swarm_id": swarm_id,
+                "file_name": file_name,
+                "file_size": file_size,
+                "chunk_size": protocol.SWARM_CHUNK_SIZE,
+                "sha256": hashes.root,
+                "chunks": hashes.chunks,
+                "scan_result": file_info.get("scan_result", "not_scanned"),
+                "scan_details": file_info.get("scan_details", "File not scanned")
+            }
+            offered = [ip for ip in client_ips
+                       if self._send_control_message(ip, offer, timeout=protocol.SWARM_JOIN_TIMEOUT)]
+            joined = session.wait_for_joins(offered, protocol.SWARM_JOIN_TIMEOUT)
+            for client_ip in set(client_ips) - joined:
+                self.send_file(client_ip, file_path)
+            if not joined:
+                return
+
+            self.status_update.emit(f"Swarming {file_name} to {len(joined)} clients", "orange")
+            for client_ip in joined:
+                self.status_update_received.emit(file_name, client_ip, "Swarming")
+
+            session.last_progress = time.time()
+            while self.running:
+                active = {ip for ip in joined if ip in self.clients}
+                if active <= session.complete:
+                    break
+                if time.time() - session.last_progress > protocol.SWARM_STALL_TIMEOUT:
+                    print(f"Swarm for {file_name} stalled")
+                    break
+                session.wait(1.0)
+        finally:
+            end_msg = {"type": "SWARM_END", "swarm_id": swarm_id, "file_name": file_name}
+            for client_ip in joined:
+                self._send_control_message(client_ip, end_msg, timeout=protocol.SWARM_JOIN_TIMEOUT)
+            for client_ip in joined - session.complete:
+                if client_ip in self.clients:
+                    print(f"Swarm of {file_name} incomplete for {client_ip}; falling back to unicast")
+                    self.send_file(client_ip, file_path)
+            self.swarm_seed.unregister(swarm_id)
+            self.swarm_sessions.pop(swarm_id, None)
+
+    def _handle_swarm_message(self, client_ip, message):
+        """Tracker side of the swarm protocol."""
+        msg_type = message.get("type")
+        session = self.swarm_sessions.get(message.get("swarm_id"))
+        if not session:
+            return
+        if msg_type == "SWARM_JOIN":
+            session.join(client_ip, message.get("port"))
+        elif msg_type == "SWARM_REJECT":
+            print(f"Client {client_ip} cannot join swarm: {message.get('reason')}")
+            session.reject(client_ip)
+        elif msg_type == "SWARM_HAVE":
+            covered = session.update_have(client_ip, message.get("ranges", []))
+            file_name = os.path.basename(session.file_info["path"])
+            percentage = int((covered / session.file_size) * 100) if session.file_size else 100
+            self.file_progress.emit(file_name, client_ip, percentage)
+            self.file_transfer_states[client_ip][file_name].update({
+                "sent_bytes": covered,
+                "total_bytes": session.file_size,
+                "last_activity": time.time()
+            })
+        elif msg_type == "SWARM_PEERS_REQUEST":
+            # Runs on the reactor: never wait behind a file body; the client asks again shortly
+            self._send_control_message(client_ip, {
+                "type": "SWARM_PEERS",
+                "swarm_id": session.swarm_id,
+                "peers": session.peer_list(client_ip)
+            }, timeout=0)
+        elif msg_type == "SWARM_COMPLETE":
+            session.mark_complete(client_ip)
+
+    def _record_send_progress(self, client_ip, file_info, sent_bytes, last_progress_update):
+        """Store resume offset and transfer state; emit UI progress at most every 0.5s.
+        Returns the timestamp of the last emitted progress update."""
+        file_name = file_info["file_name"]
+        file_size = file_info["file_size"]
+        file_info["sent_bytes"] = sent_bytes
+        current_time = time.time()
+        if current_time - last_progress_update >= 0.5:
+            percentage = int((sent_bytes / file_size) * 100) if file_size else 100
+            # Chunk size first, so the transfer row shows it with this progress update
+            if file_info.get("chunk_size") and file_info["chunk_size"] != file_info.get("reported_chunk_size"):
+                file_info["reported_chunk_size"] = file_info["chunk_size"]
+                self.file_chunk_size.emit(file_name, client_ip, file_info["chunk_size"])
+            self.file_progress.emit(file_name, client_ip, percentage)
+            last_progress_update = current_time
+        self.file_transfer_states[client_ip][file_name].update({
+            "sent_bytes": sent_bytes,
+            "total_bytes": file_size,
+            "chunk_size": file_info.get("chunk_size"),
+            "last_activity": current_time
+        })
+        return last_progress_update
+
+    def _slice_size(self, client_ip, file_info):
+        """Bytes the client's ChunkSizer wants in the next slice of file_info; noted in file_info for progress."""
+        sizer = self.chunk_sizers.setdefault(client_ip, ChunkSizer())
+        # Multiplexed files share the channel, so no slice may hold it for long
+        file_info["chunk_size"] = sizer.slice_size(MULTIPLEX_BLOCK_SIZE if file_info.get("stream_id") else None)
+        return file_info["chunk_size"]
+
+    def _sendfile_slice(self, client_ip, writer, f, offset, count, block_size):
+        """sendfile_data() one slice and report how long it took to the client's ChunkSizer."""
+        started = time.perf_counter()
+        sent = writer.sendfile_data(f, offset, count)
+        self.chunk_sizers[client_ip].record(block_size, sent, time.perf_counter() - started)
+        return sent
+
+    def _stream_file_fanout(self, client_ip, client_data, file_info, f, sent_bytes):
+        """
+        Stream the file body from the shared FanoutReader ring. If this client
+        lags beyond the ring window it continues from its own offset with a
+        private reader. Returns (sent_bytes, cancelled).
+        """
+        fanout = file_info["fanout"]
+        file_size = file_info["file_size"]
+        last_progress_update = time.time()
+        while sent_bytes < file_size and self.running:
+            if file_info["cancel_event"].is_set():
+                return sent_bytes, True
+            view = fanout.read_chunk(client_ip, sent_bytes)
+            if view is None:
+                fanout.release(client_ip)
+                break
+            if not self._throttle(client_ip, file_info, len(view)):
+                return sent_bytes, True
+            if file_info.get("hasher"):
+                file_info["hasher"].update(view)
+            try:
+                file_info["writer"].send_data(view)
+            except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
+                print(f"Socket error during shared-chunk send to {client_ip}: {e}")
+                return sent_bytes, True
+            sent_bytes += len(view)
+            last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+        else:
+            return sent_bytes, False
+        # Fell out of the shared window: finish with a private reader
+        if ZERO_COPY_ENABLED and not file_info.get("hasher"):
+            return self._stream_file_zero_copy(client_ip, client_data, file_info, f, sent_bytes)
+        return self._stream_file_buffered(client_ip, client_data, file_info, f, sent_bytes)
+
+    def _stream_file_delta(self, client_ip, client_data, file_info, f, ops):
+        """
+        Send the file as DELTA_COPY messages for ranges of the client's older copy and
+        DATA frames of literal bytes, in file order. Returns (sent_bytes, cancelled),
+        where sent_bytes counts bytes of the rebuilt file rather than of the wire.
+        """
+        file_name = file_info["file_name"]
+        writer = file_info["writer"]
+        sent_bytes = 0
+        last_progress_update = time.time()
+        for kind, offset, length in ops:
+            if file_info["cancel_event"].is_set() or not self.running:
+                return sent_bytes, True
+            try:
+                if kind == "copy":
+                    writer.send_message({
+                        "type": "DELTA_COPY", "file_name": file_name, "offset": offset, "length": length
+                    })
+                    sent_bytes += length
+                else:
+                    end = offset + length
+                    while offset < end:
+                        if file_info["cancel_event"].is_set() or not self.running:
+                            return sent_bytes, True
+                        block_size = self._slice_size(client_ip, file_info)
+                        count = min(self.rate_limiter.slice_size(client_ip, block_size), end - offset)
+                        if not self._throttle(client_ip, file_info, count):
+                            return sent_bytes, True
+                        sent = self._sendfile_slice(client_ip, writer, f, offset, count, block_size)
+                        offset += sent
+                        sent_bytes += sent
+                        last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+            except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
+                print(f"Socket error during delta send to {client_ip}: {e}")
+                return sent_bytes, True
+            last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+        return sent_bytes, False
+
+    def _stream_file_compressed(self, client_ip, client_data, file_info, f, sent_bytes, codec):
+        """
+        Stream the file body compressed, between COMPRESSION_START and COMPRESSION_END.
+        If compressing turns out slower than sending raw on this link, the stream is
+        ended early and the rest of the file goes out uncompressed.
+        Returns (sent_bytes, cancelled).
+        """
+        # Compressed output is per client, so the shared ring is not needed
+        self._release_fanout(client_ip, [file_info])
+        file_info["fanout"] = None
+        file_name = file_info["file_name"]
+        file_size = file_info["file_size"]
+        writer = file_info["writer"]
+        compressor = compression.Compressor(*codec)
+        monitor = compression.ThroughputMonitor()
+        f.seek(sent_bytes)
+        last_progress_update = time.time()
+        try:
+            writer.send_message({"type": "COMPRESSION_START", "file_name": file_name, "codec": codec[0]})
+            while sent_bytes < file_size and self.running:
+                if file_info["cancel_event"].is_set():
+                    return sent_bytes, True
+                chunk = f.read(compression.COMPRESSION_BLOCK_SIZE)
+                if not chunk:
+                    break
+                if file_info.get("hasher"):
+                    file_info["hasher"].update(chunk)
+                started = time.perf_counter()
+                out = compressor.compress(chunk)
+                compressed = time.perf_counter()
+                if out:
+                    if not self._throttle(client_ip, file_info, len(out)):
+                        return sent_bytes, True
+                    writer.send_data(out)
+                monitor.record(len(chunk), len(out), compressed - started, time.perf_counter() - compressed)
+                sent_bytes += len(chunk)
+                last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+                if not monitor.worthwhile():
+                    break
+            tail = compressor.flush()
+            if tail:
+                writer.send_data(tail)
+            writer.send_message({"type": "COMPRESSION_END", "file_name": file_name, "offset": sent_bytes})
+        except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
+            print(f"Socket error during compressed send to {client_ip}: {e}")
+            return sent_bytes, True
+        print(f"Compressed {file_name} for {client_ip} with {codec[0]}: ratio {monitor.ratio():.2f}")
+        if sent_bytes < file_size and self.running:
+            print(f"Compressing {file_name} is slower than the link to {client_ip}; sending the rest raw")
+            if ZERO_COPY_ENABLED and not file_info.get("hasher"):
+                return self._stream_file_zero_copy(client_ip, client_data, file_info, f, sent_bytes)
+            return self._stream_file_buffered(client_ip, client_data, file_info, f, sent_bytes)
+        return sent_bytes, False
+
+    def _throttle(self, client_ip, file_info, nbytes):
+        """Wait until the bandwidth scheduler lets nbytes of file_info go to client_ip; False if cancelled meanwhile."""
+        return self.rate_limiter.throttle(
+            client_ip, nbytes, lambda: file_info["cancel_event"].is_set() or not self.running)
+
+    def _release_fanout(self, client_ip, file_infos):
+        """Detach a client from shared read rings of files it will not (or no longer) send."""
+        for info in file_infos:
+            fanout = info.get("fanout") if info else None
+            if fanout:
+                fanout.release(client_ip)
+
+    def _stream_file_zero_copy(self, client_ip, client_data, file_info, f, sent_bytes):
+        """
+        Stream the file body with socket.sendfile() so the kernel copies pages
+        straight from the page cache to the socket (os.sendfile on Linux/macOS, a
+        plain send() fallback on Windows). Data is handed over in slices sized by
+        the client's ChunkSizer, one DATA frame each when framing is negotiated,
+        so cancellation and progress are still honoured.
+        Returns (sent_bytes, cancelled).
+        """
+        file_size = file_info["file_size"]
+        last_progress_update = time.time()
+        while sent_bytes < file_size and self.running:
+            if file_info["cancel_event"].is_set():
+                return sent_bytes, True
+            block_size = self._slice_size(client_ip, file_info)
+            count = min(self.rate_limiter.slice_size(client_ip, block_size), file_size - sent_bytes)
+            if not self._throttle(client_ip, file_info, count):
+                return sent_bytes, True
+            try:
+                sent = self._sendfile_slice(client_ip, file_info["writer"], f, sent_bytes, count, block_size)
+            except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
+                print(f"Socket error during sendfile to {client_ip}: {e}")
+                return sent_bytes, True
+            if not sent:
+                break  # File shrank underneath us
+            sent_bytes += sent
+            last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+        return sent_bytes, False
+
+    def _stream_file_buffered(self, client_ip, client_data, file_info, f, sent_bytes):
+        """Stream the file body through user-space chunks. Returns (sent_bytes, cancelled)."""
+        file_size = file_info["file_size"]
+        f.seek(sent_bytes) # Resume from where it left off if needed
+        buffer_size = 0
+        last_progress_update = time.time()
+
+        while sent_bytes < file_size and self.running:
+            if file_info["cancel_event"].is_set():
+                return sent_bytes, True
+
+            # Determine chunk size based on remaining buffer space
+            remaining_buffer = MAX_MEMORY_BUFFER - buffer_size
+            block_size = self._slice_size(client_ip, file_info)
+            current_chunk_size = min(self.rate_limiter.slice_size(client_ip, block_size), remaining_buffer)
+
+            chunk = f.read(current_chunk_size)
+            if not chunk:
+                break
+            if not self._throttle(client_ip, file_info, len(chunk)):
+                return sent_bytes, True
+            if file_info.get("hasher"):
+                file_info["hasher"].update(chunk)
+
+            try:
+                started = time.perf_counter()
+                file_info["writer"].send_data(chunk)
+                self.chunk_sizers[client_ip].record(block_size, len(chunk), time.perf_counter() - started)
+                chunk_size = len(chunk)
+                sent_bytes += chunk_size
+                buffer_size += chunk_size
+                last_progress_update = self._record_send_progress(client_ip, file_info, sent_bytes, last_progress_update)
+
+                # Memory management: if buffer is full, wait for network to catch up
+                if buffer_size >= MAX_MEMORY_BUFFER * 0.8:  # 80% full
+                    time.sleep(0.1)  # Brief pause to allow network to catch up
+                    buffer_size = 0  # Reset buffer tracking
+            except (ConnectionResetError, OSError, BrokenPipeError, socket.timeout) as e:
+                print(f"Socket error during chunk send to {client_ip}: {e}")
+                return sent_bytes, True
+        return sent_bytes, False
 
     # Discovery Server for advertising presence
     def start_discovery_server(self):
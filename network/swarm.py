@@ -0,0 +1,433 @@
+"""
+Peer-assisted (swarm) distribution.
+
+Every participant runs a SwarmPeerServer that serves chunks of the files it
+holds, complete or partial. The NetworkServer acts as tracker - it learns from
+HAVE reports which byte ranges each client holds and hands out peer lists - and
+as the initial seed. Receiving clients run a SwarmDownloader that fetches the
+rarest missing chunks from other clients first and from the seed only when no
+client has them, so upload capacity grows with every client that joins.
+
+Peers are not trusted: the server's SWARM_OFFER carries the SHA-256 of every
+chunk and the tree-hash root over them (utils/hashing.py). A chunk that does
+not match is discarded and fetched from another holder; only verified chunks
+are reported in HAVE or served to others, and the file completes only if the
+root built from the written chunks matches.
+
+Peer wire format (TCP, one request at a time per connection):
+    request:  {"type": "SWARM_GET", "swarm_id": id, "offset": o, "length": n}\n
+    response: {"type": "SWARM_DATA", "offset": o, "length": n}\n + n raw bytes
+              {"type": "SWARM_MISS"}\n  (range not held)
+              {"type": "SWARM_BUSY"}\n  (upload slots full, connection closed)
+"""
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+from . import protocol
+from .fileio import open_for_positional_write, pwrite
+from .ranges import RangeSet
+from utils import hashing
+
+# Seconds a peer connection may sit idle before its upload slot is released
+PEER_IDLE_TIMEOUT = 10
+# Bytes handed to sendfile() at once when uploads are throttled
+UPLOAD_SLICE_SIZE = 1024 * 1024
+
+
+class SwarmPeerServer:
+    """
+    Serves byte ranges of registered swarm files to other peers.
+
+    throttle(peer_ip, nbytes) is called before every UPLOAD_SLICE_SIZE slice
+    is sent and may block until the bandwidth limit allows it; returning False
+    ends the upload.
+    """
+    def __init__(self, port=protocol.SWARM_PORT, max_uploads=protocol.SWARM_MAX_UPLOADS, throttle=None):
+        self.files = {}  # {swarm_id: (file_path, has_range_callable)}
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.upload_slots = threading.BoundedSemaphore(max_uploads)
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind(('0.0.0.0', port))
+        except OSError:
+            # Another peer on this machine owns the well-known port
+            self.sock.bind(('0.0.0.0', 0))
+        self.port = self.sock.getsockname()[1]
+        self.sock.listen(32)
+        self.sock.settimeout(1.0)
+        self.thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+
+    def register(self, swarm_id, file_path, has_range=None):
+        """Serve file_path for swarm_id; has_range(offset, length) limits what is offered."""
+        with self.lock:
+            self.files[swarm_id] = (file_path, has_range or (lambda offset, length: True))
+
+    def unregister(self, swarm_id):
+        with self.lock:
+            self.files.pop(swarm_id, None)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not self.upload_slots.acquire(blocking=False):
+                try:
+                    conn.sendall(json.dumps({"type": "SWARM_BUSY"}).encode('utf-8') + b'\n')
+                    conn.close()
+                except OSError:
+                    pass
+                continue
+            threading.Thread(target=self._serve_peer, args=(conn, addr), daemon=True).start()
+
+    def _serve_peer(self, conn, addr):
+        open_files = {}
+        try:
+            # Idle connections give their upload slot back quickly
+            conn.settimeout(PEER_IDLE_TIMEOUT)
+            reader = conn.makefile('rb')
+            while self.running:
+                line = reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                if request.get("type") != "SWARM_GET":
+                    continue
+                swarm_id = request.get("swarm_id")
+                offset = int(request.get("offset", 0))
+                length = int(request.get("length", 0))
+                with self.lock:
+                    entry = self.files.get(swarm_id)
+                if not entry or length <= 0 or not entry[1](offset, length):
+                    conn.sendall(json.dumps({"type": "SWARM_MISS"}).encode('utf-8') + b'\n')
+                    continue
+                f = open_files.get(swarm_id)
+                if f is None:
+                    f = open_files[swarm_id] = open(entry[0], 'rb')
+                header = {"type": "SWARM_DATA", "offset": offset, "length": length}
+                conn.sendall(json.dumps(header).encode('utf-8') + b'\n')
+                end = offset + length
+                while offset < end:
+                    count = min(UPLOAD_SLICE_SIZE, end - offset) if self.throttle else end - offset
+                    if self.throttle and not self.throttle(addr[0], count):
+                        raise ConnectionAbortedError("upload stopped")
+                    sent = conn.sendfile(f, offset=offset, count=count)
+                    if not sent:
+                        raise ConnectionError("file shrank during upload")
+                    offset += sent
+        except (OSError, ValueError) as e:
+            print(f"[Swarm] Peer {addr[0]} connection ended: {e}")
+        finally:
+            for f in open_files.values():
+                f.close()
+            try:
+                conn.close()
+            except OSError:
+                pass
+            self.upload_slots.release()
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class SwarmDownloader:
+    """
+    Fetches one swarm file chunk by chunk from peers into a preallocated file.
+
+    peers are supplied by the tracker through update_peers(); request_peers and
+    report_have are callables that talk to the tracker over the command channel.
+    chunk_digests (hex SHA-256 per chunk) and root come from the server's offer;
+    failure_callback is called instead of completion_callback if the finished
+    file does not match root.
+    """
+    def __init__(self, swarm_id, file_path, file_size, chunk_size, seed_ip,
+                 request_peers, report_have, chunk_digests, root,
+                 progress_callback=None, completion_callback=None, failure_callback=None):
+        self.swarm_id = swarm_id
+        self.file_path = file_path
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.seed_ip = seed_ip
+        self.request_peers = request_peers
+        self.report_have = report_have
+        self.progress_callback = progress_callback
+        self.completion_callback = completion_callback
+        self.failure_callback = failure_callback
+        self.total_chunks = (file_size + chunk_size - 1) // chunk_size
+        if len(chunk_digests) != self.total_chunks:
+            raise ValueError(f"offer lists {len(chunk_digests)} chunk digests for {self.total_chunks} chunks")
+        self.chunk_digests = chunk_digests
+        self.root = root
+        self.written_digests = [None] * self.total_chunks  # Digest of each chunk as written, for the root check
+        self.received = RangeSet()
+        self.in_flight = set()
+        self.peers = {}  # {(ip, port): {"ranges": RangeSet, "seed": bool}}
+        self.cond = threading.Condition()
+        self.running = True
+        self.completed = False
+        self.failed = False  # Every chunk arrived but the file does not match the offered root
+        self.peer_bytes = 0  # Bytes obtained from other clients rather than the seed
+        self.fd = open_for_positional_write(file_path, file_size)
+        self.workers = [threading.Thread(target=self._worker_loop, daemon=True)
+                        for _ in range(protocol.SWARM_PARALLEL_DOWNLOADS)]
+        self.tracker_thread = threading.Thread(target=self._tracker_loop, daemon=True)
+
+    def start(self):
+        self.request_peers()
+        self.tracker_thread.start()
+        for worker in self.workers:
+            worker.start()
+
+    def has_range(self, offset, length):
+        with self.cond:
+            return self.received.contains(offset, offset + length)
+
+    def update_peers(self, peers):
+        """Replace the peer list with the tracker's view [{ip, port, ranges, seed}]."""
+        with self.cond:
+            self.peers = {}
+            for peer in peers:
+                ip = peer.get("ip") or self.seed_ip
+                self.peers[(ip, peer["port"])] = {
+                    "ranges": RangeSet.from_list(peer.get("ranges", [])),
+                    "seed": bool(peer.get("seed"))
+                }
+            self.cond.notify_all()
+
+    def _pick_chunk(self):
+        """Rarest-first choice of a missing chunk and a peer holding it; None if nothing to do now."""
+        candidates = []
+        # Start at a random chunk so peers spread over the file instead of all wanting the same piece
+        first = random.randrange(self.total_chunks) if self.total_chunks else 0
+        for step in range(self.total_chunks):
+            index = (first + step) % self.total_chunks
+            if index in self.in_flight:
+                continue
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, self.file_size)
+            if self.received.contains(start, end):
+                continue
+            holders = [addr for addr, p in self.peers.items() if p["ranges"].contains(start, end)]
+            if not holders:
+                continue
+            clients = [addr for addr in holders if not self.peers[addr]["seed"]]
+            candidates.append((len(clients) if clients else float('inf'), random.random(), index,
+                               random.choice(clients or holders)))
+            if len(candidates) >= 64:
+                break
+        if not candidates:
+            return None
+        _, _, index, addr = min(candidates)
+        return index, addr
+
+    def _worker_loop(self):
+        connections = {}
+        try:
+            while self.running:
+                with self.cond:
+                    if self.received.covered() >= self.file_size:
+                        break
+                    choice = self._pick_chunk()
+                    if choice is None:
+                        self.cond.wait(timeout=protocol.SWARM_HAVE_INTERVAL)
+                        continue
+                    index, addr = choice
+                    self.in_flight.add(index)
+                start = index * self.chunk_size
+                length = min(self.chunk_size, self.file_size - start)
+                ok = False
+                try:
+                    ok = self._fetch(connections, addr, index, start, length)
+                except (OSError, ValueError) as e:
+                    print(f"[Swarm] Fetch from {addr[0]} failed: {e}")
+                    conn = connections.pop(addr, None)
+                    if conn:
+                        conn[0].close()
+                with self.cond:
+                    self.in_flight.discard(index)
+                    if ok:
+                        self.received.add(start, start + length)
+                        if not self.peers.get(addr, {}).get("seed"):
+                            self.peer_bytes += length
+                    else:
+                        # Forget this holder for the range until the tracker says otherwise
+                        peer = self.peers.get(addr)
+                        if peer:
+                            peer["ranges"] = RangeSet.from_list(
+                                [r for r in peer["ranges"].to_list() if not (r[0] <= start < r[1])])
+                    self.cond.notify_all()
+        finally:
+            for sock, reader in connections.values():
+                try:
+                    reader.close()
+                    sock.close()
+                except OSError:
+                    pass
+        self._check_complete()
+
+    def _fetch(self, connections, addr, index, offset, length):
+        # Keep at most one open connection per worker so upload slots circulate among peers
+        for other in [a for a in connections if a != addr]:
+            sock, reader = connections.pop(other)
+            reader.close()
+            sock.close()
+        conn = connections.get(addr)
+        if conn is None:
+            sock = socket.create_connection(addr, timeout=protocol.CHUNK_TIMEOUT)
+            conn = connections[addr] = (sock, sock.makefile('rb'))
+        sock, reader = conn
+        request = {"type": "SWARM_GET", "swarm_id": self.swarm_id, "offset": offset, "length": length}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("peer closed connection")
+        reply = json.loads(line.decode('utf-8'))
+        if reply.get("type") != "SWARM_DATA":
+            if reply.get("type") == "SWARM_BUSY":
+                connections.pop(addr, None)
+                sock.close()
+            return False
+        buf = bytearray(length)
+        view = memoryview(buf)
+        got = 0
+        while got < length:
+            n = reader.readinto(view[got:])
+            if not n:
+                raise ConnectionError("peer closed connection mid-chunk")
+            got += n
+        digest = hashing.chunk_digest(view)
+        if digest != self.chunk_digests[index]:
+            # Faulty or malicious peer: the caller forgets it for this chunk and asks another holder
+            print(f"[Swarm] Chunk {index} from {addr[0]} does not match its digest; discarding it")
+            return False
+        pwrite(self.fd, view, offset)
+        self.written_digests[index] = digest
+        return True
+
+    def _tracker_loop(self):
+        last_reported = -1
+        while self.running and not self.completed:
+            with self.cond:
+                covered = self.received.covered()
+                ranges = self.received.to_list()
+            if covered != last_reported:
+                self.report_have(ranges)
+                last_reported = covered
+                if self.progress_callback:
+                    self.progress_callback(covered)
+            self.request_peers()
+            self._check_complete()
+            time.sleep(protocol.SWARM_HAVE_INTERVAL)
+
+    def _check_complete(self):
+        with self.cond:
+            if self.completed or self.failed or self.received.covered() < self.file_size:
+                return
+            if hashing.tree_root(self.written_digests) != self.root:
+                self.failed = True
+                self.running = False
+                self.cond.notify_all()
+            else:
+                self.completed = True
+                ranges = self.received.to_list()
+        if self.failed:
+            print(f"[Swarm] {self.file_path} does not match the offered tree hash")
+            if self.failure_callback:
+                self.failure_callback()
+            return
+        self.report_have(ranges)
+        if self.completion_callback:
+            self.completion_callback()
+
+    def stop(self):
+        """Stop fetching; the file descriptor is kept until close()."""
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+
+    def close(self):
+        self.stop()
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class SwarmSession:
+    """
+    Tracker state for one swarm file on the server.
+    """
+    def __init__(self, swarm_id, file_info, file_size, seed_port):
+        self.swarm_id = swarm_id
+        self.file_info = file_info
+        self.file_size = file_size
+        self.seed_port = seed_port
+        self.peers = {}  # {client_ip: {"port": int, "ranges": RangeSet}}
+        self.rejected = set()
+        self.complete = set()
+        self.last_progress = time.time()
+        self.cond = threading.Condition()
+
+    def join(self, client_ip, port):
+        with self.cond:
+            self.peers[client_ip] = {"port": port, "ranges": RangeSet()}
+            self.cond.notify_all()
+
+    def reject(self, client_ip):
+        with self.cond:
+            self.rejected.add(client_ip)
+            self.cond.notify_all()
+
+    def update_have(self, client_ip, ranges):
+        with self.cond:
+            peer = self.peers.get(client_ip)
+            if not peer:
+                return 0
+            new_ranges = RangeSet.from_list(ranges)
+            if new_ranges.covered() > peer["ranges"].covered():
+                self.last_progress = time.time()
+            peer["ranges"] = new_ranges
+            if new_ranges.covered() >= self.file_size:
+                self.complete.add(client_ip)
+                self.cond.notify_all()
+            return new_ranges.covered()
+
+    def mark_complete(self, client_ip):
+        with self.cond:
+            self.complete.add(client_ip)
+            self.cond.notify_all()
+
+    def peer_list(self, for_client):
+        """Peers for one client: every other client's holdings plus the server seed."""
+        with self.cond:
+            peers = [{"ip": ip, "port": p["port"], "ranges": p["ranges"].to_list()}
+                     for ip, p in self.peers.items() if ip != for_client and len(p["ranges"])]
+        peers.append({"ip": None, "port": self.seed_port, "seed": True, "ranges": [[0, self.file_size]]})
+        return peers
+
+    def wait_for_joins(self, client_ips, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: set(self.peers) | self.rejected >= set(client_ips), timeout=timeout)
+            return set(self.peers)
+
+    def wait(self, timeout):
+        with self.cond:
+            self.cond.wait(timeout=timeout)
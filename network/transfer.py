@@ -4,17 +4,90 @@ Handles the reliable, chunk-based file transfer over TCP.
 
 import socket
 import json
+import mmap
 import os
+import contextlib
 import threading
 import time
-import hashlib
+import queue
 from . import protocol
+from .chunking import ChunkSizer, PROBE_CHUNK_SIZE
+from .fileio import open_for_positional_write, pwrite
+from .ranges import ChunkBitmap
+from utils import hashing
+
+# Chunks beyond the cumulative ack described by each selective-ack bitmap
+SACK_SPAN = protocol.MAX_WINDOW_SIZE * 4
+# Bounds for the retransmission timeout derived from measured RTT
+MIN_RTO = 0.2
+MAX_RTO = protocol.CHUNK_TIMEOUT
+# Seconds of history kept for the minimum-RTT (propagation delay) estimate
+MIN_RTT_WINDOW = 10.0
+# Receiver: chunk bytes buffered for the writer thread before socket reads wait on the disk
+WRITE_QUEUE_BYTES = 128 * 1024 * 1024
+# Receiver: seconds a chunk may be missing below a later one before it is requested again
+GAP_GRACE = 0.5
+# Receiver: chunk indexes per RETRANSMIT_REQUEST
+RETRANSMIT_BATCH = 1024
+
+
+def encode_sack(received, base, total):
+    """Hex bitmap of which chunks in [base, base + SACK_SPAN) are in `received`."""
+    span = min(SACK_SPAN, max(0, total - base))
+    bits = bytearray((span + 7) // 8)
+    for offset in range(span):
+        if base + offset in received:
+            bits[offset >> 3] |= 0x80 >> (offset & 7)
+    return bits.hex()
+
+
+def decode_sack(sack, base):
+    """Chunk indices marked in a bitmap produced by encode_sack()."""
+    try:
+        bits = bytes.fromhex(sack or "")
+    except ValueError:
+        return []
+    return [base + (i << 3) + b for i, byte in enumerate(bits) if byte for b in range(8) if byte & (0x80 >> b)]
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes; returns None if the peer closed first."""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            return None
+        received += n
+    return buf
+
 
 class FileSender(threading.Thread):
     """
     Sends a file to a client using a reliable, chunk-based protocol.
+
+    Chunks are pipelined up to a window that follows the measured bandwidth-delay
+    product: acknowledged chunks per second times the minimum observed RTT, scaled
+    by WINDOW_SCALE_FACTOR for headroom and kept between MIN_WINDOW_SIZE and
+    MAX_WINDOW_SIZE. A separate thread reads cumulative + selective acks, so the
+    sending loop only waits when the window is full. Chunks not acknowledged within
+    the RTT-derived timeout, or reported missing by the receiver, are resent and the
+    window is cut by WINDOW_SCALE_FACTOR.
+
+    The file is mapped once and every send, first or retransmitted, hands a
+    memoryview slice of the mapping straight to sendall(), so a retransmission
+    costs no seek, read or copy. Each chunk carries its SHA-256, computed once
+    and kept for resends; the receiver drops and re-requests chunks that do not
+    match. FILE_END carries the root of a tree hash over those chunk digests
+    (leaves of chunk_size, in chunk order), which the receiver rebuilds from the
+    chunks it wrote, so the file is never read in a separate pass.
+
+    The chunk size comes from a ChunkSizer (network/chunking.py) when the file
+    starts; ack rate and RTT measured once per RTT are fed back to it.
     """
-    def __init__(self, client_ip, client_port, file_path, file_info, progress_callback=None, completion_callback=None):
+    def __init__(self, client_ip, client_port, file_path, file_info, progress_callback=None, completion_callback=None,
+                 chunk_sizer=None):
         super().__init__()
         self.client_ip = client_ip
         self.client_port = client_port
@@ -22,14 +95,36 @@ class FileSender(threading.Thread):
         self.file_info = file_info
         self.progress_callback = progress_callback
         self.completion_callback = completion_callback
+        self.chunk_sizer = chunk_sizer or ChunkSizer()  # Pass the client's sizer so what it learned carries over
         self.sock = None
         self.running = True
-        self.unacked_chunks = set()
+        self.cond = threading.Condition()
+        self.chunk_size = 0
+        self.total_chunks = 0
+        self.acked = bytearray()  # One flag per chunk
+        self.acked_count = 0
+        self.cumulative = 0  # Every chunk below this index is acknowledged
+        self.in_flight = {}  # {chunk_index: send time}
+        self.retransmit_queue = []
+        self.retransmitted = set()  # Excluded from RTT samples (Karn's rule)
+        self.window = protocol.MIN_WINDOW_SIZE
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = protocol.ACK_TIMEOUT
+        self.rtt_samples = []  # [(time, rtt)] within MIN_RTT_WINDOW
+        self.ack_rate = 0.0  # Chunks acknowledged per second (EWMA)
+        self._rate_started = 0.0
+        self._rate_acks = 0
+        self.completed = False
+        self.error = None
+        self.chunk_checksums = []  # Per chunk, computed on its first send and reused by retransmissions
 
     def run(self):
         try:
             self._connect()
-            self._send_file()
+            if self._send_file():
+                if self.completion_callback:
+                    self.completion_callback(self.file_info['name'], 'completed')
         except Exception as e:
             print(f"Error sending file to {self.client_ip}: {e}")
             if self.completion_callback:
@@ -43,20 +138,21 @@ class FileSender(threading.Thread):
         self.sock.connect((self.client_ip, self.client_port))
 
     def _send_file(self):
+        """Returns True once the receiver confirmed the whole file, False if cancelled."""
         MAX_RETRIES = 5
         RETRY_DELAY = 5  # seconds
         
         file_size = os.path.getsize(self.file_path)
         
-        # Select chunk size based on file size with more conservative sizes
-        if file_size < 50 * 1024 * 1024:  # < 50MB
-            chunk_size = protocol.CHUNK_SIZE_SMALL // 2  # Smaller chunks for better reliability
-        elif file_size < 500 * 1024 * 1024:  # < 500MB
-            chunk_size = protocol.CHUNK_SIZE_MEDIUM // 2
-        else:  # >= 500MB
-            chunk_size = protocol.CHUNK_SIZE_LARGE // 2
-            
+        # The receiver places chunk i at i * chunk_size, so the size learned so far
+        # holds for this whole file; what this file measures sizes the next one
+        chunk_size = self.chunk_sizer.slice_size()
+
         total_chunks = (file_size + chunk_size - 1) // chunk_size
+        self.chunk_size = chunk_size
+        self.total_chunks = total_chunks
+        self.acked = bytearray(total_chunks)
+        self.chunk_checksums = [None] * total_chunks
 
         # Prepare header with additional metadata
         header = {
@@ -65,8 +161,7 @@ class FileSender(threading.Thread):
             'file_size': file_size,
             'total_chunks': total_chunks,
             'chunk_size': chunk_size,
-            'category': self.file_info.get('category', 'other'),
-            'checksum': self._calculate_file_checksum()
+            'category': self.file_info.get('category', 'other')
         }
 
         # Send header with retries
@@ -83,146 +178,242 @@ class FileSender(threading.Thread):
         else:
             raise Exception("File transfer rejected by client")
 
-        failed_chunks = set()
-        with open(self.file_path, 'rb') as f:
-            for i in range(total_chunks):
-                if not self.running:
-                    self._send_message({'type': protocol.MSG_TYPE_CANCEL_TRANSFER})
-                    break
-
-                chunk_data = f.read(chunk_size)
-                chunk_message = {
-                    'type': protocol.MSG_TYPE_FILE_CHUNK,
-                    'chunk_index': i,
-                    'size': len(chunk_data),
-                    'checksum': self._calculate_chunk_checksum(chunk_data)
-                }
-
-                # Retry failed chunks
-                retry_count = 0
-                while retry_count < MAX_RETRIES:
-                    try:
-                        if i in failed_chunks:
-                            f.seek(i * chunk_size)
-                            chunk_data = f.read(chunk_size)
-                        
-                        self._send_message(chunk_message, chunk_data)
-                        self.unacked_chunks.add(i)
-
-                        # More conservative window size for better reliability
-                        window_size = 2 if file_size < 50 * 1024 * 1024 else (3 if file_size < 500 * 1024 * 1024 else 4)
-                        if len(self.unacked_chunks) >= window_size:
-                            failed = self._wait_for_acks(timeout=60)  # Longer timeout for acks
-                            if failed:
-                                failed_chunks.update(failed)
+        self.sock.settimeout(protocol.CHUNK_TIMEOUT)
+        self._rate_started = time.time()
+        reader = threading.Thread(target=self._ack_reader, daemon=True)
+        reader.start()
+
+        next_index = 0
+        end_attempts = 0
+        with self._mapped_file(file_size) as mapped:
+            while True:
+                with self.cond:
+                    chunk_index = None
+                    while self.running and not self.error and not self.completed:
+                        self._check_timeouts(time.time())
+                        if self.retransmit_queue:
+                            chunk_index = self.retransmit_queue.pop(0)
+                            if self.acked[chunk_index]:
+                                chunk_index = None
                                 continue
-                        
-                        if i in failed_chunks:
-                            failed_chunks.remove(i)
-                        break
-                        
-                    except Exception as e:
-                        print(f"Error sending chunk {i}: {e}")
-                        retry_count += 1
-                        if retry_count < MAX_RETRIES:
-                            time.sleep(RETRY_DELAY * (retry_count + 1))  # Exponential backoff
-                        else:
-                            raise Exception(f"Failed to send chunk {i} after {MAX_RETRIES} attempts")
-
-                if self.progress_callback:
-                    self.progress_callback(self.file_info['name'], (i + 1) / total_chunks * 100)
+                            self.retransmitted.add(chunk_index)
+                            break
+                        if next_index < total_chunks and len(self.in_flight) < self.window:
+                            chunk_index = next_index
+                            next_index += 1
+                            break
+                        if self.acked_count == total_chunks and not self.in_flight:
+                            break
+                        self.cond.wait(timeout=self._next_deadline())
+                    if self.error:
+                        raise Exception(self.error)
+                    if self.completed:
+                        return True
+                    if not self.running:
+                        self._send_message({'type': protocol.MSG_TYPE_CANCEL_TRANSFER})
+                        return False
+                    if chunk_index is not None:
+                        self.in_flight[chunk_index] = time.time()
+
+                if chunk_index is not None:
+                    start = chunk_index * chunk_size
+                    with mapped[start:start + chunk_size] as chunk_data:
+                        if self.chunk_checksums[chunk_index] is None:
+                            self.chunk_checksums[chunk_index] = self._calculate_chunk_checksum(chunk_data)
+                        chunk_message = {
+                            'type': protocol.MSG_TYPE_FILE_CHUNK,
+                            'chunk_index': chunk_index,
+                            'size': len(chunk_data),
+                            'checksum': self.chunk_checksums[chunk_index]
+                        }
+                        self._send_message(chunk_message, chunk_data)
+                    continue
+
+                # Every chunk acknowledged: ask the receiver to confirm the whole file
+                end_attempts += 1
+                if end_attempts > MAX_RETRIES:
+                    raise Exception("Failed to confirm file transfer completion")
+                self._send_message({'type': protocol.MSG_TYPE_FILE_END, 'checksum': self._file_checksum()})
+                with self.cond:
+                    self.cond.wait_for(lambda: self.completed or self.error or self.retransmit_queue
+                                       or not self.running, timeout=30)
+
+    @contextlib.contextmanager
+    def _mapped_file(self, file_size):
+        """The file mapped read-only, as a memoryview; unmapped when the transfer ends."""
+        if not file_size:
+            yield memoryview(b"")  # Empty files cannot be mapped
+            return
+        with open(self.file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                yield view
+            finally:
+                view.release()
 
-        # Wait for all remaining acks with retries
-        retry_count = 0
-        while (self.unacked_chunks or failed_chunks) and self.running:
+    def _ack_reader(self):
+        """Consume acknowledgements and retransmit requests until the transfer ends."""
+        while self.running and not self.completed:
             try:
-                failed = self._wait_for_acks(timeout=60)
-                if failed:
-                    failed_chunks.update(failed)
-                if not failed and not self.unacked_chunks:
-                    break
-                retry_count += 1
-                if retry_count >= MAX_RETRIES:
-                    raise Exception("Failed to get acknowledgment for all chunks")
-                time.sleep(RETRY_DELAY * (retry_count + 1))
+                message = self._receive_message()
+            except socket.timeout:
+                continue
             except Exception as e:
-                if retry_count >= MAX_RETRIES:
-                    raise Exception(f"Failed to complete file transfer: {e}")
-
-        if self.running:
-            # Send end message with retries
-            for retry in range(MAX_RETRIES):
-                try:
-                    self._send_message({'type': protocol.MSG_TYPE_FILE_END})
-                    ack = self._receive_message(timeout=30)
-                    if ack and ack.get('type') == protocol.MSG_TYPE_FILE_COMPLETE_ACK:
-                        break
-                except Exception:
-                    if retry == MAX_RETRIES - 1:
-                        raise Exception("Failed to confirm file transfer completion")
-                    time.sleep(RETRY_DELAY)
-                    
-    def _calculate_file_checksum(self):
-        """Calculate SHA-256 checksum of the file"""
-        try:
-            import hashlib
-            sha256_hash = hashlib.sha256()
-            with open(self.file_path, "rb") as f:
-                for byte_block in iter(lambda: f.read(4096), b""):
-                    sha256_hash.update(byte_block)
-            return sha256_hash.hexdigest()
-        except Exception:
+                message = None
+                if self.running:
+                    print(f"Ack reader for {self.client_ip} stopped: {e}")
+            if message is None:
+                with self.cond:
+                    if not self.completed and not self.error:
+                        self.error = "Connection lost while waiting for acknowledgements"
+                    self.cond.notify_all()
+                return
+            msg_type = message.get('type')
+            if msg_type == protocol.MSG_TYPE_CHUNK_ACK:
+                self._handle_ack(message)
+            elif msg_type == protocol.MSG_TYPE_RETRANSMIT_REQUEST:
+                with self.cond:
+                    for chunk_index in message.get('chunks', []):
+                        if 0 <= chunk_index < self.total_chunks:
+                            if self.acked[chunk_index]:
+                                self.acked[chunk_index] = 0
+                                self.acked_count -= 1
+                                self.cumulative = min(self.cumulative, chunk_index)
+                            self.in_flight.pop(chunk_index, None)
+                            self.retransmit_queue.append(chunk_index)
+                    self._reduce_window()
+                    self.cond.notify_all()
+            elif msg_type == protocol.MSG_TYPE_FILE_COMPLETE_ACK:
+                with self.cond:
+                    self.completed = True
+                    self.cond.notify_all()
+            elif msg_type == protocol.MSG_TYPE_CANCEL_TRANSFER:
+                with self.cond:
+                    self.error = "Transfer cancelled by receiver"
+                    self.cond.notify_all()
+
+    def _handle_ack(self, ack):
+        now = time.time()
+        with self.cond:
+            newly_acked = []
+            cumulative = min(int(ack.get('cumulative', 0)), self.total_chunks)
+            for chunk_index in range(self.cumulative, cumulative):
+                self._mark_acked(chunk_index, newly_acked)
+            self.cumulative = max(self.cumulative, cumulative)
+            for chunk_index in decode_sack(ack.get('sack'), cumulative):
+                if chunk_index < self.total_chunks:
+                    self._mark_acked(chunk_index, newly_acked)
+            chunk_index = ack.get('chunk_index')
+            if isinstance(chunk_index, int) and 0 <= chunk_index < self.total_chunks:
+                self._mark_acked(chunk_index, newly_acked)
+
+            for chunk_index in newly_acked:
+                sent_at = self.in_flight.pop(chunk_index, None)
+                if sent_at is not None and chunk_index not in self.retransmitted:
+                    self._add_rtt_sample(now, now - sent_at)
+            self._update_window(now, len(newly_acked))
+            self.cond.notify_all()
+            acked_count = self.acked_count
+        if newly_acked and self.progress_callback:
+            self.progress_callback(self.file_info['name'], acked_count / self.total_chunks * 100)
+
+    def _mark_acked(self, chunk_index, newly_acked):
+        if not self.acked[chunk_index]:
+            self.acked[chunk_index] = 1
+            self.acked_count += 1
+            newly_acked.append(chunk_index)
+
+    def _add_rtt_sample(self, now, rtt):
+        # RFC 6298 smoothing for the retransmission timeout
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+        self.rtt_samples.append((now, rtt))
+        while self.rtt_samples and now - self.rtt_samples[0][0] > MIN_RTT_WINDOW:
+            self.rtt_samples.pop(0)
+
+    def _update_window(self, now, newly_acked):
+        """Resize the window to the bandwidth-delay product once per RTT."""
+        self._rate_acks += newly_acked
+        elapsed = now - self._rate_started
+        if self.srtt is None or elapsed < max(self.srtt, 0.01):
+            return
+        rate = self._rate_acks / elapsed
+        self.ack_rate = rate if not self.ack_rate else 0.75 * self.ack_rate + 0.25 * rate
+        self.chunk_sizer.record(self.chunk_size, self._rate_acks * self.chunk_size, elapsed, latency=self.srtt)
+        self._rate_started = now
+        self._rate_acks = 0
+        min_rtt = min(rtt for _, rtt in self.rtt_samples) if self.rtt_samples else self.srtt
+        # While the window is the bottleneck, ack_rate * min_rtt equals the window and the
+        # scale factor grows it; once the link is full, extra chunks only add queueing delay
+        target = int(self.ack_rate * min_rtt * protocol.WINDOW_SCALE_FACTOR + 0.999)
+        self.window = max(protocol.MIN_WINDOW_SIZE, min(protocol.MAX_WINDOW_SIZE, target))
+
+    def _reduce_window(self):
+        self.window = max(protocol.MIN_WINDOW_SIZE, self.window // protocol.WINDOW_SCALE_FACTOR)
+
+    def _check_timeouts(self, now):
+        expired = [i for i, sent_at in self.in_flight.items() if now - sent_at > self.rto]
+        if not expired:
+            return
+        for chunk_index in expired:
+            del self.in_flight[chunk_index]
+            self.retransmit_queue.append(chunk_index)
+        # Back off as TCP does so a slow receiver is not flooded with duplicates
+        self._reduce_window()
+        self.rto = min(MAX_RTO, self.rto * 2)
+
+    def _next_deadline(self):
+        """Seconds until the oldest in-flight chunk times out."""
+        if not self.in_flight:
+            return self.rto
+        oldest = min(self.in_flight.values())
+        return max(0.01, oldest + self.rto - time.time())
+
+    def _file_checksum(self):
+        """Tree-hash root over the chunk checksums; None if a chunk could not be hashed"""
+        if None in self.chunk_checksums:
             return None
-            
+        return hashing.tree_root(self.chunk_checksums)
+
+
     def _calculate_chunk_checksum(self, chunk_data):
         """Calculate SHA-256 checksum of a chunk"""
         try:
-            return hashlib.sha256(chunk_data).hexdigest()
+            return hashing.chunk_digest(chunk_data)
         except Exception:
             return None
-            if self.completion_callback:
-                self.completion_callback(self.file_info['name'], 'completed')
-
-    def _wait_for_acks(self):
-        try:
-            self.sock.settimeout(protocol.ACK_TIMEOUT)
-            ack = self._receive_message()
-            if ack and ack.get('type') == protocol.MSG_TYPE_CHUNK_ACK:
-                chunk_index = ack.get('chunk_index')
-                if chunk_index in self.unacked_chunks:
-                    self.unacked_chunks.remove(chunk_index)
-        except socket.timeout:
-            # Resend the oldest unacked chunk
-            oldest_unacked = min(self.unacked_chunks)
-            self._resend_chunk(oldest_unacked)
-
-    def _resend_chunk(self, chunk_index):
-        with open(self.file_path, 'rb') as f:
-            f.seek(chunk_index * protocol.CHUNK_SIZE)
-            chunk_data = f.read(protocol.CHUNK_SIZE)
-            chunk_message = {
-                'type': protocol.MSG_TYPE_FILE_CHUNK,
-                'chunk_index': chunk_index,
-                'size': len(chunk_data)
-            }
-            self._send_message(chunk_message, chunk_data)
 
     def _send_message(self, message, data=b''):
         json_message = json.dumps(message).encode('utf-8')
-        self.sock.sendall(len(json_message).to_bytes(4, 'big') + json_message + data)
+        self.sock.sendall(len(json_message).to_bytes(4, 'big') + json_message)
+        if data:
+            self.sock.sendall(data)
 
-    def _receive_message(self):
+    def _receive_message(self, timeout=None):
+        """Read one length-prefixed message. Only the ack reader calls this once chunks flow."""
+        if timeout is not None:
+            self.sock.settimeout(timeout)
         try:
-            raw_len = self.sock.recv(4)
+            raw_len = _recv_exact(self.sock, 4)
             if not raw_len:
                 return None
             msg_len = int.from_bytes(raw_len, 'big')
-            return json.loads(self.sock.recv(msg_len).decode('utf-8'))
-        except (socket.timeout, json.JSONDecodeError, ConnectionResetError):
+            payload = _recv_exact(self.sock, msg_len)
+            if payload is None:
+                return None
+            return json.loads(payload.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError, ConnectionResetError):
             return None
 
     def stop(self):
-        self.running = False
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
 
     def _close(self):
         if self.sock:
@@ -237,6 +428,16 @@ class FileSender(threading.Thread):
 class FileReceiver(threading.Thread):
     """
     Receives a file from a server using a reliable, chunk-based protocol.
+
+    Chunks may arrive in any order (retransmissions, or several senders feeding
+    one receiver). Each is checked against the SHA-256 its message carries, then
+    handed to a writer thread that puts it at index * chunk_size with pwrite(),
+    so reading the socket never waits on the disk. Arrivals are tracked in a
+    ChunkBitmap. Chunks missing below the highest index seen for GAP_GRACE
+    seconds, and corrupt chunks, are requested again in RETRANSMIT_REQUEST
+    batches of at most RETRANSMIT_BATCH. The digests of the chunks written are
+    kept in chunk order; FILE_COMPLETE_ACK is sent only if the tree-hash root
+    over them matches the one FILE_END carries.
     """
     def __init__(self, sock, addr, received_files_dir, completion_callback=None, progress_callback=None):
         super().__init__()
@@ -246,10 +447,19 @@ class FileReceiver(threading.Thread):
         self.completion_callback = completion_callback
         self.progress_callback = progress_callback
         self.running = True
-        self.file_handle = None
+        self.fd = None
         self.file_path = None
+        self.chunk_size = 0
         self.total_chunks = 0
-        self.received_chunks = set()
+        self.received_chunks = ChunkBitmap(0)
+        self.chunk_digests = []  # SHA-256 of each chunk written, by index
+        self.cumulative = 0  # First chunk index not yet received
+        self.highest = -1  # Highest chunk index received
+        self.gaps = {}  # {chunk index: time it was first seen missing or last requested}
+        self.write_queue = None
+        self.writer = None
+        self.write_error = None
+        self.file_mismatch = False  # Every chunk arrived but the FILE_END checksum did not match
 
     def run(self):
         try:
@@ -261,7 +471,7 @@ class FileReceiver(threading.Thread):
 
     def _handle_transfer(self):
         # Receive file header
-        header_data = self._receive_message_and_data(protocol.BUFFER_SIZE)
+        header_data = self._receive_message_and_data()
         if not header_data:
             return
         
@@ -272,7 +482,9 @@ class FileReceiver(threading.Thread):
         file_name = header['file_name']
         file_size = header['file_size']
         self.total_chunks = header['total_chunks']
-        self.chunk_size = header.get('chunk_size', protocol.CHUNK_SIZE_SMALL)
+        self.chunk_size = header.get('chunk_size', PROBE_CHUNK_SIZE)
+        self.received_chunks = ChunkBitmap(self.total_chunks)
+        self.chunk_digests = [None] * self.total_chunks
         category = header.get('category', 'other')
         
         # Set socket buffer size based on chunk size and network type
@@ -297,51 +509,95 @@ class FileReceiver(threading.Thread):
         os.makedirs(storage_dir, exist_ok=True)
         self.file_path = os.path.join(storage_dir, file_name)
 
+        # Chunks land by offset, so the file gets its full size up front
+        try:
+            self.fd = open_for_positional_write(self.file_path, file_size)
+            os.ftruncate(self.fd, file_size)
+        except OSError as e:
+            print(f"Cannot create {self.file_path}: {e}")
+            self._send_message({'type': protocol.MSG_TYPE_FILE_HEADER_ACK, 'status': 'error', 'reason': str(e)})
+            return
+        self.write_queue = queue.Queue(maxsize=max(2, WRITE_QUEUE_BYTES // max(1, self.chunk_size)))
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
         # Send acknowledgment to start transfer
         self._send_message({'type': protocol.MSG_TYPE_FILE_HEADER_ACK, 'status': 'ok'})
 
-        # Open file for writing in binary mode
-        self.file_handle = open(self.file_path, 'wb')
-        
-        while len(self.received_chunks) < self.total_chunks and self.running:
+        while self.running:
             try:
                 # Adjust timeout based on chunk size and network conditions
                 base_timeout = protocol.ACK_TIMEOUT * 2
-                if self.chunk_size > protocol.CHUNK_SIZE_MEDIUM:
+                if self.chunk_size > 4 * PROBE_CHUNK_SIZE:
                     base_timeout *= 2  # Double timeout for large chunks
                 self.sock.settimeout(base_timeout)
                 
-                # Use chunk size as the base for receive buffer
-                message_data = self._receive_message_and_data(self.chunk_size + 1024)  # Buffer for message + chunk
-                if not message_data:
+                message_data = self._receive_message_and_data()
+                if not message_data[0]:
                     print("Connection lost while receiving file.")
                     break
                 
                 message, data = message_data
                 msg_type = message.get('type')
+                if self.write_error:
+                    print(f"Cannot write {file_name}: {self.write_error}")
+                    self._send_message({'type': protocol.MSG_TYPE_CANCEL_TRANSFER})
+                    break
 
                 if msg_type == protocol.MSG_TYPE_FILE_CHUNK:
-                    chunk_index = message['chunk_index']
-                    
-                    # This is a simple implementation. A more robust one would seek and write.
-                    # For now, we assume chunks arrive mostly in order.
-                    # A better implementation would handle out-of-order chunks by writing to temporary files
-                    # or seeking to the correct position in the output file.
+                    chunk_index = message.get('chunk_index')
+                    if not isinstance(chunk_index, int) or not 0 <= chunk_index < self.total_chunks:
+                        continue
                     if chunk_index not in self.received_chunks:
-                        self.file_handle.seek(chunk_index * protocol.CHUNK_SIZE)
-                        self.file_handle.write(data)
-                        self.received_chunks.add(chunk_index)
+                        if not self._chunk_intact(message, data):
+                            print(f"Chunk {chunk_index} of {file_name} is corrupt; requesting it again")
+                            self.gaps[chunk_index] = 0  # Requested with the next batch, right away
+                        else:
+                            self.write_queue.put((chunk_index * self.chunk_size, data))
+                            self.received_chunks.add(chunk_index)
+                            # An intact chunk's digest equals the checksum it carries
+                            self.chunk_digests[chunk_index] = message.get('checksum') or hashing.chunk_digest(data)
+                            self.gaps.pop(chunk_index, None)
+                            self._note_gaps(chunk_index)
+                            while self.cumulative in self.received_chunks:
+                                self.cumulative += 1
+                    self._request_gaps()
                     
                     if self.progress_callback:
-                        progress = (len(self.received_chunks) / self.total_chunks) * 100
+                        progress = (self.received_chunks.count / self.total_chunks) * 100
                         self.progress_callback(file_name, self.addr[0], progress)
 
-                    # Acknowledge receipt of the chunk
-                    ack_message = {'type': protocol.MSG_TYPE_CHUNK_ACK, 'chunk_index': chunk_index}
+                    # Cumulative ack plus a bitmap of what arrived beyond it, so the sender
+                    # learns about every chunk even if an individual ack is delayed
+                    ack_message = {
+                        'type': protocol.MSG_TYPE_CHUNK_ACK,
+                        'chunk_index': chunk_index,
+                        'cumulative': self.cumulative,
+                        'sack': encode_sack(self.received_chunks, self.cumulative, self.total_chunks)
+                    }
                     self._send_message(ack_message)
 
                 elif msg_type == protocol.MSG_TYPE_FILE_END:
-                    break # Server signaled end of transfer
+                    if self.received_chunks.complete():
+                        # Confirm only once every chunk is on disk
+                        self.write_queue.join()
+                        if self.write_error:
+                            print(f"Cannot write {file_name}: {self.write_error}")
+                            self._send_message({'type': protocol.MSG_TYPE_CANCEL_TRANSFER})
+                            break
+                        checksum = message.get('checksum')
+                        if checksum and hashing.tree_root(self.chunk_digests) != checksum:
+                            print(f"{file_name} does not match the checksum in FILE_END")
+                            self.file_mismatch = True
+                            self._send_message({'type': protocol.MSG_TYPE_CANCEL_TRANSFER})
+                            break
+                        self._send_message({'type': protocol.MSG_TYPE_FILE_COMPLETE_ACK, 'status': 'ok'})
+                        break
+                    missing = self.received_chunks.missing(self.cumulative, limit=RETRANSMIT_BATCH)
+                    now = time.time()
+                    for chunk_index in missing:
+                        self.gaps[chunk_index] = now
+                    self._send_message({'type': protocol.MSG_TYPE_RETRANSMIT_REQUEST, 'chunks': missing})
                 
                 elif msg_type == protocol.MSG_TYPE_CANCEL_TRANSFER:
                     self.running = False
@@ -349,52 +605,109 @@ class FileReceiver(threading.Thread):
                     break
 
             except socket.timeout:
-                print("Socket timed out waiting for chunk. Requesting retransmit if possible.")
-                # A more robust implementation would request missing chunks here.
+                # Nothing arrived for a while: ask again for everything still missing
+                now = time.time()
+                for chunk_index in self.received_chunks.missing(self.cumulative, limit=RETRANSMIT_BATCH):
+                    self.gaps.setdefault(chunk_index, now - GAP_GRACE)
+                self._request_gaps()
                 continue
             except Exception as e:
                 print(f"Error during chunk reception: {e}")
                 break
-        
-        if len(self.received_chunks) == self.total_chunks:
+
+        self._stop_writer()
+        if self.received_chunks.complete() and not self.write_error and not self.file_mismatch:
             print(f"File {file_name} received successfully.")
             if self.completion_callback:
                 self.completion_callback(file_name, 'completed', self.file_path)
         else:
-            print(f"File {file_name} transfer incomplete. Received {len(self.received_chunks)}/{self.total_chunks} chunks.")
+            print(f"File {file_name} transfer incomplete. Received {self.received_chunks.count}/{self.total_chunks} chunks.")
             if self.completion_callback:
                 self.completion_callback(file_name, 'failed', self.file_path)
 
+    def _note_gaps(self, chunk_index):
+        """A chunk beyond the highest seen so far: the chunks skipped over are gaps from now."""
+        if chunk_index <= self.highest:
+            return
+        now = time.time()
+        for index in range(max(self.highest + 1, self.cumulative), chunk_index):
+            if index not in self.received_chunks:
+                self.gaps.setdefault(index, now)
+        self.highest = chunk_index
+
+    def _request_gaps(self):
+        """Request the gaps older than GAP_GRACE, in one RETRANSMIT_REQUEST per RETRANSMIT_BATCH chunks."""
+        if not self.gaps:
+            return
+        now = time.time()
+        due = sorted(i for i, since in self.gaps.items() if now - since >= GAP_GRACE)
+        for start in range(0, len(due), RETRANSMIT_BATCH):
+            batch = due[start:start + RETRANSMIT_BATCH]
+            for chunk_index in batch:
+                self.gaps[chunk_index] = now  # Asked again only if still missing after another GAP_GRACE
+            self._send_message({'type': protocol.MSG_TYPE_RETRANSMIT_REQUEST, 'chunks': batch})
+
+    def _write_loop(self):
+        """Writer thread: put queued chunks at their offsets; the first error stops further writes."""
+        while True:
+            item = self.write_queue.get()
+            try:
+                if item is None:
+                    return
+                offset, data = item
+                if self.write_error is None:
+                    try:
+                        pwrite(self.fd, data, offset)
+                    except OSError as e:
+                        self.write_error = e
+            finally:
+                self.write_queue.task_done()
+
+    def _stop_writer(self):
+        """Let the writer finish what is queued, then end it."""
+        if self.writer:
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def _chunk_intact(self, message, data):
+        """True if data is the whole chunk and matches its checksum (chunks sent without one are taken as is)."""
+        if len(data) != message['size']:
+            return False
+        checksum = message.get('checksum')
+        return not checksum or hashing.chunk_digest(data) == checksum
 
     def _send_message(self, message):
         json_message = json.dumps(message).encode('utf-8')
         self.sock.sendall(len(json_message).to_bytes(4, 'big') + json_message)
 
-    def _receive_message_and_data(self, max_data_size):
+    def _receive_message_and_data(self):
         try:
-            raw_len = self.sock.recv(4)
+            raw_len = _recv_exact(self.sock, 4)
             if not raw_len:
                 return None, None
             msg_len = int.from_bytes(raw_len, 'big')
-            json_message = self.sock.recv(msg_len).decode('utf-8')
-            message = json.loads(json_message)
+            json_message = _recv_exact(self.sock, msg_len)
+            if json_message is None:
+                return None, None
+            message = json.loads(json_message.decode('utf-8'))
             
             data = b''
             if message.get('type') == protocol.MSG_TYPE_FILE_CHUNK:
-                data_len = message['size']
-                while len(data) < data_len:
-                    packet = self.sock.recv(min(data_len - len(data), max_data_size))
-                    if not packet:
-                        break
-                    data += packet
+                data = _recv_exact(self.sock, message['size']) or b''
             return message, data
-        except (socket.timeout, json.JSONDecodeError, ConnectionResetError, ValueError) as e:
+        except (json.JSONDecodeError, ConnectionResetError, ValueError) as e:
             print(f"Error receiving message and data: {e}")
             return None, None
 
     def _close(self):
-        if self.file_handle:
-            self.file_handle.close()
+        self._stop_writer()
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
         if self.sock:
             try:
                 self.sock.close()
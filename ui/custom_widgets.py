@@ -178,6 +178,7 @@ class FileTransferWidget(QWidget):
         self._scan_text = ""  # Start with empty scan text
         self._scan_progress = 0
         self._scan_status = "pending"  # pending, scanning, safe, unsafe
+        self.chunk_size = None  # Bytes per slice the server currently sends this file in
 
         self.init_ui()
 
@@ -570,8 +570,18 @@ class ServerWindow(QMainWindow):
         actions = QHBoxLayout()
         self.cancel_all_button = QPushButton("Cancel All Transfers")
         self.cancel_selected_button = QPushButton("Cancel Selected")
+        # Total bandwidth for transfers, adjustable while sharing; 0 means no limit
+        self.rate_limit_spinbox = QSpinBox()
+        self.rate_limit_spinbox.setRange(0, 10000)
+        self.rate_limit_spinbox.setSingleStep(5)
+        self.rate_limit_spinbox.setSuffix(" MB/s")
+        self.rate_limit_spinbox.setSpecialValueText("No limit")
+        self.rate_limit_spinbox.setKeyboardTracking(False)
+        self.rate_limit_spinbox.setToolTip("Limit the total bandwidth used for sending files")
         actions.addWidget(self.cancel_all_button)
         actions.addStretch(1)
+        actions.addWidget(QLabel("Bandwidth:"))
+        actions.addWidget(self.rate_limit_spinbox)
         actions.addWidget(self.cancel_selected_button)
         transfers_vbox.addLayout(actions)
 
@@ -0,0 +1,187 @@
+"""
+Persistent cache of file hashes for the files the server distributes.
+
+Every file is hashed once by utils/hashing.py: the tree hash (root plus a
+SHA-256 per HASH_CHUNK_SIZE chunk, chunks hashed in parallel) is stored in
+SQLite keyed by path and validated against the file's inode, size and mtime.
+Any change to those makes the entry stale and the next request re-hashes the
+file. The plain whole-file SHA-256, needed only for VirusTotal lookups, is
+computed on first request and kept alongside. The virus scanner, FILE_METADATA
+(dedup) and the FILE_DIGEST integrity trailer all read from the same cache.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from utils import hashing
+from utils.hashing import TreeHashes
+
+HASH_CHUNK_SIZE = hashing.CHUNK_SIZE  # Granularity of the per-chunk digests
+# 1: file_hashes, keyed by plain SHA-256; 2: tree_hashes, keyed by tree root
+SCHEMA_VERSION = 2
+DEFAULT_DB_PATH = os.environ.get(
+    'LAN_AUTO_INSTALL_HASH_CACHE',
+    os.path.join(os.path.expanduser("~"), ".lan_auto_install", "hash_cache.sqlite3")
+)
+
+
+class HashCache:
+    """
+    SQLite-backed {path: (inode, size, mtime_ns) -> TreeHashes} cache, safe to share between threads.
+    """
+    def __init__(self, db_path=DEFAULT_DB_PATH, chunk_size=HASH_CHUNK_SIZE):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.path_locks = {}  # {path: Lock} so concurrent requests for one file share a single pass
+        self.db = None
+        try:
+            if db_path != ":memory:":
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self._migrate()
+            self.db.commit()
+        except (OSError, sqlite3.Error) as e:
+            # Hashing still works, results just are not kept between runs
+            print(f"Hash cache unavailable at {db_path}: {e}")
+            self.db = None
+
+    def _migrate(self):
+        """Bring the database to SCHEMA_VERSION, keeping entries written by earlier versions."""
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tree_hashes ("
+            " path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER,"
+            " root TEXT, chunk_size INTEGER, chunks BLOB, sha256 TEXT, hashed_at REAL)"
+        )
+        has_v1 = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_hashes'"
+        ).fetchone()
+        if version < 2 and has_v1:
+            # Version 1 stored the same per-chunk digests, so the tree root follows from
+            # them without reading the file, and its whole-file digest is the plain SHA-256
+            rows = self.db.execute(
+                "SELECT path, inode, size, mtime_ns, sha256, chunk_size, chunks, hashed_at FROM file_hashes"
+            ).fetchall()
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tree_hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path, inode, size, mtime_ns, hashlib.sha256(chunks or b"").hexdigest(),
+                  chunk_size, chunks, sha256, hashed_at)
+                 for path, inode, size, mtime_ns, sha256, chunk_size, chunks, hashed_at in rows]
+            )
+            self.db.execute("DROP TABLE file_hashes")
+        if version < SCHEMA_VERSION:
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def get(self, file_path):
+        """TreeHashes for file_path, hashing it if it is not cached or changed since."""
+        file_path = os.path.abspath(file_path)
+        with self._path_lock(file_path):
+            st = os.stat(file_path)
+            cached = self._lookup(file_path, st)
+            if cached:
+                return cached
+            hashes = hashing.hash_file(file_path, self.chunk_size)
+            # A file modified while it was read gets hashed again next time
+            if os.stat(file_path).st_mtime_ns == st.st_mtime_ns:
+                self._store(file_path, st, hashes)
+            return hashes
+
+    def peek(self, file_path):
+        """TreeHashes for file_path if the cache holds a current entry, else None; never reads the file."""
+        file_path = os.path.abspath(file_path)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return self._lookup(file_path, st)
+
+    def file_hash(self, file_path):
+        """Tree-hash root of the file: its content identity for dedup, manifests and verification."""
+        return self.get(file_path).root
+
+    def chunk_hashes(self, file_path):
+        """Per-chunk SHA-256 hex digests (chunk size is HashCache.chunk_size)."""
+        return self.get(file_path).chunks
+
+    def sha256(self, file_path):
+        """Plain whole-file SHA-256 hex digest, as external lookups (VirusTotal) expect."""
+        file_path = os.path.abspath(file_path)
+        with self._path_lock(file_path):
+            st = os.stat(file_path)
+            row = self._row(file_path)
+            if row and row[7] and tuple(row[:3]) == (st.st_ino, st.st_size, st.st_mtime_ns):
+                return row[7]
+            # One sequential pass gives both, so the tree hash is not read separately later
+            digest, hashes = hashing.hash_file_sequential(file_path, self.chunk_size)
+            if os.stat(file_path).st_mtime_ns == st.st_mtime_ns:
+                self._store(file_path, st, hashes, digest)
+            return digest
+
+    def _path_lock(self, file_path):
+        """Lock serialising hashing of one file, so concurrent requests share a single pass."""
+        with self.lock:
+            return self.path_locks.setdefault(file_path, threading.Lock())
+
+    def _row(self, file_path):
+        if self.db is None:
+            return None
+        try:
+            with self.lock:
+                return self.db.execute(
+                    "SELECT inode, size, mtime_ns, root, chunk_size, chunks, hashed_at, sha256"
+                    " FROM tree_hashes WHERE path = ?", (file_path,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            # Treated as a miss; the file is hashed again
+            print(f"Could not read cached hash of {file_path}: {e}")
+            return None
+
+    def _lookup(self, file_path, st):
+        row = self._row(file_path)
+        if not row or tuple(row[:3]) != (st.st_ino, st.st_size, st.st_mtime_ns) or row[4] != self.chunk_size:
+            return None
+        blob = row[5] or b""
+        chunks = [blob[i:i + 32].hex() for i in range(0, len(blob), 32)]
+        return TreeHashes(row[3], row[4], chunks)
+
+    def _store(self, file_path, st, hashes, sha256=None):
+        if self.db is None:
+            return
+        blob = b"".join(bytes.fromhex(c) for c in hashes.chunks)
+        try:
+            with self.lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO tree_hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (file_path, st.st_ino, st.st_size, st.st_mtime_ns, hashes.root,
+                     hashes.chunk_size, blob, sha256, time.time())
+                )
+                self.db.commit()
+        except sqlite3.Error as e:
+            print(f"Could not cache hash of {file_path}: {e}")
+
+    def forget(self, file_path):
+        if self.db is None:
+            return
+        try:
+            with self.lock:
+                self.db.execute("DELETE FROM tree_hashes WHERE path = ?", (os.path.abspath(file_path),))
+                self.db.commit()
+        except sqlite3.Error as e:
+            print(f"Could not drop cached hash of {file_path}: {e}")
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_hash_cache():
+    """The process-wide HashCache."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = HashCache()
+        return _shared_cache
@@ -0,0 +1,180 @@
+"""
+Content index of received files, used to skip transfers of files the client already holds.
+
+Maps the content hash (the tree-hash root of utils/hashing.py, as sent in
+FILE_METADATA) of every file under received_files/ to where it currently
+lives. Entries remember the size and mtime they were hashed at, so a file that
+was modified, moved or deleted since is never offered as a match. The index is
+persisted as JSON in the indexed directory and refreshed in the background.
+"""
+
+import json
+import os
+import re
+import threading
+
+from utils import hashing
+
+INDEX_FILE_NAME = ".hash_index.json"
+INDEX_VERSION = 2  # Indexes written before tree hashes are discarded and rebuilt
+# Files in these directories are incomplete or bookkeeping, never dedup sources
+SKIP_DIRS = {"tmp"}
+SKIP_SUFFIXES = (".resume", ".info.txt", ".new")
+# Suffix _unique_temp_path() gives duplicates: name_<n>.ext
+DUPLICATE_SUFFIX = re.compile(r"_\d+$")
+
+
+class HashIndex:
+    """
+    Persistent {path: (size, mtime_ns, sha256)} index of a directory tree,
+    with reverse maps by content and by name so lookups do not scan it.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.index_path = os.path.join(root_dir, INDEX_FILE_NAME)
+        self.entries = {}  # {relative path: [size, mtime_ns, sha256]}
+        self.by_content = {}  # {(sha256, size): {relative path}}
+        self.by_name = {}  # {file name as sent: {relative path}}, duplicates saved as name_<n>.ext included
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Files received together finish, and save, concurrently
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict) and data.get("version") == INDEX_VERSION and isinstance(data.get("entries"), dict):
+                for rel_path, entry in data["entries"].items():
+                    self._set(rel_path, entry)
+        except (OSError, ValueError, TypeError, IndexError):
+            self.entries, self.by_content, self.by_name = {}, {}, {}
+
+    @staticmethod
+    def _names(rel_path):
+        """Names a file may have been sent under: its own, and without a duplicate's _<n> suffix."""
+        name = os.path.basename(rel_path)
+        base_name, ext = os.path.splitext(name)
+        return {name, DUPLICATE_SUFFIX.sub("", base_name) + ext}
+
+    def _set(self, rel_path, entry):
+        """Add or replace an entry and its reverse-map keys; call with self.lock held (or before sharing)."""
+        self._pop(rel_path)
+        self.entries[rel_path] = entry
+        self.by_content.setdefault((entry[2], entry[0]), set()).add(rel_path)
+        for name in self._names(rel_path):
+            self.by_name.setdefault(name, set()).add(rel_path)
+
+    def _pop(self, rel_path):
+        """Remove an entry and its reverse-map keys; call with self.lock held. Returns the entry."""
+        entry = self.entries.pop(rel_path, None)
+        if entry is None:
+            return None
+        key = (entry[2], entry[0])
+        self.by_content[key].discard(rel_path)
+        if not self.by_content[key]:
+            del self.by_content[key]
+        for name in self._names(rel_path):
+            self.by_name[name].discard(rel_path)
+            if not self.by_name[name]:
+                del self.by_name[name]
+        return entry
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"version": INDEX_VERSION, "entries": self.entries})
+        tmp_path = self.index_path + ".new"
+        with self.save_lock:
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                print(f"Could not save hash index: {e}")
+
+    def _relative(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.root_dir))
+
+    def _current(self, rel_path, entry):
+        """True if the file still has the size and mtime it was hashed at."""
+        try:
+            st = os.stat(os.path.join(self.root_dir, rel_path))
+        except OSError:
+            return False
+        return st.st_size == entry[0] and st.st_mtime_ns == entry[1]
+
+    def lookup(self, sha256, file_size):
+        """Path of an unchanged indexed file with this content, or None."""
+        with self.lock:
+            candidates = [(rel, self.entries[rel]) for rel in self.by_content.get((sha256, file_size), ())]
+        for rel_path, entry in candidates:
+            if self._current(rel_path, entry):
+                return os.path.join(self.root_dir, rel_path)
+            with self.lock:
+                if self.entries.get(rel_path) is entry:
+                    self._pop(rel_path)
+        return None
+
+    def find_by_name(self, file_name):
+        """
+        Path of the newest unchanged indexed file received under file_name (or the
+        name_<n>.ext a duplicate was saved as), or None.
+        """
+        with self.lock:
+            candidates = [(self.entries[rel][1], rel, self.entries[rel]) for rel in self.by_name.get(file_name, ())]
+        for _, rel_path, entry in sorted(candidates, reverse=True):
+            if self._current(rel_path, entry):
+                return os.path.join(self.root_dir, rel_path)
+        return None
+
+    def add(self, file_path, sha256=None):
+        """Index file_path, hashing it unless its digest is supplied; returns the digest."""
+        try:
+            st = os.stat(file_path)
+            if sha256 is None:
+                sha256 = hashing.hash_file(file_path).root
+        except OSError:
+            return None
+        with self.lock:
+            self._set(self._relative(file_path), [st.st_size, st.st_mtime_ns, sha256])
+        return sha256
+
+    def digest(self, file_path):
+        """SHA-256 of file_path, from the index while the file is unchanged, else hashed and indexed."""
+        rel_path = self._relative(file_path)
+        with self.lock:
+            entry = self.entries.get(rel_path)
+        if entry and self._current(rel_path, entry):
+            return entry[2]
+        return self.add(file_path)
+
+    def move(self, old_path, new_path):
+        """Follow a file that was renamed without changing its content."""
+        with self.lock:
+            entry = self._pop(self._relative(old_path))
+        if entry:
+            try:
+                st = os.stat(new_path)
+            except OSError:
+                return
+            with self.lock:
+                self._set(self._relative(new_path), [st.st_size, st.st_mtime_ns, entry[2]])
+
+    def refresh(self):
+        """Drop entries for vanished or modified files and hash files not yet indexed."""
+        with self.lock:
+            entries = dict(self.entries)
+        stale = [rel for rel, entry in entries.items() if not self._current(rel, entry)]
+        with self.lock:
+            for rel_path in stale:
+                self._pop(rel_path)
+            known = set(self.entries)
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            if dirpath == self.root_dir:
+                dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+            for name in filenames:
+                if name == INDEX_FILE_NAME or name.endswith(SKIP_SUFFIXES):
+                    continue
+                file_path = os.path.join(dirpath, name)
+                if self._relative(file_path) not in known:
+                    self.add(file_path)
+        self.save()
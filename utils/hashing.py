@@ -0,0 +1,138 @@
+"""
+File hashing shared by the sender, the receiver and the virus scanner.
+
+Content is identified by a tree hash: the file is cut into CHUNK_SIZE chunks,
+each chunk gets its own SHA-256, and the root is the SHA-256 of the chunk
+digests concatenated. Chunks are independent, so a large file is hashed by a
+pool of threads reading CHUNK_SIZE-aligned ranges (hashlib releases the GIL
+while it hashes), and a stream can be hashed incrementally as it is sent or
+written. Protocol fields named "sha256" (FILE_METADATA, manifests, FILE_DIGEST)
+carry this root.
+
+hash_file_sequential() also gives the plain SHA-256 of a whole file, which is
+what external services such as VirusTotal look files up by; it cannot be split
+across cores and is only computed where such a lookup needs it.
+"""
+
+import hashlib
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Leaf size of the tree hash; sender and receiver must agree on it
+HASH_WORKERS = max(2, os.cpu_count() or 2)  # Threads hashing chunks of large files
+READ_BLOCK_SIZE = 4 * 1024 * 1024  # Read size for the sequential whole-file SHA-256
+
+TreeHashes = namedtuple("TreeHashes", ["root", "chunk_size", "chunks"])  # chunks: list of hex digests
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _hash_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+        return _pool
+
+
+def chunk_digest(data):
+    """SHA-256 hex digest of one chunk."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def tree_root(chunks):
+    """Root of the tree hash over these chunk hex digests (an empty file has no chunks)."""
+    return hashlib.sha256(b"".join(bytes.fromhex(c) for c in chunks)).hexdigest()
+
+
+def _hash_range(file_path, offset, length):
+    """SHA-256 hex digest of length bytes of file_path at offset, read with one aligned read."""
+    buf = bytearray(length)
+    view = memoryview(buf)
+    filled = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        while filled < length:
+            n = f.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+    return hashlib.sha256(view[:filled]).hexdigest()
+
+
+def hash_file(file_path, chunk_size=CHUNK_SIZE):
+    """
+    TreeHashes of file_path. Files of more than one chunk have their chunks
+    hashed in parallel on the shared pool.
+    """
+    size = os.path.getsize(file_path)
+    offsets = range(0, size, chunk_size)
+    if len(offsets) <= 1:
+        chunks = [_hash_range(file_path, 0, size)] if size else []
+    else:
+        pool = _hash_pool()
+        futures = [pool.submit(_hash_range, file_path, offset, min(chunk_size, size - offset))
+                   for offset in offsets]
+        chunks = [future.result() for future in futures]
+    return TreeHashes(tree_root(chunks), chunk_size, chunks)
+
+
+def hash_file_sequential(file_path, chunk_size=CHUNK_SIZE, block_size=READ_BLOCK_SIZE):
+    """
+    (plain SHA-256 hex digest, TreeHashes) of file_path in one sequential pass.
+    The plain digest cannot be split across cores, so this is only for callers
+    that need it; everything else uses hash_file().
+    """
+    whole = hashlib.sha256()
+    tree = TreeHasher(chunk_size)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            whole.update(view[:n])
+            tree.update(view[:n])
+    root, chunks = tree.digests()
+    return whole.hexdigest(), TreeHashes(root, chunk_size, chunks)
+
+
+class TreeHasher:
+    """
+    Tree hash of a byte stream taken as the bytes go by: the SHA-256 of each
+    chunk_size chunk, and the root over them once the stream ends.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = []  # Hex digests of completed chunks
+        self.size = 0  # Bytes fed so far
+        self._chunk = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data).cast("B")
+        self.size += len(view)
+        while len(view):
+            take = min(len(view), self.chunk_size - self._filled)
+            self._chunk.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.chunk_size:
+                self.chunks.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+                self._filled = 0
+
+    def digests(self):
+        """(root, per-chunk hex digests) of everything fed so far."""
+        chunks = list(self.chunks)
+        if self._filled:
+            chunks.append(self._chunk.hexdigest())
+        return tree_root(chunks), chunks
+
+    def hexdigest(self):
+        """Root of the tree hash of everything fed so far."""
+        return self.digests()[0]
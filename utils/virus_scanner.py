@@ -2,10 +2,10 @@
 Virus scanning utility using VirusTotal API
 """
 import os
-import hashlib
 import requests
 import time
 from PyQt5.QtCore import QObject, pyqtSignal
+from utils.hash_cache import get_hash_cache
 
 class VirusScanner(QObject):
     # Signals for UI updates
@@ -29,12 +29,8 @@ class VirusScanner(QObject):
         self.current_scan = None  # Track current scan for cancellation
 
     def _calculate_file_hash(self, file_path):
-        """Calculate SHA-256 hash of file"""
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+        """Plain SHA-256 of the file, as VirusTotal indexes files (cached across scans)"""
+        return get_hash_cache().sha256(file_path)
 
     def _check_cached_result(self, file_hash):
         """Check if we have a cached scan result"""
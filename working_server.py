@@ -76,6 +76,7 @@ class ServerController:
         self.ui.select_all_files_button.clicked.connect(self.select_all_files)
         self.ui.send_to_all_button.clicked.connect(self.send_to_all_clients)
         self.network_server.file_progress.connect(self.update_transfer_progress)
+        self.network_server.file_chunk_size.connect(self.update_transfer_chunk_size)
         self.network_server.status_update_received.connect(self.update_transfer_status)
         # self.ui.client_list_widget.itemClicked.connect(self.show_client_profile)
         self.ui.show_profile_button.clicked.connect(self.show_selected_client_profile)
@@ -83,6 +84,8 @@ class ServerController:
         self.ui.cancel_selected_button.clicked.connect(self.cancel_selected_transfers)
         if hasattr(self.ui, 'share_more_button'):
             self.ui.share_more_button.clicked.connect(self.share_more)
+        if hasattr(self.ui, 'rate_limit_spinbox'):
+            self.ui.rate_limit_spinbox.valueChanged.connect(self.set_rate_limit)
         # Connect Details button signal
         if hasattr(self.ui, 'show_server_details_requested'):
             self.ui.show_server_details_requested.connect(self.show_server_details)
@@ -604,10 +607,19 @@ class ServerController:
         if (file_name, client_ip) in self.transfer_widgets:
             widget = self.transfer_widgets[(file_name, client_ip)]
             widget.set_progress(percentage)
-            widget.set_status(f"Sending to {client_ip}...", "orange")
+            if widget.chunk_size:
+                size = widget.chunk_size
+                chunks = f"{size / (1024 * 1024):.0f} MB" if size >= 1024 * 1024 else f"{size // 1024} KB"
+                widget.set_status(f"Sending to {client_ip}... ({chunks} chunks)", "orange")
+            else:
+                widget.set_status(f"Sending to {client_ip}...", "orange")
             if percentage >= 100:
                 widget.set_status("Sent", "lightgreen")
 
+    def update_transfer_chunk_size(self, file_name, client_ip, chunk_size):
+        if (file_name, client_ip) in self.transfer_widgets:
+            self.transfer_widgets[(file_name, client_ip)].chunk_size = chunk_size
+
     def update_transfer_status(self, file_name, client_ip, status):
         if (file_name, client_ip) in self.transfer_widgets:
             widget = self.transfer_widgets[(file_name, client_ip)]
@@ -688,6 +700,9 @@ class ServerController:
                 break
         self.transfer_widgets.pop((file_name, client_ip), None)
 
+    def set_rate_limit(self, megabytes_per_second):
+        self.network_server.set_rate_limit(megabytes_per_second * 1024 * 1024)
+
     def cancel_all_transfers(self):
         self.network_server.cancel_all_transfers()
         # Clear the UI transfer list entirely